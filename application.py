@@ -9,18 +9,48 @@ Description: This is the main GUI application for the "Pierce's Lock"
 
 """
 
-import glob, binascii, os
+import os, queue
 import tkinter as tk
 from tkinter import Frame, Button, Label, Menu, Entry, StringVar, Listbox, \
     Scrollbar
-from tkinter.filedialog import askopenfilename,asksaveasfilename,askdirectory
+from tkinter.ttk import Progressbar
+from tkinter.filedialog import askopenfilename,asksaveasfilename,askdirectory,\
+    askopenfilenames
+from tkinter.simpledialog import askstring
 from PIL import ImageTk, Image
 
-from AESCipher import AESCipher, AuthenticationFailed,\
-    DecryptionFailed, UnpaddingError, TTLError
+from pierceslock.cipher import AESCipher
+from pierceslock.exceptions import AuthenticationFailed, DecryptionFailed, \
+    UnpaddingError, TTLError, InvalidToken, NotAnArchive
+from pierceslock.jobs import Job, Batch, BATCH_WORKERS
+from pierceslock import keys
+from pierceslock.keystore import KeyStoreIndex, KEYSTORE_SUFFIX, \
+    load_key_spec, open_key_index
+from pierceslock.compress import default_codec
+from pierceslock.archive import encrypt_tree, decrypt_tree
+from pierceslock.container import cmf_name, plain_name
 
 from password_manager import PasswordManager
 
+class _ProgressCipher(object):
+    '''
+    Passes encrypt_file and decrypt_file on to an AESCipher, counting the 
+    input toward a Job (see the progress argument).  encrypt_tree and 
+    decrypt_tree are given one, so folders count their tar stream and
+    archive the same way files do.
+    '''
+    def __init__(self, cipher, job):
+        self.cipher = cipher
+        self.job = job
+
+    def encrypt_file(self, src, dst, key, **kwargs):
+        return self.cipher.encrypt_file(src, dst, key, 
+                                        progress=self.job.advance, **kwargs)
+
+    def decrypt_file(self, src, dst, key, **kwargs):
+        return self.cipher.decrypt_file(src, dst, key, 
+                                        progress=self.job.advance, **kwargs)
+
 class Application(object):
     
     def __init__(self):
@@ -34,7 +64,10 @@ class Application(object):
         window_width : int 
            Pixel width of base application 
         key_dir : string ('keys/')
-           The directory location where the .key files are stored
+           The directory location where the .key files are stored, or a
+           keystore (.pks file) holding them
+        key_index : KeyIndex or KeyStoreIndex object
+           The cached listing of key_dir, shared with the password manager
         version : string 
            The version number of the current software
         last_update : string
@@ -43,6 +76,14 @@ class Application(object):
            The main application window
         pwm : PasswordManager object
             This is used to add the PasswordManager to the main application
+        screens : dict
+            The Frame of every screen built so far, by name (see show_screen)
+        images : dict
+            The PhotoImages decoded so far (see image)
+        status_labels : dict
+            The step status labels of the encryption and decryption screens
+        batch : Batch object or None
+            The last batch started (see run_batch)
             
         Returns
         -------
@@ -54,6 +95,11 @@ class Application(object):
         self.key_dir = os.path.abspath('keys')
         self.version = "0.1.4"
         self.last_update = '21 Nov 2021'
+        self.screens = {}
+        self.screen = None
+        self.images = {}
+        self.status_labels = {}
+        self.batch = None
 
         if os.path.exists('.profile'):
             with open('.profile' , 'r') as f:
@@ -65,6 +111,8 @@ class Application(object):
         else:
             with open('.profile', 'w') as f:
                 f.write('key_dir '+ self.key_dir)
+        
+        self.key_index = open_key_index(self.key_dir)
                 
         # Initialize Window
         self.window = tk.Tk()
@@ -81,7 +129,7 @@ class Application(object):
         
     def draw_menu(self):
         '''
-        Draws the main menu (default view)
+        Draws the main menu (default view), or puts it back
 
         Attributes
         ----------
@@ -93,8 +141,11 @@ class Application(object):
         None.
         '''
         
+        # The menu is built once; the password manager puts up its own, so
+        # it is put back rather than rebuilt
         if hasattr(self, 'menu'):
-            self.menu.destroy()
+            self.window.config(menu=self.menu)
+            return
         
         # Build the menu
         self.menu = Menu(self.window)
@@ -114,6 +165,8 @@ class Application(object):
                              command=self.decryption_window)
         toolMenu.add_command(label='Key Manager', 
                              command=self.key_manager_window)
+        toolMenu.add_command(label='Job Queue', 
+                             command=self.queue_window)
         
         toolMenu.add_command(label='Password Manager', 
                               command=self.pwm.password_manager_window)        
@@ -125,6 +178,30 @@ class Application(object):
     def draw_main(self):
         '''
         Draws the main GUI
+           
+        Returns
+        -------
+        None.
+        '''    
+        self.show_screen('main', self.build_main, 400, 400)
+        self.draw_menu()
+
+    def show_screen(self, name, build, width, height):
+        '''
+        Shows the screen called name in the window and hides the one shown 
+        before.  Each screen is built once, by build, and then kept, so 
+        switching screens does not recreate any widgets.
+
+        Parameters
+        ----------
+        name : string
+            The name of the screen
+        build : callable
+            build(frame) puts the widgets of the screen in frame
+        width : int
+            Pixel width of the screen
+        height : int
+            Pixel height of the screen
 
         Attributes
         ----------
@@ -132,55 +209,106 @@ class Application(object):
            Pixel height of base application 
         window_width : int 
            Pixel width of base application 
+        screen : string
+           The name of the screen shown
         background_frame : Tkinter Frame object
-           The space to draw the app content 
-           
+           The Frame of the screen shown
+
         Returns
         -------
-        None.
-        '''    
-        self.window_height = 400
-        self.window_width = 400
+        frame : Tkinter Frame object
+            The Frame of the screen
+        '''
+        if hasattr(self, 'popup_window'):
+            self.popup_window.destroy()
+        
+        self.window_height = height
+        self.window_width = width
         self.window.geometry("%dx%d" % (self.window_width, 
                                         self.window_height))
         
-        if hasattr(self, 'popup_window'):
-            self.popup_window.destroy()
-        if hasattr(self, 'background_frame'):
-            self.background_frame.destroy()        
-        self.draw_menu()
+        if name not in self.screens:
+            frame = Frame(self.window, width=width, height=height)
+            build(frame)
+            self.screens[name] = frame
         
-        self.background_frame = Frame(self.window, 
-                                 width=self.window_width,
-                                 height=self.window_height)
-        self.background_frame.pack()
+        if self.screen != name:
+            if self.screen in self.screens:
+                self.screens[self.screen].pack_forget()
+            self.screens[name].pack()
+            self.screen = name
         
-        label = Label(self.background_frame, 
+        self.background_frame = self.screens[name]
+        return self.background_frame
+
+    def image(self, name, size):
+        '''
+        The image img/<name>.png scaled to size x size pixels.  Each image 
+        is decoded once and then shared by every label that shows it.
+
+        Parameters
+        ----------
+        name : string
+            The image name, e.g. 'green_check'
+        size : int
+            Pixel width and height
+
+        Returns
+        -------
+        ImageTk.PhotoImage object
+        '''
+        if (name, size) not in self.images:
+            img = Image.open('img/%s.png' % name)
+            self.images[name, size] = ImageTk.PhotoImage(
+                img.resize((size, size), Image.ANTIALIAS))
+        return self.images[name, size]
+
+    def set_status(self, label, done):
+        '''
+        Shows a green check mark (done) or a red x in a step status label
+        
+        Returns
+        -------
+        None.
+        '''
+        size = int(self.window_width / 3) - 100
+        label.config(image=self.image('green_check' if done else 'red_x', 
+                                      size))
+
+    def build_main(self, frame):
+        '''
+        Builds the main screen (see draw_main) in frame
+        
+        Returns
+        -------
+        None.
+        '''
+        label = Label(frame, 
                       text='Pierce\'s Lock', 
                       font=('Helvetica', 18,'bold'))
         label.place(x=50, y=49, width=300, height=50)
         
-        button1 = Button(self.background_frame,
+        button1 = Button(frame,
                          text='Encrypt File',
                          command=self.encryption_window)
         button1.place(x=140, y=100, width=120, height=50)
 
-        button2 = Button(self.background_frame,
+        button2 = Button(frame,
                          text='Decrypt File',
                          command=self.decryption_window)
         button2.place(x=140, y=151, width=120, height=50)
 
-        button3 = Button(self.background_frame,
+        button3 = Button(frame,
                          text='Key Manager',
                          command=self.key_manager_window)
         button3.place(x=140, y=202, width=120, height=50)
         
-        button4 = Button(self.background_frame,
+        button4 = Button(frame,
                           text='Password Manager',
                           command=self.pwm.password_manager_window)
         button4.place(x=140, y=253, width=120, height=50)
 
-        button5 = Button(self.background_frame,
+        button5 = Button(frame,
                          text='Exit',
                          command=self.quit_prompt)
         button5.place(x=140, y=304, width=120, height=50)
@@ -249,101 +377,18 @@ class Application(object):
                            command=popup_window.destroy)
         button1.place(x=100, y=450, width=100, height=30 )        
 
-
-    def encryption_window_new(self):
-        '''
-        This generates a window to encrypt files
-
-        Attributes:
-        -----------
-        window_height : int
-            The heights of the window
-        window_width : int
-            The width of the window
-        background_frame : tkinter Frame object
-            The drawing canvas for the window
-        key_path_var : StringVar object
-            The entry for the key file
-        left_pane : tkinter Listbox object
-            The list of possible keys
-
-        Returns
-        -------
-        None.
-
-        '''
-        self.window_height = 600
-        self.window_width = 801
-        
-        self.window.geometry("%dx%d" % (self.window_width, 
-                                        self.window_height))
-        
-        if hasattr(self, 'popup_window'):
-            self.popup_window.destroy()
-        if hasattr(self, 'background_frame'):
-            self.background_frame.destroy()        
-        
-        self.background_frame = Frame(self.window, 
-                                 width=self.window_width,
-                                 height=self.window_height)
-        self.background_frame.pack()        
-        self.draw_menu()
-        
-        label = Label(self.background_frame,
-                      text='File(s) to Encrypt: ')
-        label.place(x=0, y=0, width=100, height=30)
-        
-        self.key_path_var = StringVar()
-        path_pane = Entry(self.background_frame, 
-                          textvariable=self.key_path_var)
-        self.key_path_var.set(self.key_dir)
-        path_pane.bind('<Return>', self.update_key_dir)
-        path_pane.place(x=100, y=0, width=self.window_width-250, height=30)
-        
-        button = Button(self.background_frame,
-                        text='Browse',
-                        command=self.change_key_dir)
-        button.place(x=self.window_width-150, y=0, width=150, height=30)
-        
-        self.left_pane = Listbox(self.background_frame)
-        self.left_pane.bind('<<ListboxSelect>>', self.select_key)
-        
-        self.left_pane.place(x=0, y=31, 
-                        width=300, 
-                        height=self.window_height)
-
-
-        for i, key_file in enumerate(glob.glob(self.key_dir + '/*.key')):
-            self.left_pane.insert(i, key_file.split('\\')[-1][:-4])
-        
-        scrollbar = Scrollbar(self.left_pane)
-        scrollbar.pack(side = tk.RIGHT, fill = tk.BOTH)
-        self.left_pane.config(yscrollcommand = scrollbar.set)
-        scrollbar.config(command = self.left_pane.yview)
-        
-        label = Label(self.background_frame, 
-                      text='Encryption Key:', 
-                      font=('Helvetica', 12,'bold')
-                      )
-        label.place(x=355, y=50, width=460, height=30)
-        
-    
     def encryption_window(self):
         '''
         Loads the encryption menu in the application
 
         Attributes
         ----------
-        window_height : int 
-           Pixel height of base application 
-        window_width : int 
-           Pixel width of base application 
         filepath : string
             The location of the file to be encrypted
+        filepaths : list of strings
+            Every file picked in step 1 (more than one runs as a batch)
         keyfile : string
             The location of the encryption key to be used
-        background_frame :Tkinter Frame object
-           The space to draw the app content 
         label_status_1 : tkinter Label object
             The label for the status for step 1, i.e., select file to encrypt
         label_status_2 : tkinter Label object
@@ -353,12 +398,25 @@ class Application(object):
         -------
         None.
         '''
+        self.show_screen('encrypt', self.build_encryption, 801, 400)
+        self.draw_menu()
         
-        self.window_height = 400
-        self.window_width = 801
         self.filepath = None
+        self.filepaths = []
         self.keyfile = None
+        self.label_status_1, self.label_status_2 = \
+            self.status_labels['encrypt']
+        self.set_status(self.label_status_1, False)
+        self.set_status(self.label_status_2, False)
+
+    def build_encryption(self, frame):
+        '''
+        Builds the encryption screen (see encryption_window) in frame
         
+        Returns
+        -------
+        None.
+        '''
         col2 = int(self.window_width / 3)
         col3 = col2 * 2
         
@@ -366,52 +424,41 @@ class Application(object):
         row2 = 100
         row3 = 150
         
-        if hasattr(self, 'background_frame'):
-            self.background_frame.destroy()  
-        if hasattr(self, 'popup_window'):
-            self.popup_window.destroy()            
-        self.draw_menu()
-        
-        self.window.geometry("%dx%d" % (self.window_width, 
-                                        self.window_height))
-        
-        self.background_frame = Frame(self.window, 
-                                 width=self.window_width,
-                                 height=self.window_height)
-        self.background_frame.pack()
-        
-        label1 = Label(self.background_frame,
-                       text='Step 1: Pick file to encrypt', 
+        label1 = Label(frame,
+                       text='Step 1: Pick file(s) to encrypt', 
                       font=('Helvetica', 12,'bold'))
         label1.place(x=25, y=row1, width=col2 - 50)
 
-        browse_button = Button(self.background_frame, 
-                                text='Browse for file',
+        # A whole folder is encrypted into a single archive
+        folder_button = Button(frame, 
+                                text='Browse for folder',
+                                command=self.find_folder)
+        folder_button.place(x=25 + (col2 - 50) // 2, 
+                            y=row2, 
+                            width=(col2 - 50) // 2,
+                            height=30)
+
+        browse_button = Button(frame, 
+                                text='Browse for file(s)',
                                 command=self.find_file)
         
-        img = Image.open('img/red_x.png')
-        img = ImageTk.PhotoImage(img.resize((col2-100, col2-100), 
-                                            Image.ANTIALIAS))
-
-        self.label_status_1 = Label(self.background_frame,
-                                    image=img)
-        self.label_status_1.image = img
-        self.label_status_1.place(x=50, 
-                                  y=row3, 
-                                  width=col2-100, 
-                                  height=col2-100)
+        status_1 = Label(frame)
+        status_1.place(x=50, 
+                       y=row3,
+                       width=col2-100,
+                       height=col2-100)
 
         browse_button.place(x=25, 
                             y=row2, 
-                            width=col2 - 50,
+                            width=(col2 - 50) // 2,
                             height=30)
 
-        label2 = Label(self.background_frame,
+        label2 = Label(frame,
                        text='Step 2: Select encryption key', 
                       font=('Helvetica', 12,'bold'))
         label2.place(x=col2 + 20, y=row1, width=col2 - 40)
         
-        browse_button = Button(self.background_frame, 
+        browse_button = Button(frame, 
                                 text='Browse for key',
                                 command=self.find_key)
         
@@ -420,20 +467,19 @@ class Application(object):
                             width=col2 - 50,
                             height=30)
 
-        self.label_status_2 = Label(self.background_frame,
-                                    image=img)
-        self.label_status_2.image = img
-        self.label_status_2.place(x=col2+50, 
-                                  y=row3, 
-                                  width=col2-100, 
-                                  height=col2-100)
+        status_2 = Label(frame)
+        status_2.place(x=col2+50, 
+                       y=row3,
+                       width=col2-100,
+                       height=col2-100)
+        self.status_labels['encrypt'] = (status_1, status_2)
         
-        label3 = Label(self.background_frame,
+        label3 = Label(frame,
                        text='Step 3: Encrypt File', 
                       font=('Helvetica', 12,'bold'))
         label3.place(x=col3+25, y=row1, width=col2 - 50)
         
-        button = Button(self.background_frame, 
+        button = Button(frame, 
                                 text='Encrypt',
                                 command=self.encrypt)
         
@@ -442,7 +488,7 @@ class Application(object):
                     width=col2 - 50,
                     height=30)
         
-        button = Button(self.background_frame,
+        button = Button(frame,
                              text='<<< Back to Main Menu',
                              command=self.draw_main)
         
@@ -451,19 +497,24 @@ class Application(object):
     def encrypt(self):
         '''
         Helper function for encryption_window.  This function uses 
-        AESCipher.py to encrypt the file.
+        AESCipher (pierceslock/cipher.py) to encrypt the file on a 
+        background thread (see run_job).  Several files are encrypted as a
+        batch (see encrypt_batch).
         
         Attributes
         ----------
         popup_window : tkinter TopLevel object 
-           This popup window is the prompt once encryption is complete
+           The prompt shown once encryption is complete
            
         Returns
         -------
         None.              
         '''
         
-        if self.filepath and self.keypath:
+        if self.filepath and self.keypath and len(self.filepaths) > 1:
+            self.encrypt_batch()
+        
+        elif self.filepath and self.keypath:
             
             savepath = asksaveasfilename(filetypes=(("CMF File", 
                                                          ['.cmf']),),
@@ -474,14 +525,12 @@ class Application(object):
                 return
             
             cipher = AESCipher()
+            key = load_key_spec(self.keypath)
             
-            with open(self.keypath, "r") as f:
-                key = f.read()
-            
-            key = binascii.unhexlify(key)
-            ciphertext, signing_key = cipher.encrypt_file(self.filepath, key)
-            
-            file_ext = self.filepath.split('.')[-1].upper()
+            if os.path.isdir(self.filepath):
+                file_ext = 'TAR'
+            else:
+                file_ext = self.filepath.split('.')[-1].upper()
 
             if savepath[-4:] != '.cmf':
                 savepath = savepath+'_'+ file_ext + '.cmf'
@@ -489,42 +538,92 @@ class Application(object):
             else:
                 savepath = savepath[:-4] + '_' + file_ext + '.cmf'
                 
-            with open(savepath , "wb") as f:
-                f.write(signing_key + ciphertext)
-       
-            self.popup_window = tk.Toplevel()
-            self.popup_window.geometry("300x100") 
-            self.popup_window.wm_title("Encryption Successful")
+            filepath = self.filepath
             
-            # Background of the popup window
-            bkgd_frame = Frame(self.popup_window, width=300, height=100)
-            bkgd_frame.pack()
-            
-            # Label that displays the prompt
-            prompt_txt = "Encryption successful.  Encrypt another file?"
-            prompt = Label(bkgd_frame, text=prompt_txt)
-            prompt.place(x=25, y=20, width=250)
+            # Logs and CSVs shrink a lot; compressed formats are detected 
+            # and stored as-is.  The plaintext taken in is counted (through
+            # the cipher's progress callback, so path inputs stay mmap'd), 
+            # and the estimate does not depend on how well it compresses.
+            if os.path.isdir(filepath):
+                # The tar stream: each entry has a 512-byte header and is 
+                # padded to 512 bytes
+                total = 512
+                for root, _, names in os.walk(filepath):
+                    total += 512
+                    for name in names:
+                        size = os.path.getsize(os.path.join(root, name))
+                        total += 512 + -(-size // 512) * 512
+                
+                def work(job):
+                    with job.output(savepath, counted=False) as fout:
+                        encrypt_tree(filepath, fout, key, 
+                                     compression=default_codec(), 
+                                     cipher=_ProgressCipher(cipher, job))
+            else:
+                total = os.path.getsize(filepath)
+                
+                def work(job):
+                    with job.output(savepath, counted=False) as fout:
+                        cipher.encrypt_file(filepath, fout, key,
+                                            compression=default_codec(),
+                                            progress=job.advance)
             
-            # Buttons to save and quit, just quit, and cancel the "quit" 
-            # command
-            button = Button(bkgd_frame, text="Yes", 
-                               command=self.encryption_window)
-            button.place(x=49, y=50, width=100, height=30 )        
+            self.run_job("Encrypting", work, total, 
+                         lambda: self.success_popup("Encryption Successful",
+                             "Encryption successful.  Encrypt another file?",
+                             self.encryption_window))
+
+    def encrypt_batch(self):
+        '''
+        Helper function for encrypt.  Asks once for a folder and encrypts 
+        every file picked into it (as cmf_name would name them) through 
+        the job queue (see run_batch).  Files whose output exists already
+        fail instead of being overwritten.
+        
+        Returns
+        -------
+        None.
+        '''
+        outdir = askdirectory(initialdir = '', 
+                              title = "Save encrypted files in")
+        if not outdir:
+            return
+        
+        cipher = AESCipher()
+        key = load_key_spec(self.keypath)
+        # Share the cores between files running at the same time
+        workers = max(1, (os.cpu_count() or 1) // BATCH_WORKERS)
+        
+        def task(filepath):
+            savepath = os.path.join(outdir, 
+                                    cmf_name(os.path.basename(filepath)))
             
-            button = Button(bkgd_frame, text="No", 
-                                   command=self.draw_main)
-            button.place(x=151, y=50, width=100, height=30)
+            # The plaintext taken in is counted, so the estimate does not 
+            # depend on how well the file compresses
+            def work(job):
+                if os.path.exists(savepath):
+                    raise FileExistsError('%s exists' % savepath)
+                with job.output(savepath, counted=False) as fout:
+                    cipher.encrypt_file(filepath, fout, key, workers=workers,
+                                        compression=default_codec(),
+                                        progress=job.advance)
+            return work, os.path.getsize(filepath)
+        
+        self.run_batch("Encrypting %d files" % len(self.filepaths),
+                       self.filepaths, [task(path) for path in self.filepaths])
 
     def find_file(self):
         '''
-        Helper function for encryption_window.  This function finds the file 
-        (Step 1) to be encrypted.  If a file is selected, it changes the 
-        label_status_1 to a green check mark.
+        Helper function for encryption_window.  This function finds the 
+        file(s) (Step 1) to be encrypted.  If a file is selected, it changes 
+        the label_status_1 to a green check mark.
         
         Attributes
         ----------
         filepath : string 
-           This is the path to the file that will be encrypted.
+           This is the path to the (first) file that will be encrypted.
+        filepaths : list of strings
+           Every file that will be encrypted
         label_status_1 : tkinter Label object
             The label for the status for step 1, i.e., select file to encrypt
         
@@ -533,35 +632,45 @@ class Application(object):
         None.
         '''
         
-        self.filepath = askopenfilename(initialdir = '', 
-                                title = "Select file")
+        self.filepaths = list(askopenfilenames(initialdir = '', 
+                                               title = "Select file(s)"))
+        self.filepath = self.filepaths[0] if self.filepaths else None
         
         if self.filepath:
-            col2 = int(self.window_width / 3)
-
-            img = Image.open('img/green_check.png')
-            img = ImageTk.PhotoImage(img.resize((col2-100, col2-100), 
-                                                Image.ANTIALIAS))
+            self.set_status(self.label_status_1, True)
             
-            self.label_status_1.destroy()
-            self.label_status_1 = Label(self.background_frame,
-                                        image=img)
-            self.label_status_1.img = img
-            self.label_status_1.place(x=50, 
-                                  y=150, 
-                                  width=col2-100, 
-                                  height=col2-100)
+    def find_folder(self):
+        '''
+        Helper function for encryption_window.  Same as find_file, for a 
+        folder that is encrypted into a single archive.
+        
+        Attributes
+        ----------
+        filepath : string 
+           This is the path to the folder that will be encrypted.
+        
+        Returns
+        -------
+        None.
+        '''
+        filepath = askdirectory(initialdir = '', title = "Select folder")
+        
+        if filepath:
+            self.filepath = filepath
+            self.filepaths = [filepath]
+            self.set_status(self.label_status_1, True)
             
     def find_key(self):
         '''
         Helper function for encryption_ and decryption_window.  This function 
-        finds the .key file (Step 2) to be used.  If a file is selected, it 
-        changes the label_status_2 to a green check mark.
+        finds the .key file (Step 2) to be used, or the key in the keystore
+        chosen in the key manager.  If a key is selected, it changes the 
+        label_status_2 to a green check mark.
         
         Attributes
         ----------
         keypath : string 
-           This is the path to the key file
+           This is the path to the key file (STORE.pks:NAME for a keystore)
         label_status_2 : tkinter Label object
            The label for the status for step 2, i.e., select key file
            
@@ -570,25 +679,68 @@ class Application(object):
         None.
         '''
         
+        if isinstance(self.key_index, KeyStoreIndex):
+            self.pick_stored_key()
+            return
+        
         self.keypath = askopenfilename(filetypes=(("KEY File", ['.key']),),
                                 initialdir = self.key_dir, 
                                 title = "Select encrpytion key")
 
         if self.keypath:
-            col2 = int(self.window_width / 3)
-
-            img = Image.open('img/green_check.png')
-            img = ImageTk.PhotoImage(img.resize((col2-100, col2-100), 
-                                                Image.ANTIALIAS))
-            
-            self.label_status_2.destroy()
-            self.label_status_2 = Label(self.background_frame,
-                                        image=img)
-            self.label_status_2.img = img
-            self.label_status_2.place(x=col2+50, 
-                                  y=150, 
-                                  width=col2-100, 
-                                  height=col2-100)
+            self.set_status(self.label_status_2, True)
+    
+    def pick_stored_key(self):
+        '''
+        Helper function for find_key.  Lists the keys of the keystore in a
+        popup and picks the one selected.
+        
+        Returns
+        -------
+        None.
+        '''
+        names = self.stored_key_names()
+        if names is None:
+            return
+        
+        popup_window = tk.Toplevel()
+        popup_window.geometry("300x400") 
+        popup_window.wm_title("Select encryption key")
+        
+        pane = Listbox(popup_window)
+        pane.insert(tk.END, *names)
+        pane.place(x=10, y=10, width=280, height=320)
+        
+        def select():
+            ii = pane.curselection()
+            if not ii:
+                return
+            self.keypath = self.key_index.path(pane.get(ii))
+            self.set_status(self.label_status_2, True)
+            popup_window.destroy()
+        
+        button = Button(popup_window, text="Select", command=select)
+        button.place(x=49, y=340, width=100, height=50)
+        
+        button = Button(popup_window, text="Cancel", 
+                        command=popup_window.destroy)
+        button.place(x=151, y=340, width=100, height=50)
+    
+    def stored_key_names(self):
+        '''
+        The key names of key_index, or None (after telling the user) if
+        the keystore cannot be opened
+        
+        Returns
+        -------
+        list of strings
+        '''
+        try:
+            return self.key_index.names()
+        except (InvalidToken, AuthenticationFailed):
+            self.one_button_popup("Invalid Keystore",
+                                  "Not a keystore, or a wrapped one.")
+            return None
     
     def decryption_window(self):
         '''
@@ -596,16 +748,12 @@ class Application(object):
 
         Attributes
         ----------
-        window_height : int 
-           Pixel height of base application 
-        window_width : int 
-           Pixel width of base application 
         filepath : string
             The location of the file to be decrypted
+        filepaths : list of strings
+            Every file picked in step 1 (more than one runs as a batch)
         keyfile : string
             The location of the decryption key to be used
-        background_frame : Tkinter Frame object
-           The space to draw the app content 
         label_status_1 : tkinter Label object
             The label for the status for step 1, i.e., select file to decrypt
         label_status_2 : tkinter Label object
@@ -614,12 +762,26 @@ class Application(object):
         Returns
         -------
         None.
-        '''        
-        self.window_height = 400
-        self.window_width = 801
+        '''
+        self.show_screen('decrypt', self.build_decryption, 801, 400)
+        self.draw_menu()
+        
         self.filepath = None
+        self.filepaths = []
         self.keyfile = None
+        self.label_status_1, self.label_status_2 = \
+            self.status_labels['decrypt']
+        self.set_status(self.label_status_1, False)
+        self.set_status(self.label_status_2, False)
+
+    def build_decryption(self, frame):
+        '''
+        Builds the decryption screen (see decryption_window) in frame
         
+        Returns
+        -------
+        None.
+        '''
         col2 = int(self.window_width / 3)
         col3 = col2 * 2
         
@@ -627,52 +789,32 @@ class Application(object):
         row2 = 100
         row3 = 150
         
-        if hasattr(self, 'background_frame'):
-            self.background_frame.destroy()  
-        if hasattr(self, 'popup_window'):
-            self.popup_window.destroy()            
-        self.draw_menu()
-        
-        self.window.geometry("%dx%d" % (self.window_width, 
-                                        self.window_height))
-        
-        self.background_frame = Frame(self.window, 
-                                 width=self.window_width,
-                                 height=self.window_height)
-        self.background_frame.pack()
-        
-        label1 = Label(self.background_frame,
-                       text='Step 1: Select file to decrypt', 
+        label1 = Label(frame,
+                       text='Step 1: Select file(s) to decrypt', 
                       font=('Helvetica', 12,'bold'))
         label1.place(x=25, y=row1, width=col2 - 50)
 
-        browse_button = Button(self.background_frame, 
-                                text='Browse for file',
+        browse_button = Button(frame, 
+                                text='Browse for file(s)',
                                 command=self.find_cmf_file)
         
-        img = Image.open('img/red_x.png')
-        img = ImageTk.PhotoImage(img.resize((col2-100, col2-100), 
-                                            Image.ANTIALIAS))
-
-        self.label_status_1 = Label(self.background_frame,
-                                    image=img)
-        self.label_status_1.image = img
-        self.label_status_1.place(x=50, 
-                                  y=row3, 
-                                  width=col2-100, 
-                                  height=col2-100)
+        status_1 = Label(frame)
+        status_1.place(x=50, 
+                       y=row3,
+                       width=col2-100,
+                       height=col2-100)
 
         browse_button.place(x=25, 
                             y=row2, 
                             width=col2 - 50,
                             height=30)
 
-        label2 = Label(self.background_frame,
+        label2 = Label(frame,
                        text='Step 2: Select encryption key', 
                       font=('Helvetica', 12,'bold'))
         label2.place(x=col2 + 20, y=row1, width=col2 - 40)
         
-        browse_button = Button(self.background_frame, 
+        browse_button = Button(frame, 
                                 text='Browse for key',
                                 command=self.find_key)
         
@@ -681,20 +823,19 @@ class Application(object):
                             width=col2 - 50,
                             height=30)
 
-        self.label_status_2 = Label(self.background_frame,
-                                    image=img)
-        self.label_status_2.image = img
-        self.label_status_2.place(x=col2+50, 
-                                  y=row3, 
-                                  width=col2-100, 
-                                  height=col2-100)
+        status_2 = Label(frame)
+        status_2.place(x=col2+50, 
+                       y=row3,
+                       width=col2-100,
+                       height=col2-100)
+        self.status_labels['decrypt'] = (status_1, status_2)
         
-        label3 = Label(self.background_frame,
+        label3 = Label(frame,
                        text='Step 3: Decrypt File', 
                       font=('Helvetica', 12,'bold'))
         label3.place(x=col3+25, y=row1, width=col2 - 50)
         
-        button = Button(self.background_frame, 
+        button = Button(frame, 
                                 text='Decrypt',
                                 command=self.decrypt)
         
@@ -703,7 +844,7 @@ class Application(object):
                     width=col2 - 50,
                     height=30)
         
-        button = Button(self.background_frame,
+        button = Button(frame,
                              text='<<< Back to Main Menu',
                              command=self.draw_main)
         
@@ -711,19 +852,23 @@ class Application(object):
         
     def decrypt(self):
         '''
-        Helper function for decryption_window.  This function uses AESCipher.py
-        to decrypt the file.
+        Helper function for decryption_window.  This function uses AESCipher
+        to decrypt the file on a background thread (see run_job).  Several
+        files are decrypted as a batch (see decrypt_batch).
         
         Attributes
         ----------
         popup_window : tkinter TopLevel object 
-           This popup window is the prompt once decryption is complete
+           The prompt shown once decryption is complete
            
         Returns
         -------
         None.              
         '''
-        if self.filepath and self.keypath:
+        if self.filepath and self.keypath and len(self.filepaths) > 1:
+            self.decrypt_batch()
+        
+        elif self.filepath and self.keypath:
             
             savepath = asksaveasfilename(initialdir = '', 
                                              title = "Save decrypted file")
@@ -732,76 +877,94 @@ class Application(object):
                 return
             
             cipher = AESCipher()
+            key = load_key_spec(self.keypath)
             
-            with open(self.keypath, "r") as f:
-                key = f.read()
-            
-            key = binascii.unhexlify(key)
-            
-            with open(self.filepath, "rb") as f:
-                msg = f.read()
-                signing_key = msg[:16]
-                ciphertext = msg[16:]
-                                 
-            try:
-                ciphertext, iv = cipher.authenticate(ciphertext, signing_key)
-            except TTLError:
-                self.one_button_popup("TTL Failure",
-                            "The message's time-to-live (TTL) has expired.")
-                return
-            except AuthenticationFailed:
-                self.one_button_popup("Authentication Failed",
-                                      "Message Authentication has Failed")                
-                return
-            
-            try:
-                deciphertext = cipher.decrypt(ciphertext, key, iv)
-            except DecryptionFailed:
-                self.one_button_popup("Decryption Failed",
-                                      "Message Decryption has Failed")                
-                return                
-            except UnpaddingError:
-                self.one_button_popup("Unpadding Failed",
-                            "Message unpadding after decryption has failed.")                
-                return              
-            
-            file_ext = self.filepath.split('_')[-1].split('.')[0].lower()
-            with open(savepath + '.' + file_ext, 'wb') as f:
-                f.write(deciphertext)
-            
-            self.popup_window = tk.Toplevel()
-            self.popup_window.geometry("300x100") 
-            self.popup_window.wm_title("Decryption Successful")
-            
-            # Background of the popup window
-            bkgd_frame = Frame(self.popup_window, width=300, height=100)
-            bkgd_frame.pack()
+            filepath = self.filepath
+            file_ext = filepath.split('_')[-1].split('.')[0].lower()
+            total = os.path.getsize(filepath)
             
-            # Label that displays the prompt
-            prompt_txt = "Decryption successful.  Decrypt another file?"
-            prompt = Label(bkgd_frame, text=prompt_txt)
-            prompt.place(x=25, y=20, width=250)
+            if file_ext == 'tar':
+                # Folder archives are unpacked into savepath; progress is 
+                # counted on the archive as it is read
+                def work(job):
+                    with job.output_dir(savepath):
+                        decrypt_tree(filepath, savepath, key, 
+                                     cipher=_ProgressCipher(cipher, job))
+            else:
+                try:
+                    # The plaintext size, if the header records it
+                    total = cipher.stat_file(filepath, key)['size'] or total
+                except (AuthenticationFailed, InvalidToken, OSError):
+                    pass
+                
+                def work(job):
+                    with job.output(savepath + '.' + file_ext) as fout:
+                        cipher.decrypt_file(filepath, fout, key)
             
-            # Buttons to save and quit, just quit, and cancel the "quit" 
-            # command
-            button = Button(bkgd_frame, text="Yes", 
-                               command=self.encryption_window)
-            button.place(x=49, y=50, width=100, height=30 )        
+            self.run_job("Decrypting", work, total, 
+                         lambda: self.success_popup("Decryption Successful",
+                             "Decryption successful.  Decrypt another file?",
+                             self.decryption_window))
+
+    def decrypt_batch(self):
+        '''
+        Helper function for decrypt.  Asks once for a folder and decrypts 
+        every file picked into it (as plain_name would name them; folder 
+        archives are unpacked into it) through the job queue (see 
+        run_batch).  Files whose output exists already fail instead of 
+        being overwritten.
+        
+        Returns
+        -------
+        None.
+        '''
+        outdir = askdirectory(initialdir = '', 
+                              title = "Save decrypted files in")
+        if not outdir:
+            return
+        
+        cipher = AESCipher()
+        key = load_key_spec(self.keypath)
+        # Share the cores between files running at the same time
+        workers = max(1, (os.cpu_count() or 1) // BATCH_WORKERS)
+        
+        def task(filepath):
+            savepath = os.path.join(outdir, 
+                                    plain_name(os.path.basename(filepath)))
             
-            button = Button(bkgd_frame, text="No", 
-                                   command=self.draw_main)
-            button.place(x=151, y=50, width=100, height=30)    
+            # The .cmf file read is counted; its size is known up front
+            if savepath.lower().endswith('.tar'):
+                def work(job):
+                    if os.path.exists(savepath[:-4]):
+                        raise FileExistsError('%s exists' % savepath[:-4])
+                    with job.output_dir(savepath[:-4]):
+                        decrypt_tree(filepath, outdir, key, workers=workers,
+                                     cipher=_ProgressCipher(cipher, job))
+            else:
+                def work(job):
+                    if os.path.exists(savepath):
+                        raise FileExistsError('%s exists' % savepath)
+                    with job.output(savepath, counted=False) as fout:
+                        cipher.decrypt_file(filepath, fout, key, 
+                                            workers=workers, 
+                                            progress=job.advance)
+            return work, os.path.getsize(filepath)
+        
+        self.run_batch("Decrypting %d files" % len(self.filepaths),
+                       self.filepaths, [task(path) for path in self.filepaths])
 
     def find_cmf_file(self):
         '''
-        Helper function for decryption_menu.  This function finds the .cmf file 
-        (Step 1) to be decrypted.  If a file is selected, it changes the 
-        label_status_1 to a green check mark.
+        Helper function for decryption_menu.  This function finds the .cmf 
+        file(s) (Step 1) to be decrypted.  If a file is selected, it changes
+        the label_status_1 to a green check mark.
         
         Attributes
         ----------
         filepath : string 
-           This is the path to the file that will be decrypted.
+           This is the path to the (first) file that will be decrypted.
+        filepaths : list of strings
+           Every file that will be decrypted
         label_status_1 : tkinter Label object
            The label for the status for step 1, i.e., select file to decrypt
            
@@ -809,38 +972,22 @@ class Application(object):
         -------
         None.
         '''
-        self.filepath = askopenfilename(filetypes=(("CMF File", ['.cmf']),),
-                                        initialdir = '', 
-                                title = "Select file")
+        self.filepaths = list(askopenfilenames(
+                                    filetypes=(("CMF File", ['.cmf']),),
+                                    initialdir = '', 
+                                    title = "Select file(s)"))
+        self.filepath = self.filepaths[0] if self.filepaths else None
         
         if self.filepath:
-            col2 = int(self.window_width / 3)
-
-            img = Image.open('img/green_check.png')
-            img = ImageTk.PhotoImage(img.resize((col2-100, col2-100), 
-                                                Image.ANTIALIAS))
-            
-            self.label_status_1.destroy()
-            self.label_status_1 = Label(self.background_frame,
-                                        image=img)
-            self.label_status_1.img = img
-            self.label_status_1.place(x=50, 
-                                  y=150, 
-                                  width=col2-100, 
-                                  height=col2-100)
+            self.set_status(self.label_status_1, True)
      
     def key_manager_window(self):
         '''
-        Opens the key management window in the application
+        Opens the key management window in the application, listing the 
+        keys in key_dir (a directory or a keystore) afresh
 
         Attributes
         ----------
-        window_height : int 
-           Pixel height of base application 
-        window_width : int 
-           Pixel width of base application 
-        background_frame : Tkinter Frame object
-           The space to draw the app content
         left_pane : tkinter Frame object
            The frame that shows the list of keys in the directory of choice
         key_var : tkinter StringVar object
@@ -850,81 +997,99 @@ class Application(object):
         -------
         None.
         '''
-        self.window_height = 600
-        self.window_width = 1000
-        self.window.geometry("%dx%d" % (self.window_width, 
-                                        self.window_height))
-        
-        if hasattr(self, 'popup_window'):
-            self.popup_window.destroy()
-        if hasattr(self, 'background_frame'):
-            self.background_frame.destroy()        
+        self.show_screen('keys', self.build_key_manager, 1000, 600)
         self.draw_menu()
         
-        self.background_frame = Frame(self.window, 
-                                 width=self.window_width,
-                                 height=self.window_height)
-        self.background_frame.pack()
+        self.key_path_var.set(self.key_dir)
+        self.key_var.set('')
         
+        # The list is only filled again if the directory has changed
+        self.key_index = open_key_index(self.key_dir, self.key_index)
+        if isinstance(self.key_index, KeyStoreIndex):
+            self.import_button.config(text='Import Key Directory')
+        else:
+            self.import_button.config(text='Copy Keys to Keystore')
+        names = self.stored_key_names()
+        if names is None:
+            names = []
+        if self.listed_keys != (self.key_index.key_dir, 
+                                self.key_index.generation):
+            self.left_pane.delete(0, tk.END)
+            self.left_pane.insert(tk.END, *names)
+            self.listed_keys = (self.key_index.key_dir, 
+                                self.key_index.generation)
+
+    def build_key_manager(self, frame):
+        '''
+        Builds the key manager screen (see key_manager_window) in frame
         
-        label = Label(self.background_frame,
+        Returns
+        -------
+        None.
+        '''
+        label = Label(frame,
                       text='Key Directory: ')
         label.place(x=0, y=0, width=100, height=30)
         
         self.key_path_var = StringVar()
-        path_pane = Entry(self.background_frame, 
+        path_pane = Entry(frame, 
                           textvariable=self.key_path_var)
-        self.key_path_var.set(self.key_dir)
         path_pane.bind('<Return>', self.update_key_dir)
-        path_pane.place(x=100, y=0, width=self.window_width-250, height=30)
+        path_pane.place(x=100, y=0, width=self.window_width-400, height=30)
         
-        button = Button(self.background_frame,
+        button = Button(frame,
                         text='Browse Working Directory',
                         command=self.change_key_dir)
+        button.place(x=self.window_width-300, y=0, width=150, height=30)
+        
+        button = Button(frame,
+                        text='Open Keystore',
+                        command=self.open_keystore)
         button.place(x=self.window_width-150, y=0, width=150, height=30)
         
-        self.left_pane = Listbox(self.background_frame)
+        self.left_pane = Listbox(frame)
         self.left_pane.bind('<<ListboxSelect>>', self.select_key)
+        self.listed_keys = None
         
         self.left_pane.place(x=0, y=31, 
                         width=300, 
                         height=self.window_height)
-
-
-        for i, key_file in enumerate(glob.glob(self.key_dir + '\\*.key')):
-            self.left_pane.insert(i, key_file.split('\\')[-1][:-4])
         
         scrollbar = Scrollbar(self.left_pane)
         scrollbar.pack(side = tk.RIGHT, fill = tk.BOTH)
         self.left_pane.config(yscrollcommand = scrollbar.set)
         scrollbar.config(command = self.left_pane.yview)
         
-        label = Label(self.background_frame, 
+        label = Label(frame, 
                       text='Encryption Key:', 
                       font=('Helvetica', 12,'bold')
                       )
         label.place(x=355, y=50, width=460, height=30)
         
         self.key_var = StringVar()
-        key_entry = Entry(self.background_frame, textvariable=self.key_var)
+        key_entry = Entry(frame, textvariable=self.key_var)
         key_entry.place(x= 355, y=81, width=460, height=30)         
                     
-        button = Button(self.background_frame, 
+        button = Button(frame, 
                         text='Generate Random Key',
                         command=self.generate_key)
         button.place(x=355, y=120, width=150, height=50)
         
-        button = Button(self.background_frame, 
+        button = Button(frame, 
                         text='Save Key',
                         command=self.add_key)
         button.place(x=510, y=120, width=150, height=50)        
 
-        button = Button(self.background_frame, 
+        button = Button(frame, 
                         text='Delete Key',
                         command=self.delete_key_prompt)
         button.place(x=665, y=120, width=150, height=50) 
+        
+        # Its text is set by key_manager_window
+        self.import_button = Button(frame, command=self.import_keys)
+        self.import_button.place(x=355, y=175, width=460, height=50)
 
-        button = Button(self.background_frame,
+        button = Button(frame,
                              text='<<< Back to Main Menu',
                              command=self.draw_main)
         button.place(x=575, y=540, width=150, height=50)
@@ -952,10 +1117,7 @@ class Application(object):
         ii = self.left_pane.curselection()
         filename = self.left_pane.get(ii)
         
-        with open(self.key_dir + '\\%s.key' % filename, 'rb') as f:
-            key = f.read()
-            
-        self.key_var.set(key.decode('utf-8'))
+        self.key_var.set(self.key_index.read(filename))
 
     def delete_key_prompt(self):
         '''
@@ -1009,7 +1171,7 @@ class Application(object):
         ii = self.left_pane.curselection()
         filename = self.left_pane.get(ii)
 
-        os.remove(self.key_dir + '\\%s.key' % filename)
+        self.key_index.remove(filename)
         self.popup_window.destroy()
         self.key_manager_window()
         
@@ -1017,7 +1179,7 @@ class Application(object):
     def add_key(self):
         '''
         Helper function for key_manager_window.  This creates a new .key file
-        for the key typed or generated in the Entry box.
+        (or keystore entry) for the key typed or generated in the Entry box.
         
         Attributes
         ----------
@@ -1030,6 +1192,19 @@ class Application(object):
         '''
         
         self.new_key = self.key_var.get()
+        
+        if isinstance(self.key_index, KeyStoreIndex):
+            name = askstring("Save key", "Key name:")
+            if not name:
+                return
+            try:
+                self.key_index.add(name, self.new_key)
+            except (ValueError, InvalidToken, AuthenticationFailed) as e:
+                self.one_button_popup("Key Not Saved", str(e) or 
+                                      "The keystore cannot be opened.")
+                return
+            self.key_manager_window()
+            return
 
         savepath = asksaveasfilename(filetypes=(("KEY File", ['.key']),),
                                              initialdir = '', 
@@ -1038,11 +1213,335 @@ class Application(object):
         if not savepath:
             return
 
-        with open(savepath + '.key' , "w") as f:
-            f.write(self.new_key)
+        keys.save_key(savepath + '.key', self.new_key)
             
         self.key_manager_window()
             
+    def run_job(self, title, work, total, on_done):
+        '''
+        Runs work on a background thread (see pierceslock/jobs.py) while a
+        popup shows its progress.  The main window stays responsive; the 
+        popup polls the job's queue with window.after.
+        
+        Parameters
+        ----------
+        title : string
+            The title of the progress popup
+        work : callable
+            work(job) does the job, writing through job.output
+        total : int
+            The number of bytes expected
+        on_done : callable
+            Called once the job has finished successfully
+        
+        Returns
+        -------
+        None.
+        '''
+        job = Job(work, total).start()
+        
+        # Not kept in popup_window, which show_screen closes: the progress
+        # popup stays, with its Cancel button, until the job has finished
+        popup_window = tk.Toplevel()
+        popup_window.geometry("300x120") 
+        popup_window.wm_title(title)
+        popup_window.protocol("WM_DELETE_WINDOW", job.cancel)
+        
+        bkgd_frame = Frame(popup_window, width=300, height=120)
+        bkgd_frame.pack()
+        
+        bar = Progressbar(bkgd_frame, maximum=max(total, 1))
+        bar.place(x=25, y=15, width=250, height=20)
+        
+        status = Label(bkgd_frame, text='Starting...')
+        status.place(x=25, y=45, width=250)
+        
+        button = Button(bkgd_frame, text="Cancel", command=job.cancel)
+        button.place(x=100, y=80, width=100, height=30)
+        
+        def poll():
+            try:
+                while True:
+                    event = job.events.get_nowait()
+                    if event[0] == 'progress':
+                        _, done, total_bytes, rate = event
+                        bar['value'] = min(done, total_bytes)
+                        status['text'] = '%.1f of %.1f MB, %.1f MB/s' % (
+                            done / 1e6, total_bytes / 1e6, rate / 1e6)
+                        continue
+                    
+                    popup_window.destroy()
+                    if event[0] == 'done':
+                        on_done()
+                    elif event[0] == 'cancelled':
+                        self.one_button_popup("Cancelled", 
+                            "Cancelled.  The partial output was removed.")
+                    else:
+                        self.job_failed(event[1])
+                    return
+            except queue.Empty:
+                pass
+            self.window.after(100, poll)
+        
+        self.window.after(100, poll)
+    
+    def run_batch(self, title, paths, items):
+        '''
+        Runs a queue of jobs on a bounded pool of threads (see Batch in 
+        pierceslock/jobs.py) and shows it in the window: one row per file 
+        with its status, the overall progress with the time left at the 
+        measured throughput, and a summary at the end.  Failures are listed
+        in their row instead of in a popup, so a long batch runs unattended.
+        It keeps running while other screens are shown (Tools > Job Queue
+        goes back to it) and stops only when the user cancels it.  One 
+        batch runs at a time.
+        
+        Parameters
+        ----------
+        title : string
+            The heading of the queue view
+        paths : list of strings
+            The input file of each job, as shown in the queue
+        items : list of tuples
+            (work, total) of each job, see run_job
+        
+        Attributes
+        ----------
+        batch : Batch object
+           The batch shown in the queue view
+        
+        Returns
+        -------
+        None.
+        '''
+        self.show_screen('queue', self.build_queue, 801, 400)
+        self.draw_menu()
+        
+        if self.batch is not None and self.batch.thread.is_alive():
+            self.one_button_popup("Batch Running", 
+                                  "Wait for the queued files to finish, or "
+                                  "cancel them, before queuing more.")
+            return
+        
+        batch = self.batch = Batch(items).start()
+        names = [os.path.basename(path) for path in paths]
+        
+        queue_pane, bar, status, button = (self.queue_pane, self.queue_bar, 
+                                           self.queue_status, 
+                                           self.queue_button)
+        self.queue_title['text'] = title
+        queue_pane.delete(0, tk.END)
+        for i, name in enumerate(names):
+            queue_pane.insert(i, 'Queued      ' + name)
+        bar.config(maximum=max(batch.total, 1), value=0)
+        status['text'] = 'Starting...'
+        button.config(text="Cancel", command=self.cancel_batch_prompt)
+        
+        # The queue view is kept when other screens are shown, so it is 
+        # updated whether or not it is on screen
+        def poll():
+            try:
+                while True:
+                    event = batch.events.get_nowait()
+                    if event[0] == 'status':
+                        _, i, state, detail = event
+                        row = '%-12s%s' % (state.capitalize(), names[i])
+                        if state == 'failed':
+                            row += ' - ' + self.describe_error(detail)[1]
+                        queue_pane.delete(i)
+                        queue_pane.insert(i, row)
+                        if state == 'failed':
+                            queue_pane.itemconfig(i, foreground='red')
+                        elif state == 'running':
+                            queue_pane.see(i)
+                    elif event[0] == 'progress':
+                        _, done, total_bytes, rate, eta = event
+                        bar['value'] = min(done, total_bytes)
+                        left = ('%d:%02d left' % divmod(int(eta), 60) 
+                                if eta is not None else 'estimating...')
+                        status['text'] = '%.1f of %.1f MB, %.1f MB/s, %s' % (
+                            done / 1e6, total_bytes / 1e6, rate / 1e6, left)
+                    else:
+                        _, done, failed, cancelled, seconds = event
+                        status['text'] = ('%d done, %d failed, %d cancelled'
+                                          ' in %.1f s' % (done, failed, 
+                                                          cancelled, seconds))
+                        button.config(text='<<< Back to Main Menu',
+                                      command=self.draw_main)
+                        return
+            except queue.Empty:
+                pass
+            self.window.after(100, poll)
+        
+        self.window.after(100, poll)
+    
+    def queue_window(self):
+        '''
+        Shows the queue view of the last batch, running or finished
+        
+        Returns
+        -------
+        None.
+        '''
+        if self.batch is None:
+            self.one_button_popup("Job Queue", "No files have been queued.")
+            return
+        self.show_screen('queue', self.build_queue, 801, 400)
+        self.draw_menu()
+    
+    def cancel_batch_prompt(self):
+        '''
+        Asks before cancelling the running batch
+        
+        Returns
+        -------
+        None.
+        '''
+        popup_window = tk.Toplevel()
+        popup_window.geometry("300x100") 
+        popup_window.wm_title("Cancel?")
+        
+        bkgd_frame = Frame(popup_window, width=300, height=100)
+        bkgd_frame.pack()
+        
+        prompt = Label(bkgd_frame, text="Cancel the files not done yet?")
+        prompt.place(x=25, y=20, width=250)
+        
+        def cancel():
+            self.batch.cancel()
+            popup_window.destroy()
+        
+        button1 = Button(bkgd_frame, text="Yes", command=cancel)
+        button1.place(x=49, y=50, width=100, height=30)
+        
+        button2 = Button(bkgd_frame, text="No", 
+                         command=popup_window.destroy)
+        button2.place(x=151, y=50, width=100, height=30)
+    
+    def build_queue(self, frame):
+        '''
+        Builds the queue view (see run_batch) in frame
+        
+        Attributes
+        ----------
+        queue_pane : tkinter Listbox object
+            One row per file with its status
+        queue_bar : tkinter Progressbar object
+            The progress of the whole batch
+        queue_status : tkinter Label object
+            Throughput and time left, then the summary
+        
+        Returns
+        -------
+        None.
+        '''
+        self.queue_title = Label(frame, font=('Helvetica', 12,'bold'))
+        self.queue_title.place(x=25, y=10, width=self.window_width - 50)
+        
+        self.queue_pane = Listbox(frame)
+        self.queue_pane.place(x=25, y=40, width=self.window_width - 50, 
+                              height=230)
+        
+        scrollbar = Scrollbar(self.queue_pane)
+        scrollbar.pack(side = tk.RIGHT, fill = tk.BOTH)
+        self.queue_pane.config(yscrollcommand = scrollbar.set)
+        scrollbar.config(command = self.queue_pane.yview)
+        
+        self.queue_bar = Progressbar(frame)
+        self.queue_bar.place(x=25, y=285, width=self.window_width - 50, 
+                             height=20)
+        
+        self.queue_status = Label(frame)
+        self.queue_status.place(x=25, y=315, width=self.window_width - 50)
+        
+        self.queue_button = Button(frame)
+        self.queue_button.place(x=5, y=self.window_height - 35, width=150, 
+                                height=30)
+    
+    def describe_error(self, error):
+        '''
+        A title and a message telling the user why a job failed
+        
+        Parameters
+        ----------
+        error : Exception
+            The exception raised by the job
+        
+        Returns
+        -------
+        tuple of strings
+            (title, message)
+        '''
+        if isinstance(error, TTLError):
+            return ("TTL Failure",
+                    "The message's time-to-live (TTL) has expired.")
+        elif isinstance(error, (AuthenticationFailed, InvalidToken, 
+                                NotAnArchive)):
+            return ("Authentication Failed",
+                    "Message Authentication has Failed")
+        elif isinstance(error, DecryptionFailed):
+            return ("Decryption Failed", "Message Decryption has Failed")
+        elif isinstance(error, UnpaddingError):
+            return ("Unpadding Failed",
+                    "Message unpadding after decryption has failed.")
+        return ("Failed", str(error))
+    
+    def job_failed(self, error):
+        '''
+        Tells the user why a background job failed
+        
+        Parameters
+        ----------
+        error : Exception
+            The exception raised by the job
+        
+        Returns
+        -------
+        None.
+        '''
+        self.one_button_popup(*self.describe_error(error))
+    
+    def success_popup(self, title, prompt_txt, again):
+        '''
+        The popup shown when a job is complete, offering to run another one
+        
+        Parameters
+        ----------
+        title : string
+            The title bar message
+        prompt_txt : string
+            The question shown
+        again : callable
+            Called when the user picks "Yes"
+        
+        Attributes
+        ----------
+        popup_window : tkinter TopLevel object 
+           The popup
+        
+        Returns
+        -------
+        None.
+        '''
+        self.popup_window = tk.Toplevel()
+        self.popup_window.geometry("300x100") 
+        self.popup_window.wm_title(title)
+        
+        # Background of the popup window
+        bkgd_frame = Frame(self.popup_window, width=300, height=100)
+        bkgd_frame.pack()
+        
+        # Label that displays the prompt
+        prompt = Label(bkgd_frame, text=prompt_txt)
+        prompt.place(x=25, y=20, width=250)
+        
+        # Buttons to run another job or go back to the main menu
+        button = Button(bkgd_frame, text="Yes", command=again)
+        button.place(x=49, y=50, width=100, height=30 )        
+        
+        button = Button(bkgd_frame, text="No", command=self.draw_main)
+        button.place(x=151, y=50, width=100, height=30)
+
     def one_button_popup(self, title, msg):
         '''
         Display a message pop-up with a close button
@@ -1085,15 +1584,15 @@ class Application(object):
         
         Attributes
         ----------
-        new_key : byte string 
-           The new random key being generated
+        new_key : string 
+           The new random key being generated (hex encoded)
         
         Returns
         -------
         None.
         '''
-        self.new_key = binascii.hexlify(os.urandom(32))
-        self.key_var.set(self.new_key.decode('utf-8'))
+        self.new_key = keys.generate_key()
+        self.key_var.set(self.new_key)
 
     def update_key_dir(self, event):
         '''
@@ -1142,6 +1641,87 @@ class Application(object):
             
             self.key_manager_window()            
 
+    def open_keystore(self):
+        '''
+        Helper function for key_manager_window.  This opens (or creates) a 
+        keystore to display in place of the key directory.
+        
+        Attributes
+        ----------
+        key_dir : string 
+           This is the path to the keystore.
+
+        Returns
+        -------
+        None.
+        '''
+        
+        path = asksaveasfilename(filetypes=(("Keystore", 
+                                             [KEYSTORE_SUFFIX]),),
+                                 initialdir = os.path.dirname(self.key_dir), 
+                                 title = "Open or create a keystore",
+                                 confirmoverwrite = False)
+        
+        if path:
+            if not path.lower().endswith(KEYSTORE_SUFFIX):
+                path += KEYSTORE_SUFFIX
+            self.key_dir = os.path.normpath(path)
+            
+            with open('.profile', 'w') as f:
+                f.write('key_dir '+self.key_dir)
+                
+            self.key_manager_window()
+
+    def import_keys(self):
+        '''
+        Helper function for key_manager_window.  When a keystore is shown, 
+        this copies the .key files of a directory into it.  When a key 
+        directory is shown, this copies its .key files into a keystore 
+        (new or existing) and shows that instead.  The .key files are left
+        where they are.
+
+        Returns
+        -------
+        None.
+        '''
+        
+        if isinstance(self.key_index, KeyStoreIndex):
+            key_dir = askdirectory(initialdir = os.path.dirname(self.key_dir),
+                                   title = "Import Key Directory")
+            store = self.key_index
+        else:
+            key_dir = self.key_dir
+            path = asksaveasfilename(filetypes=(("Keystore", 
+                                                 [KEYSTORE_SUFFIX]),),
+                                     initialdir = self.key_dir, 
+                                     title = "Copy keys to keystore",
+                                     confirmoverwrite = False)
+            if not path:
+                return
+            if not path.lower().endswith(KEYSTORE_SUFFIX):
+                path += KEYSTORE_SUFFIX
+            store = KeyStoreIndex(path)
+            
+        if not key_dir:
+            return
+        
+        try:
+            imported = store.import_dir(key_dir)
+        except (InvalidToken, AuthenticationFailed):
+            self.one_button_popup("Invalid Keystore",
+                                  "Not a keystore, or a wrapped one.")
+            return
+        
+        if store is not self.key_index:
+            self.key_dir = store.key_dir
+            with open('.profile', 'w') as f:
+                f.write('key_dir '+self.key_dir)
+            
+        self.key_manager_window()
+        self.one_button_popup("Keys Imported", 
+                              "%d key(s) copied into the keystore." % 
+                              len(imported))
+
     def change_key_dir(self):
         '''
         Helper function for key_manager_window.  This opens a browse window 
@@ -1161,7 +1741,7 @@ class Application(object):
                                     title = "Change Key Directory")
         
         if new_key_dir:
-            self.key_dir = new_key_dir.replace('/', '\\')
+            self.key_dir = os.path.normpath(new_key_dir)
             
             with open('.profile', 'w') as f:
                 f.write('key_dir '+self.key_dir)
@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+"""
+benchmark.py
+
+Description: Throughput benchmarks for the AESCipher file API.  Run
+             "python benchmark.py" and compare the MiB/s columns.
+
+"""
+
+import io, os, subprocess, sys, time, asyncio
+from pierceslock.cipher import AESCipher
+from pierceslock.container import ALGORITHMS, ALG_AES_GCM
+from pierceslock.compress import CODECS, available_codecs
+from pierceslock import aio
+
+def best_time(fn, repeat=3):
+    '''
+    Runs fn repeat times and returns the fastest wall-clock time in seconds
+    '''
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+def bench_algorithms(size=64 * 1024 * 1024):
+    '''
+    Encrypts and decrypts size random bytes in memory with every algorithm
+    and prints the throughput of each.
+    '''
+    cipher = AESCipher()
+    key = os.urandom(32)
+    data = os.urandom(size)
+    mb = size / 2**20
+
+    print('File encryption, %d MiB' % mb)
+    for algorithm, name in ALGORITHMS.items():
+        enc = io.BytesIO()
+
+        def encrypt():
+            enc.seek(0)
+            enc.truncate()
+            cipher.encrypt_file(io.BytesIO(data), enc, key,
+                                algorithm=algorithm)
+
+        def decrypt():
+            enc.seek(0)
+            cipher.decrypt_file(enc, io.BytesIO(), key)
+
+        def verify():
+            enc.seek(0)
+            cipher.verify_file(enc, key)
+
+        t_enc = best_time(encrypt)
+        t_dec = best_time(decrypt)
+        t_ver = best_time(verify)
+        print('  %-28s encrypt %8.1f MiB/s   decrypt %8.1f MiB/s   '
+              'verify %8.1f MiB/s' % 
+              (name, mb / t_enc, mb / t_dec, mb / t_ver))
+
+def bench_workers(size=256 * 1024 * 1024, algorithm=ALG_AES_GCM):
+    '''
+    Encrypts size random bytes with 1, 2, 4, ... worker threads up to the
+    number of CPUs and prints the throughput and speed-up of each.
+    '''
+    cipher = AESCipher()
+    key = os.urandom(32)
+    data = os.urandom(size)
+    mb = size / 2**20
+    
+    counts = [1]
+    while counts[-1] * 2 <= os.cpu_count():
+        counts.append(counts[-1] * 2)
+    
+    print('Segmented %s encryption, %d MiB' % (ALGORITHMS[algorithm], mb))
+    base = None
+    for workers in counts:
+        t = best_time(lambda: cipher.encrypt_file(io.BytesIO(data), 
+                                                  io.BytesIO(), key,
+                                                  algorithm=algorithm,
+                                                  workers=workers))
+        base = base or t
+        print('  %3d worker(s) %8.1f MiB/s   x%.2f' % (workers, mb / t, 
+                                                       base / t))
+
+def bench_compression(size=64 * 1024 * 1024):
+    '''
+    Encrypts size bytes of CSV-like text and of random bytes with every 
+    available codec and prints the throughput and the output size of each.
+    '''
+    cipher = AESCipher()
+    key = os.urandom(32)
+    line = b'%d,2021-06-18 12:00:00,INFO,worker-%d,request served in %d ms\n'
+    text = b''.join(line % (i, i % 16, i % 997) 
+                    for i in range(size // len(line)))[:size]
+    mb = size / 2**20
+    
+    print('Compression before encryption, %d MiB' % mb)
+    for label, data in [('text', text), ('random', os.urandom(size))]:
+        for codec in available_codecs():
+            enc = io.BytesIO()
+            
+            def encrypt():
+                enc.seek(0)
+                enc.truncate()
+                cipher.encrypt_file(io.BytesIO(data), enc, key,
+                                    compression=codec)
+            
+            t = best_time(encrypt)
+            print('  %-6s %-6s %8.1f MiB/s   %6.1f%% of the input' % 
+                  (label, CODECS[codec], mb / t, 
+                   100 * len(enc.getvalue()) / size))
+
+def bench_async(uploads=200, size=4 * 1024 * 1024):
+    '''
+    Encrypts uploads concurrent in-memory streams of size bytes on one event
+    loop, first with the blocking file API and then with aio.encrypt_stream,
+    and prints the throughput and the worst event loop stall of each.
+    '''
+    cipher = AESCipher()
+    key = os.urandom(32)
+    data = os.urandom(size)
+    mb = uploads * size / 2**20
+    
+    class Sink(object):
+        def write(self, data):
+            pass
+        async def drain(self):
+            pass
+    
+    async def blocking():
+        cipher.encrypt_file(io.BytesIO(data), io.BytesIO(), key, workers=1)
+    
+    async def streamed():
+        reader = asyncio.StreamReader()
+        reader.feed_data(data)
+        reader.feed_eof()
+        await aio.encrypt_stream(reader, Sink(), key, cipher=cipher)
+    
+    async def run(upload):
+        stalls = [0.0]
+        done = asyncio.Event()
+        
+        async def ticker():
+            while not done.is_set():
+                start = time.perf_counter()
+                await asyncio.sleep(0.001)
+                stalls.append(time.perf_counter() - start - 0.001)
+        
+        tick = asyncio.create_task(ticker())
+        await asyncio.sleep(0)
+        start = time.perf_counter()
+        await asyncio.gather(*[upload() for _ in range(uploads)])
+        elapsed = time.perf_counter() - start
+        done.set()
+        await tick
+        return elapsed, max(stalls)
+    
+    print('Concurrent uploads, %d x %d MiB' % (uploads, size / 2**20))
+    for label, upload in [('blocking encrypt_file', blocking),
+                          ('aio.encrypt_stream', streamed)]:
+        elapsed, stall = asyncio.run(run(upload))
+        print('  %-28s %8.1f MiB/s   worst loop stall %8.1f ms' % 
+              (label, mb / elapsed, 1e3 * stall))
+
+def bench_session(count=10000, size=200):
+    '''
+    Encrypts and decrypts count small messages one call at a time, then 
+    through a CipherSession, and prints the cost per message.
+    '''
+    cipher = AESCipher()
+    key = os.urandom(32)
+    signing_key = cipher.generate_key()
+    msgs = [os.urandom(size) for _ in range(count)]
+    
+    def one_shot():
+        for msg in msgs:
+            ciphertext, iv = cipher.encrypt(msg, key)
+            token, _ = cipher.encode_authentication(ciphertext, iv, 
+                                                    signing_key)
+            ciphertext, iv = cipher.authenticate(token, signing_key)
+            cipher.decrypt(ciphertext, key, iv)
+    
+    def batched():
+        session = cipher.session(key, signing_key)
+        session.decrypt_many(session.encrypt_many(msgs))
+    
+    print('Small messages, %d x %d bytes (encrypt + decrypt)' % (count, size))
+    t_before = best_time(one_shot)
+    t_after = best_time(batched)
+    print('  %-28s %8.2f us/message' % ('AESCipher calls', 
+                                         1e6 * t_before / count))
+    print('  %-28s %8.2f us/message   x%.2f' % ('CipherSession', 
+                                               1e6 * t_after / count,
+                                               t_before / t_after))
+
+def bench_import(modules=('pierceslock', 'pierceslock.cipher', 
+                          'pierceslock.vault', 'application')):
+    '''
+    Times a cold import of each module in a fresh interpreter and prints
+    whether it pulled in tkinter or PIL.
+    '''
+    code = ('import sys, time\n'
+            't = time.perf_counter()\n'
+            'import %s\n'
+            't = time.perf_counter() - t\n'
+            'gui = [m for m in ("tkinter", "PIL") if m in sys.modules]\n'
+            'print(t, ",".join(gui) or "-")\n')
+    print('Cold import time')
+    for module in modules:
+        try:
+            out = subprocess.check_output([sys.executable, '-c', 
+                                           code % module],
+                                          stderr=subprocess.DEVNULL)
+        except subprocess.CalledProcessError:
+            print('  %-28s failed to import' % module)
+            continue
+        seconds, gui = out.decode().split()
+        print('  %-28s %8.1f ms   GUI modules: %s' % 
+              (module, 1e3 * float(seconds), gui))
+
+if __name__ == "__main__":
+    bench_import()
+    bench_algorithms()
+    bench_workers()
+    bench_compression()
+    bench_async()
+    bench_session()
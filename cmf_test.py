@@ -0,0 +1,801 @@
+# -*- coding: utf-8 -*-
+"""
+cmf_test.py
+
+Description: Round-trip and tamper tests for the .cmf file API in the
+             pierceslock package
+
+"""
+
+from pierceslock.cipher import AESCipher, CMFReader
+from pierceslock.container import CMF_MAGIC, ALGORITHMS, ALG_AES_CBC_HMAC, \
+    ALG_AES_GCM, METADATA_HEADER_SIZE, cmf_name, key_fingerprint
+from pierceslock.compress import CODEC_NONE, DECOMPRESS_PIECE_SIZE, \
+    available_codecs, entropy
+from pierceslock.exceptions import AuthenticationFailed, InvalidToken, \
+    NotAnArchive, MemberNotFound, KeyNotFound
+from pierceslock.vault import read_vault, write_vault
+from pierceslock import aio
+from pierceslock.archive import encrypt_tree, decrypt_tree, list_archive, \
+    extract_member
+from pierceslock.keys import generate_key, save_key, KeyIndex
+from pierceslock.keystore import KeyStore, import_key_dir, RECORD_SIZE, \
+    KeyStoreIndex, load_key_spec, open_key_index
+from pierceslock.jobs import Job, Batch
+from pierceslock import cli
+import unittest, io, os, json, subprocess, sys, tempfile, asyncio
+from unittest import mock
+
+# Seconds allowed for a cold "import pierceslock.cipher" in a fresh process
+IMPORT_BUDGET = 0.5
+
+class CMF_Testing(unittest.TestCase):
+
+    def setUp(self):
+        self.cipher = AESCipher()
+        self.key = os.urandom(32)
+
+    def roundtrip(self, msg, chunk_size=4096, workers=None, **kwargs):
+        enc = io.BytesIO()
+        self.cipher.encrypt_file(io.BytesIO(msg), enc, self.key, 
+                                 chunk_size=chunk_size, workers=workers, 
+                                 **kwargs)
+        enc.seek(0)
+        dec = io.BytesIO()
+        self.cipher.decrypt_file(enc, dec, self.key, chunk_size=chunk_size,
+                                 workers=workers)
+        return dec.getvalue()
+
+    def test_roundtrip(self):
+        for algorithm in ALGORITHMS:
+            for n in [0, 1, 15, 16, 17, 1000, 4096, 8192, 100003]:
+                msg = os.urandom(n)
+                out = self.roundtrip(msg, chunk_size=4096, algorithm=algorithm)
+                self.assertEqual(out, msg)
+            # Chunks smaller than a cipher block
+            for chunk_size in [1, 8]:
+                msg = os.urandom(100)
+                out = self.roundtrip(msg, chunk_size=chunk_size, 
+                                     algorithm=algorithm)
+                self.assertEqual(out, msg)
+            with self.assertRaises(ValueError):
+                self.roundtrip(b'msg', chunk_size=0, algorithm=algorithm)
+
+    @mock.patch('pierceslock.cipher.SEGMENT_SIZE', 4000)
+    def test_parallel(self):
+        msg = os.urandom(300000)
+        for algorithm in ALGORITHMS:
+            out = self.roundtrip(msg, chunk_size=1000, algorithm=algorithm,
+                                 workers=4)
+            self.assertEqual(out, msg)
+
+    def test_roundtrip_paths(self):
+        # Regular files go through the mmap input path
+        with tempfile.TemporaryDirectory() as d:
+            src = os.path.join(d, 'in.bin')
+            enc = os.path.join(d, 'out_BIN.cmf')
+            dec = os.path.join(d, 'out.bin')
+            for algorithm in ALGORITHMS:
+                for n in [0, 1, 16, 4096, 70000]:
+                    msg = os.urandom(n)
+                    with open(src, 'wb') as f:
+                        f.write(msg)
+                    self.cipher.encrypt_file(src, enc, self.key, 
+                                             chunk_size=4096, 
+                                             algorithm=algorithm)
+                    self.cipher.decrypt_file(enc, dec, self.key)
+                    with open(dec, 'rb') as f:
+                        self.assertEqual(f.read(), msg)
+            
+            with open(enc, 'r+b') as f:
+                f.seek(-1, io.SEEK_END)
+                last = f.read(1)[0]
+                f.seek(-1, io.SEEK_END)
+                f.write(bytes([last ^ 0x01]))
+            with self.assertRaises(AuthenticationFailed):
+                self.cipher.decrypt_file(enc, dec, self.key)
+            self.assertFalse(os.path.exists(dec))
+
+    def test_container_layout(self):
+        enc = io.BytesIO()
+        self.cipher.encrypt_file(io.BytesIO(os.urandom(100)), enc, self.key,
+                                 algorithm=ALG_AES_CBC_HMAC)
+        data = enc.getvalue()
+        self.assertEqual(data[:len(CMF_MAGIC)], CMF_MAGIC)
+        self.assertEqual(len(data), len(CMF_MAGIC) + 1 + 8 + 16 + 112 + 32)
+        
+        enc = io.BytesIO()
+        self.cipher.encrypt_file(io.BytesIO(os.urandom(100)), enc, self.key,
+                                 chunk_size=64, algorithm=ALG_AES_GCM)
+        data = enc.getvalue()
+        self.assertEqual(data[:len(CMF_MAGIC)], CMF_MAGIC)
+        self.assertEqual(len(data), METADATA_HEADER_SIZE + 100 + 2 * 16)
+
+    def test_legacy_token(self):
+        msg = os.urandom(5000)
+        ciphertext, iv = self.cipher.encrypt(msg, self.key)
+        token, signing_key = self.cipher.encode_authentication(ciphertext, iv)
+        dec = io.BytesIO()
+        self.cipher.decrypt_file(io.BytesIO(signing_key + token), dec,
+                                 self.key, chunk_size=1000)
+        self.assertEqual(dec.getvalue(), msg)
+
+    def test_tamper(self):
+        enc = io.BytesIO()
+        self.cipher.encrypt_file(io.BytesIO(os.urandom(5000)), enc, self.key)
+        data = bytearray(enc.getvalue())
+        data[len(data) // 2] ^= 0x01
+        dec = io.BytesIO()
+        with self.assertRaises(AuthenticationFailed):
+            self.cipher.decrypt_file(io.BytesIO(bytes(data)), dec, self.key)
+        self.assertEqual(dec.getvalue(), b'')
+
+    def test_verify(self):
+        with tempfile.TemporaryDirectory() as d:
+            for algorithm in ALGORITHMS:
+                path = os.path.join(d, '%d_BIN.cmf' % algorithm)
+                self.cipher.encrypt_file(io.BytesIO(os.urandom(5000)), path,
+                                         self.key, chunk_size=1000, 
+                                         algorithm=algorithm)
+                self.cipher.verify_file(path, self.key)
+            with open(path, 'r+b') as f:
+                f.seek(-1, io.SEEK_END)
+                f.write(b'\x00')
+            with self.assertRaises(AuthenticationFailed):
+                self.cipher.verify_file(path, self.key)
+            
+            key_file = os.path.join(d, 'my.key')
+            save_key(key_file, self.key.hex())
+            out = io.StringIO()
+            args = cli.build_parser().parse_args(['verify', '--json', '-k', 
+                                                  key_file, d])
+            self.assertEqual(cli.run(args, out, io.StringIO()), 1)
+            report = [json.loads(line) for line in 
+                      out.getvalue().splitlines()]
+            self.assertEqual([r['ok'] for r in report], 
+                             [r['path'] != path for r in report])
+
+    def test_stat(self):
+        with tempfile.TemporaryDirectory() as d:
+            src = os.path.join(d, 'report.csv')
+            with open(src, 'wb') as f:
+                f.write(os.urandom(5000))
+            enc = os.path.join(d, 'report_CSV.cmf')
+            self.cipher.encrypt_file(src, enc, self.key)
+            
+            info = self.cipher.stat_file(enc, self.key)
+            self.assertEqual((info['name'], info['size'], info['verified']),
+                             ('report.csv', 5000, True))
+            self.assertEqual(info['algorithm'], ALG_AES_GCM)
+            # The name and size are sealed
+            info = self.cipher.stat_file(enc)
+            self.assertEqual((info['name'], info['size']), (None, None))
+            with self.assertRaises(AuthenticationFailed):
+                self.cipher.stat_file(enc, os.urandom(32))
+            
+            # Tampering with the metadata is caught by decrypt as well
+            with open(enc, 'r+b') as f:
+                f.seek(METADATA_HEADER_SIZE - 20)
+                f.write(b'\x00')
+            with self.assertRaises(AuthenticationFailed):
+                self.cipher.stat_file(enc, self.key)
+            with self.assertRaises(AuthenticationFailed):
+                self.cipher.decrypt_file(enc, io.BytesIO(), self.key)
+        
+        # Input of unknown length
+        enc = io.BytesIO()
+        pipe = io.BytesIO(b'data')
+        pipe.seekable = lambda: False
+        self.cipher.encrypt_file(pipe, enc, self.key, name='dump.sql')
+        enc.seek(0)
+        info = self.cipher.stat_file(enc, self.key)
+        self.assertEqual((info['name'], info['size']), ('dump.sql', None))
+
+    def test_decrypt_chunks(self):
+        msg = os.urandom(20000)
+        for algorithm in ALGORITHMS:
+            enc = io.BytesIO()
+            self.cipher.encrypt_file(io.BytesIO(msg), enc, self.key,
+                                     chunk_size=1000, algorithm=algorithm)
+            data = bytearray(enc.getvalue())
+            self.assertEqual(b''.join(self.cipher.decrypt_chunks(
+                                 io.BytesIO(bytes(data)), self.key)), msg)
+            
+            # Damage the end: AEAD plaintext before it is released early
+            data[-20] ^= 0x01
+            received = []
+            with self.assertRaises(AuthenticationFailed), \
+                    mock.patch('pierceslock.cipher.SEGMENT_SIZE', 1000):
+                for piece in self.cipher.decrypt_chunks(
+                        io.BytesIO(bytes(data)), self.key, workers=1):
+                    received.append(piece)
+            received = b''.join(received)
+            self.assertEqual(received, msg[:len(received)])
+            if algorithm != ALG_AES_CBC_HMAC:
+                self.assertEqual(len(received), 19000)
+            else:
+                self.assertEqual(received, b'')
+
+    def test_truncated_at_chunk_boundary(self):
+        enc = io.BytesIO()
+        self.cipher.encrypt_file(io.BytesIO(os.urandom(300)), enc, self.key,
+                                 chunk_size=100)
+        data = enc.getvalue()[:METADATA_HEADER_SIZE + 2 * 116]
+        with self.assertRaises(AuthenticationFailed):
+            self.cipher.decrypt_file(io.BytesIO(data), io.BytesIO(), self.key)
+
+    def test_random_access(self):
+        msg = os.urandom(10000)
+        enc = io.BytesIO()
+        self.cipher.encrypt_file(io.BytesIO(msg), enc, self.key, 
+                                 chunk_size=512)
+        enc.seek(0)
+        reader = CMFReader(enc, self.key)
+        self.assertEqual(reader.size, len(msg))
+        for offset, n in [(0, 10), (511, 2), (9990, 100), (3000, 2000)]:
+            reader.seek(offset)
+            self.assertEqual(reader.read(n), msg[offset:offset+n])
+        reader.seek(-5, io.SEEK_END)
+        self.assertEqual(reader.read(), msg[-5:])
+        
+        # Damage chunk 2: the other chunks are still readable
+        data = bytearray(enc.getvalue())
+        data[METADATA_HEADER_SIZE + 2 * 528 + 7] ^= 0x01
+        reader = CMFReader(io.BytesIO(bytes(data)), self.key)
+        self.assertEqual(reader.read(100), msg[:100])
+        reader.seek(1100)
+        with self.assertRaises(AuthenticationFailed):
+            reader.read(10)
+
+    def test_session(self):
+        session = self.cipher.session(self.key)
+        msgs = [b'', b'a', os.urandom(16), os.urandom(1000)]
+        tokens = session.encrypt_many(msgs)
+        self.assertEqual(session.decrypt_many(tokens), msgs)
+        
+        # Tokens interoperate with the one-shot API
+        ciphertext, iv = self.cipher.authenticate(tokens[3], 
+                                                  session.signing_key)
+        self.assertEqual(self.cipher.decrypt(ciphertext, self.key, iv), 
+                         msgs[3])
+        
+        other = self.cipher.session(self.key)
+        with self.assertRaises(AuthenticationFailed):
+            other.decrypt(tokens[0])
+
+    def test_compression(self):
+        text = b''.join(b'%d,2021-06-18,INFO,all good\n' % i 
+                        for i in range(20000))
+        for codec in available_codecs():
+            for msg in [b'', b'x', text]:
+                out = self.roundtrip(msg, chunk_size=4096, compression=codec)
+                self.assertEqual(out, msg)
+            
+            enc = io.BytesIO()
+            self.cipher.encrypt_file(io.BytesIO(text), enc, self.key, 
+                                     compression=codec)
+            # The codec byte follows the version and algorithm
+            self.assertEqual(enc.getvalue()[len(CMF_MAGIC) + 2], codec)
+            if codec != CODEC_NONE:
+                self.assertLess(len(enc.getvalue()), len(text) // 5)
+                enc.seek(0)
+                with self.assertRaises(InvalidToken):
+                    CMFReader(enc, self.key)
+        
+        # Random data is stored as-is
+        noise = os.urandom(100000)
+        self.assertGreater(entropy(noise), 7.9)
+        enc = io.BytesIO()
+        self.cipher.encrypt_file(io.BytesIO(noise), enc, self.key,
+                                 compression=available_codecs()[1])
+        self.assertEqual(enc.getvalue()[len(CMF_MAGIC) + 2], CODEC_NONE)
+        enc.seek(0)
+        self.assertEqual(CMFReader(enc, self.key).read(), noise)
+
+    def test_archive(self):
+        with tempfile.TemporaryDirectory() as d:
+            tree = {os.path.join('src', 'a.txt') : b'hello\n' * 1000,
+                    os.path.join('src', 'empty') : b'',
+                    os.path.join('src', 'sub', 'b.bin') : os.urandom(50000)}
+            for name, data in tree.items():
+                os.makedirs(os.path.join(d, os.path.dirname(name)), 
+                            exist_ok=True)
+                with open(os.path.join(d, name), 'wb') as f:
+                    f.write(data)
+            
+            enc = os.path.join(d, 'src_TAR.cmf')
+            encrypt_tree(os.path.join(d, 'src'), enc, self.key, 
+                         chunk_size=4096, cipher=self.cipher)
+            decrypt_tree(enc, os.path.join(d, 'out'), self.key)
+            for name, data in tree.items():
+                with open(os.path.join(d, 'out', name), 'rb') as f:
+                    self.assertEqual(f.read(), data)
+            
+            # The index gives the members without decrypting the archive
+            names = sorted(m['name'] for m in list_archive(enc, self.key)
+                           if m['type'] == 'file')
+            self.assertEqual(names, sorted(n.replace(os.sep, '/') 
+                                           for n in tree))
+            with mock.patch.object(self.cipher, 'decrypt_file') as full:
+                path = extract_member(enc, self.key, 'src/sub/b.bin', 
+                                      os.path.join(d, 'one'), 
+                                      cipher=self.cipher)
+                self.assertFalse(full.called)
+            with open(path, 'rb') as f:
+                self.assertEqual(f.read(), tree[os.path.join('src', 'sub',
+                                                             'b.bin')])
+            with self.assertRaises(MemberNotFound):
+                extract_member(enc, self.key, 'src/nope', d)
+            plain = io.BytesIO()
+            self.cipher.encrypt_file(io.BytesIO(b'x' * 1000), plain, self.key)
+            plain.seek(0)
+            with self.assertRaises(NotAnArchive):
+                decrypt_tree(plain, os.path.join(d, 'none'), self.key)
+            
+            # Compressed archives are listed by decrypting them
+            enc_z = os.path.join(d, 'z_TAR.cmf')
+            encrypt_tree(os.path.join(d, 'src'), enc_z, self.key, 
+                         compression=available_codecs()[1])
+            members = list_archive(enc, self.key)
+            for member in members:
+                member.pop('offset', None)
+            self.assertEqual(list_archive(enc_z, self.key), members)
+            path = extract_member(enc_z, self.key, 'src/a.txt', 
+                                  os.path.join(d, 'two'))
+            with open(path, 'rb') as f:
+                self.assertEqual(f.read(), tree[os.path.join('src', 'a.txt')])
+            
+            # Cutting off the last chunk is noticed after the tar has ended
+            with open(enc, 'rb') as f:
+                data = f.read()
+            with self.assertRaises(AuthenticationFailed):
+                decrypt_tree(io.BytesIO(data[:-4112]), 
+                             os.path.join(d, 'out2'), self.key)
+            
+            with self.assertRaises(ValueError):
+                encrypt_tree(os.path.join(d, 'src'), io.BytesIO(), self.key,
+                             algorithm=ALG_AES_CBC_HMAC)
+            
+            # The CLI unpacks archives of any name to the directory they hold
+            key_file = os.path.join(d, 'my.key')
+            save_key(key_file, self.key.hex())
+            backup = os.path.join(d, 'backup.cmf')
+            os.rename(enc, backup)
+            out = os.path.join(d, 'o')
+            for status in (0, 1):
+                args = cli.build_parser().parse_args(
+                    ['extract', '-k', key_file, '-o', out, backup])
+                err = io.StringIO()
+                self.assertEqual(cli.run(args, io.StringIO(), err), status)
+            self.assertIn(os.path.join(out, 'src') + ' exists', 
+                          err.getvalue())
+            with open(os.path.join(out, 'src', 'a.txt'), 'rb') as f:
+                self.assertEqual(f.read(), tree[os.path.join('src', 'a.txt')])
+
+    @mock.patch('pierceslock.cipher.SEGMENT_SIZE', 4000)
+    @mock.patch('pierceslock.journal.CHECKPOINT_INTERVAL', 8000)
+    def test_resume(self):
+        import pierceslock.cipher
+        real_map = pierceslock.cipher._parallel_map
+        real_seg = pierceslock.cipher._segments
+        
+        def interrupted(fn, iterable, workers):
+            for n, result in enumerate(real_map(fn, iterable, workers)):
+                if n == 10:
+                    raise KeyboardInterrupt
+                yield result
+        
+        msg = os.urandom(100000)
+        with tempfile.TemporaryDirectory() as d:
+            src = os.path.join(d, 'in.bin')
+            enc = os.path.join(d, 'in_BIN.cmf')
+            dec = os.path.join(d, 'out.bin')
+            with open(src, 'wb') as f:
+                f.write(msg)
+            
+            for run, out in [(lambda: self.cipher.encrypt_file(
+                                  src, enc, self.key, chunk_size=1000, 
+                                  resumable=True), enc),
+                             (lambda: self.cipher.decrypt_file(
+                                  enc, dec, self.key, resumable=True), dec)]:
+                with mock.patch('pierceslock.cipher._parallel_map', 
+                                interrupted):
+                    with self.assertRaises(KeyboardInterrupt):
+                        run()
+                self.assertTrue(os.path.exists(out + '.journal'))
+                # The second run only handles the chunks after the journal
+                segments = []
+                
+                def recorded(chunks, chunk_size):
+                    segments.extend(real_seg(chunks, chunk_size))
+                    return segments
+                
+                with mock.patch('pierceslock.cipher._segments', recorded):
+                    run()
+                self.assertGreater(segments[0][0][0], 0)
+                self.assertFalse(os.path.exists(out + '.journal'))
+            
+            with open(dec, 'rb') as f:
+                self.assertEqual(f.read(), msg)
+            
+            # A run resumed with another key starts over under that key
+            other = os.urandom(32)
+            with mock.patch('pierceslock.cipher._parallel_map', interrupted):
+                with self.assertRaises(KeyboardInterrupt):
+                    self.cipher.encrypt_file(src, enc, self.key, 
+                                             chunk_size=1000, resumable=True)
+            self.cipher.encrypt_file(src, enc, other, chunk_size=1000, 
+                                     resumable=True)
+            self.assertFalse(os.path.exists(enc + '.journal'))
+            self.cipher.verify_file(enc, other)
+            with self.assertRaises(AuthenticationFailed):
+                self.cipher.verify_file(enc, self.key)
+
+    def test_pipe(self):
+        class Pipe(io.BytesIO):
+            def seekable(self):
+                return False
+        
+        msg = os.urandom(50000)
+        with tempfile.TemporaryDirectory() as d:
+            key_file = os.path.join(d, 'my.key')
+            save_key(key_file, generate_key())
+            
+            def pipe(*argv, data):
+                out, err = Pipe(), io.StringIO()
+                args = cli.build_parser().parse_args(list(argv) + 
+                                                     ['-k', key_file])
+                status = cli.run_pipe(args, Pipe(data), out, err)
+                return status, out.getvalue()
+            
+            for algorithm in ('gcm', 'cbc'):
+                status, enc = pipe('encrypt', '-a', algorithm, data=msg)
+                self.assertEqual(status, 0)
+                self.assertEqual(pipe('decrypt', data=enc), (0, msg))
+                self.assertEqual(pipe('verify', data=enc), (0, b''))
+                # Nothing unauthenticated reaches the pipe
+                tampered = enc[:-1] + bytes([enc[-1] ^ 1])
+                status, out = pipe('decrypt', data=tampered)
+                self.assertEqual(status, 1)
+                if algorithm == 'cbc':
+                    self.assertEqual(out, b'')
+
+    def test_in_place(self):
+        import pierceslock.cipher
+        real_write = pierceslock.cipher.write_journal
+        
+        def crashing(dst, state, payload=b'', wipe=False):
+            real_write(dst, state, payload, wipe)
+            if state['pending'] is not None and state['done'] < 60:
+                raise KeyboardInterrupt
+        
+        msg = os.urandom(100000)
+        with tempfile.TemporaryDirectory() as d:
+            src = os.path.join(d, 'in.bin')
+            enc = os.path.join(d, 'in_BIN.cmf')
+            with open(src, 'wb') as f:
+                f.write(msg)
+            
+            with mock.patch('pierceslock.cipher.SEGMENT_SIZE', 5000):
+                with mock.patch('pierceslock.cipher.write_journal', 
+                                crashing), \
+                        self.assertRaises(KeyboardInterrupt):
+                    self.cipher.encrypt_in_place(src, self.key, enc, 
+                                                 chunk_size=1000)
+                self.assertFalse(os.path.exists(src))
+                self.assertTrue(os.path.exists(enc + '.journal'))
+                self.cipher.encrypt_in_place(src, self.key, enc, wipe=True)
+            
+            self.assertFalse(os.path.exists(enc + '.journal'))
+            self.assertEqual(os.path.getsize(enc), 
+                             METADATA_HEADER_SIZE + len(msg) + 100 * 16)
+            info = self.cipher.stat_file(enc, self.key)
+            self.assertEqual((info['name'], info['size']), 
+                             ('in.bin', len(msg)))
+            dec = io.BytesIO()
+            self.cipher.decrypt_file(enc, dec, self.key)
+            self.assertEqual(dec.getvalue(), msg)
+
+    def test_job(self):
+        msg = os.urandom(300000)
+        with tempfile.TemporaryDirectory() as d:
+            src = os.path.join(d, 'in.bin')
+            enc = os.path.join(d, 'in_BIN.cmf')
+            with open(src, 'wb') as f:
+                f.write(msg)
+            
+            def work(job):
+                with job.output(enc) as fout:
+                    self.cipher.encrypt_file(src, fout, self.key, 
+                                             chunk_size=1000)
+                return enc
+            
+            job = Job(work, len(msg)).start()
+            job.thread.join()
+            events = list(job.events.queue)
+            self.assertEqual(events[-1], ('done', enc))
+            self.assertEqual(events[-2][:3], ('progress', job.done, len(msg)))
+            self.assertEqual(job.done, os.path.getsize(enc))
+            
+            # The cipher counts the plaintext it takes in, mmap'd or not
+            def counted(job):
+                with job.output(enc, counted=False) as fout:
+                    self.cipher.encrypt_file(src, fout, self.key, 
+                                             chunk_size=1000, 
+                                             progress=job.advance)
+            
+            job = Job(counted, len(msg)).start()
+            job.thread.join()
+            self.assertEqual(job.events.queue[-1], ('done', None))
+            self.assertEqual(job.done, len(msg))
+            
+            # A cancelled job stops and removes its output
+            job = Job(work, len(msg))
+            job.cancel()
+            job.start().thread.join()
+            self.assertEqual(list(job.events.queue), [('cancelled',)])
+            self.assertFalse(os.path.exists(enc))
+
+    def test_batch(self):
+        with tempfile.TemporaryDirectory() as d:
+            paths = []
+            for i in range(3):
+                paths.append(os.path.join(d, 'f%d.bin' % i))
+                with open(paths[-1], 'wb') as f:
+                    f.write(os.urandom(50000 * (i + 1)))
+            
+            def task(path, total):
+                def work(job):
+                    out = cmf_name(path)
+                    with job.input(path) as fin, \
+                            job.output(out, counted=False) as fout:
+                        self.cipher.encrypt_file(fin, fout, self.key, 
+                                                 chunk_size=1000)
+                return work, total
+            
+            # The missing file fails without stopping the others
+            items = [task(path, os.path.getsize(path)) for path in paths]
+            items.insert(1, task(os.path.join(d, 'missing.bin'), 0))
+            batch = Batch(items, workers=2).start()
+            batch.thread.join()
+            events = list(batch.events.queue)
+            self.assertEqual(events[-1][:4], ('summary', 3, 1, 0))
+            self.assertEqual(events[-2][:3], ('progress', batch.total, 
+                                              batch.total))
+            states = {e[1] : e[2] for e in events if e[0] == 'status'}
+            self.assertEqual(states, {0 : 'done', 1 : 'failed', 2 : 'done', 
+                                      3 : 'done'})
+            for path in paths:
+                self.assertEqual(self.cipher.stat_file(cmf_name(path), 
+                                                       self.key)['size'],
+                                 os.path.getsize(path))
+                os.remove(cmf_name(path))
+            
+            # A cancelled batch skips its jobs and leaves no output behind
+            batch = Batch(items)
+            batch.cancel()
+            batch.start().thread.join()
+            self.assertEqual(list(batch.events.queue)[-1][:4], 
+                             ('summary', 0, 0, 4))
+            self.assertEqual(sorted(os.listdir(d)), 
+                             [os.path.basename(path) for path in paths])
+
+    def test_async(self):
+        class Sink(object):
+            def __init__(self):
+                self.data = bytearray()
+            def write(self, data):
+                self.data += data
+            async def drain(self):
+                pass
+        
+        def stream(data):
+            reader = asyncio.StreamReader()
+            reader.feed_data(data)
+            reader.feed_eof()
+            return reader
+        
+        async def encrypt(msg):
+            enc = Sink()
+            await aio.encrypt_stream(stream(msg), enc, self.key, 
+                                     chunk_size=1000)
+            return bytes(enc.data)
+        
+        async def decrypt(data):
+            dec = Sink()
+            await aio.decrypt_stream(stream(data), dec, self.key)
+            return bytes(dec.data)
+        
+        for n in [0, 1, 999, 1000, 1001, 30000]:
+            msg = os.urandom(n)
+            enc = asyncio.run(encrypt(msg))
+            self.assertEqual(asyncio.run(decrypt(enc)), msg)
+            # Same format as the file API
+            out = io.BytesIO()
+            self.cipher.decrypt_file(io.BytesIO(enc), out, self.key)
+            self.assertEqual(out.getvalue(), msg)
+        
+        with self.assertRaises(AuthenticationFailed):
+            asyncio.run(decrypt(enc[:-1]))
+        
+        # Compressed chunks are written in bounded pieces
+        writes = []
+        
+        async def inflate(data):
+            sink = Sink()
+            sink.write = lambda data: writes.append(len(data))
+            await aio.decrypt_stream(stream(data), sink, self.key)
+        
+        for codec in available_codecs()[1:]:
+            enc = io.BytesIO()
+            self.cipher.encrypt_file(io.BytesIO(bytes(8 * 2**20)), enc, 
+                                     self.key, compression=codec)
+            del writes[:]
+            asyncio.run(inflate(enc.getvalue()))
+            self.assertEqual(sum(writes), 8 * 2**20)
+            self.assertLessEqual(max(writes), DECOMPRESS_PIECE_SIZE)
+        
+        # Version 1 containers and other data are refused up front
+        legacy = io.BytesIO()
+        self.cipher.encrypt_file(io.BytesIO(os.urandom(100)), legacy, 
+                                 self.key, algorithm=ALG_AES_CBC_HMAC)
+        for data in [legacy.getvalue(), os.urandom(100), b'']:
+            with self.assertRaises(InvalidToken):
+                asyncio.run(decrypt(data))
+
+    def test_vault(self):
+        rows = [['site', 'user', 'p,a"ss\nword'], ['', '', '']]
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, 'passwords.pwf')
+            write_vault(path, self.key, rows)
+            self.assertEqual(read_vault(path, self.key), rows)
+            
+            # Vaults from before the CSV format are split on plain commas
+            legacy = [['site', '"user', 'pass"word'], ['b', 'caf\xe9', '']]
+            data = ''.join(','.join(row) + '\n' for row in legacy)
+            self.cipher.encrypt_file(io.BytesIO(data.encode('latin-1')), 
+                                     path, self.key)
+            self.assertEqual(read_vault(path, self.key), legacy)
+            write_vault(path, self.key, legacy)
+            self.assertEqual(read_vault(path, self.key), legacy)
+
+    def test_key_index(self):
+        with tempfile.TemporaryDirectory() as d:
+            for name in ('b', 'a', 'c'):
+                save_key(os.path.join(d, name + '.key'), generate_key())
+            index = KeyIndex(d + os.sep, cache_size=2)
+            self.assertEqual(index.names(), ['a', 'b', 'c'])
+            key = index.load('a')
+            self.assertEqual(index.fingerprint('a'), key_fingerprint(key))
+            
+            # Parsed keys come from the cache, at most cache_size of them
+            self.assertIs(index.load('a'), key)
+            self.assertEqual(index.find(key_fingerprint(key)), ['a'])
+            self.assertEqual(list(index._keys), ['b', 'c'])
+            
+            # Changes to the directory are picked up, by whoever made them
+            generation = index.generation
+            index.add('d', self.key.hex())
+            self.assertEqual(index.load('d'), self.key)
+            index.remove('b')
+            os.remove(index.path('c'))
+            self.assertEqual(index.names(), ['a', 'd'])
+            self.assertGreater(index.generation, generation)
+            generation = index.generation
+            self.assertEqual(index.names(), ['a', 'd'])
+            self.assertEqual(index.generation, generation)
+
+    def test_keystore(self):
+        with tempfile.TemporaryDirectory() as d:
+            for name in ('b', 'a'):
+                save_key(os.path.join(d, name + '.key'), generate_key())
+            save_key(os.path.join(d, 'broken.key'), 'not hex')
+            path = os.path.join(d, 'keys.pks')
+            
+            with KeyStore(path) as keystore:
+                self.assertEqual(import_key_dir(keystore, d), ['a', 'b'])
+                self.assertEqual(import_key_dir(keystore, d), [])
+                keystore.add('mine', self.key)
+                self.assertRaises(ValueError, keystore.add, 'mine', self.key)
+                self.assertEqual(keystore.find(key_fingerprint(self.key)),
+                                 ['mine'])
+                
+                # Deleting clears one record, adding reuses its slot
+                size = os.path.getsize(path)
+                keystore.remove('a')
+                keystore.add('c', os.urandom(32))
+                self.assertEqual(os.path.getsize(path), size)
+            
+            with KeyStore(path) as keystore:
+                self.assertEqual(keystore.names(), ['b', 'c', 'mine'])
+                self.assertEqual(keystore.get('mine'), self.key)
+                self.assertRaises(KeyNotFound, keystore.get, 'nope')
+            
+            # The CLI takes keys from a keystore as STORE.pks:NAME
+            enc = os.path.join(d, 'msg_BIN.cmf')
+            self.cipher.encrypt_file(io.BytesIO(b'msg'), enc, self.key)
+            args = cli.build_parser().parse_args(
+                ['verify', '-k', path + ':mine', enc])
+            self.assertEqual(cli.run(args, io.StringIO(), io.StringIO()), 0)
+            
+            # A wrapped store needs its master key
+            path = os.path.join(d, 'wrapped.pks')
+            with KeyStore(path, master_key=self.key) as keystore:
+                keystore.add('mine', self.key)
+            with open(path, 'rb') as f:
+                self.assertNotIn(self.key, f.read())
+            self.assertRaises(AuthenticationFailed, KeyStore, path)
+            self.assertRaises(AuthenticationFailed, KeyStore, path, 
+                              os.urandom(32))
+            with KeyStore(path, master_key=self.key) as keystore:
+                self.assertTrue(keystore.wrapped)
+                self.assertEqual(keystore.get('mine'), self.key)
+            
+            # A damaged record keeps its slot and name until it is cleared
+            with open(path, 'r+b') as f:
+                f.seek(-RECORD_SIZE // 2, os.SEEK_END)
+                f.write(b'\xff')
+            with KeyStore(path, master_key=self.key) as keystore:
+                self.assertEqual(keystore.names(), ['mine'])
+                self.assertEqual(keystore.damaged(), [0])
+                self.assertRaises(AuthenticationFailed, keystore.get, 'mine')
+                self.assertRaises(ValueError, keystore.add, 'mine', self.key)
+                keystore.add('other', self.key)
+                self.assertEqual(keystore.key_id('other'), 
+                                 key_fingerprint(self.key))
+                size = os.path.getsize(path)
+                keystore.clear_damaged(0)
+                self.assertEqual(keystore.names(), ['other'])
+                keystore.add('mine', self.key)
+                self.assertEqual(os.path.getsize(path), size)
+            with KeyStore(path, master_key=self.key) as keystore:
+                self.assertEqual(keystore.damaged(), [])
+                self.assertEqual(keystore.get('mine'), self.key)
+
+    def test_keystore_index(self):
+        # The key manager shows a keystore through the KeyIndex calls
+        with tempfile.TemporaryDirectory() as d:
+            save_key(os.path.join(d, 'a.key'), generate_key())
+            path = os.path.join(d, 'keys.pks')
+            
+            index = open_key_index(d)
+            self.assertIsInstance(index, KeyIndex)
+            index = open_key_index(path, index)
+            self.assertIsInstance(index, KeyStoreIndex)
+            self.assertIs(open_key_index(path, index), index)
+            self.assertEqual(index.names(), [])
+            
+            self.assertEqual(index.import_dir(d), ['a'])
+            index.add('mine', self.key.hex())
+            self.assertRaises(ValueError, index.add, 'mine', self.key.hex())
+            self.assertEqual(index.names(), ['a', 'mine'])
+            self.assertEqual(index.read('mine'), self.key.hex())
+            self.assertEqual(load_key_spec(index.path('mine')), self.key)
+            index.remove('a')
+            self.assertEqual(index.names(), ['mine'])
+            self.assertRaises(KeyNotFound, load_key_spec, index.path('a'))
+            
+            # Wrapped stores are not opened without their master key
+            path = os.path.join(d, 'wrapped.pks')
+            KeyStore(path, master_key=self.key).close()
+            self.assertRaises(AuthenticationFailed, 
+                              KeyStoreIndex(path).names)
+
+    def test_headless_import(self):
+        # The library must not drag in the GUI stack
+        code = ('import sys, time\n'
+                't = time.perf_counter()\n'
+                'import pierceslock.cipher, pierceslock.keys, '
+                'pierceslock.vault\n'
+                't = time.perf_counter() - t\n'
+                'gui = [m for m in ("tkinter", "PIL") if m in sys.modules]\n'
+                'print(t, ",".join(gui))\n')
+        out = subprocess.check_output([sys.executable, '-c', code],
+                                      cwd=os.path.dirname(
+                                          os.path.abspath(__file__)))
+        seconds, _, gui = out.decode().strip().partition(' ')
+        self.assertEqual(gui, '')
+        self.assertLess(float(seconds), IMPORT_BUDGET)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -8,13 +8,16 @@ Description: This is a Password Manager for the Pierce's Lock Application
 
 """
 
-import glob, os, binascii
+import os
 import tkinter as tk
 from tkinter import Frame, Button, Label, Menu, Entry, StringVar, Listbox, \
     Scrollbar, ttk
 from tkinter.filedialog import askopenfilename,asksaveasfilename, askdirectory
-from AESCipher import AESCipher, AuthenticationFailed,DecryptionFailed, \
-    UnpaddingError, TTLError
+from pierceslock.exceptions import AuthenticationFailed, DecryptionFailed, \
+    UnpaddingError, TTLError, InvalidToken
+from pierceslock.keys import KeyIndex
+from pierceslock.keystore import load_key_spec, open_key_index
+from pierceslock.vault import read_vault, write_vault
     
 class BaseApp(object):
     '''
@@ -26,7 +29,28 @@ class BaseApp(object):
         self.window = tk.Tk()
         self.window.title("Password Manager")
         self.key_dir = os.path.abspath('keys')
+        self.key_index = KeyIndex(self.key_dir)
+        self.screens = {}
+        self.screen = None
         
+    def show_screen(self, name, build, width, height):
+        '''
+        Same as Application.show_screen: builds the screen once, then 
+        shows it in the window instead of the screen shown before
+        '''
+        self.window.geometry("%dx%d" % (width, height))
+        if name not in self.screens:
+            frame = Frame(self.window, width=width, height=height)
+            build(frame)
+            self.screens[name] = frame
+        if self.screen != name:
+            if self.screen in self.screens:
+                self.screens[self.screen].pack_forget()
+            self.screens[name].pack()
+            self.screen = name
+        self.background_frame = self.screens[name]
+        return self.background_frame
+
     def quit_prompt(self):
         '''
         Helper function for draw_menu function.  Displays a prompt to quit the
@@ -161,8 +185,11 @@ class PasswordManager(object):
         -------
         None.        
         '''
+        # The menu is built once, and put back when the window is shown 
+        # again
         if hasattr(self, 'menu'):
-            self.menu.destroy()
+            self.base_app.window.config(menu=self.menu)
+            return
         
         # Build the menu
         self.menu = Menu(self.base_app.window)
@@ -210,7 +237,8 @@ class PasswordManager(object):
 
     def password_manager_window(self):
         '''
-        Opens the password manager window in the application
+        Opens the password manager window in the application, with an 
+        empty table
     
         Attributes
         ----------
@@ -220,31 +248,34 @@ class PasswordManager(object):
         Returns
         -------
         None.               
-        '''        
-
-        self.base_app.window.geometry("%dx%d" % (self.window_width, 
-                                        self.window_height))
+        '''
+        self.base_app.show_screen('passwords', self.build_window, 
+                                  self.window_width, self.window_height)
+        self.draw_menu(self.treev)
         
         self.iid = 0
-        
-        if hasattr(self, 'popup_window'):
-            self.popup_window.destroy()
-        if hasattr(self.base_app, 'background_frame'):
-            self.base_app.background_frame.destroy()        
-        
-        
-        self.base_app.background_frame = Frame(self.base_app.window, 
-                                 width=self.window_width,
-                                 height=self.window_height)
-        self.base_app.background_frame.pack()
-        
+        self.treev.delete(*self.treev.get_children())
+
+    def build_window(self, frame):
+        '''
+        Builds the password manager window (see password_manager_window) in
+        frame
+    
+        Attributes
+        ----------
+        treev : tkinter Treeview object
+            This contains the database for display purposes.
 
-        treev = ttk.Treeview(self.base_app.background_frame, 
+        Returns
+        -------
+        None.
+        '''
+        treev = ttk.Treeview(frame, 
                              selectmode='browse')
         treev.place(x=10, y=65, width=self.window_width-20, 
                        height=self.window_height-95)
 
-        verscrlbar = ttk.Scrollbar(self.base_app.background_frame,
+        verscrlbar = ttk.Scrollbar(frame,
                            orient ="vertical",
                            command = treev.yview) 
         verscrlbar.place(x=self.window_width-21, y=65, width=20, 
@@ -265,22 +296,22 @@ class PasswordManager(object):
             treev.heading(key, text=key, anchor ='c')
         
         # '''Buttons''' 
-        button = Button(self.base_app.background_frame,
+        button = Button(frame,
                         text='New Entry',
                         command=lambda:self.add_new_password_window(treev))
         button.place(x=10, y=10, width=150, height=50)
         
-        button = Button(self.base_app.background_frame,
+        button = Button(frame,
                               text='Edit Entry',
                               command=lambda:self.edit_password_window(treev))
         button.place(x=165, y=10, width=150, height=50)
 
-        button = Button(self.base_app.background_frame,
+        button = Button(frame,
                               text='Delete Entry',
                               command=lambda:self.delete_password_cmd(treev))
         button.place(x=320, y=10, width=150, height=50)    
 
-        self.draw_menu(treev)        
+        self.treev = treev
         
     def key_prompt_window(self, treev, mode):
         '''
@@ -328,7 +359,8 @@ class PasswordManager(object):
         path_pane = Entry(bkgd_frame, 
                           textvariable=self.key_path_var)
         self.key_path_var.set(self.base_app.key_dir)
-        path_pane.bind('<Return>', lambda:self.update_key_dir(treev, mode))
+        path_pane.bind('<Return>', 
+                       lambda event:self.update_key_dir(event, treev, mode))
         path_pane.place(x=100, y=31, width=window_width-250, height=30)
         
         cmd = lambda:self.change_key_dir(popup_window, treev, mode)
@@ -344,9 +376,15 @@ class PasswordManager(object):
                         width=window_width-20, 
                         height=window_height-130)
     
-    
-        for i, key_file in enumerate(glob.glob(self.base_app.key_dir + '/*.key')):
-            self.pane.insert(i, key_file.split('\\')[-1][:-4])
+        # The key index is shared with the main application
+        key_index = open_key_index(self.base_app.key_dir, 
+                                   self.base_app.key_index)
+        self.base_app.key_index = key_index
+        try:
+            self.pane.insert(tk.END, *key_index.names())
+        except (InvalidToken, AuthenticationFailed):
+            # Not a keystore, or a wrapped one: nothing to pick
+            pass
         
         scrollbar = Scrollbar(self.pane)
         scrollbar.pack(side = tk.RIGHT, fill = tk.BOTH)
@@ -449,7 +487,7 @@ class PasswordManager(object):
                                     title = "Change Key Directory")
         
         if new_key_dir:
-            self.base_app.key_dir = new_key_dir.replace('/', '\\')
+            self.base_app.key_dir = os.path.normpath(new_key_dir)
             
             # with open('.profile', 'w') as f:
             #     f.write('key_dir '+self.base_app.key_dir)
@@ -469,7 +507,8 @@ class PasswordManager(object):
         Attributes
         ----------
         keypath : string
-            The location of the .key file that will be used.
+            The location of the .key file that will be used (STORE.pks:NAME
+            for a key in a keystore).
 
         Returns
         -------
@@ -477,7 +516,7 @@ class PasswordManager(object):
         '''
         ii = self.pane.curselection()
         filename = self.pane.get(ii)
-        self.keypath = self.base_app.key_dir + '\\%s.key' % filename
+        self.keypath = self.base_app.key_index.path(filename)
 
     def save_password_cmd(self, treev, window):
         '''
@@ -507,25 +546,10 @@ class PasswordManager(object):
             if not savepath:
                 return
             
-            cipher = AESCipher()
-            
-            with open(self.keypath, "r") as f:
-                key = f.read()
+            key = load_key_spec(self.keypath)
             
-            key = binascii.unhexlify(key)
-            
-            csv_data = ''
-            for row_id in treev.get_children():
-                row = treev.item(row_id)['values']
-                for val in row:
-                    csv_data = csv_data + str(val) + ','
-                csv_data = csv_data[:-1] + '\n'
-            
-            b = bytearray()
-            b.extend(map(ord, csv_data))
-            
-            ciphertext, iv = cipher.encrypt(b, key)
-            ciphertext, signing_key = cipher.encode_authentication(ciphertext, iv)
+            rows = [[str(val) for val in treev.item(row_id)['values']]
+                    for row_id in treev.get_children()]
             
             if savepath[-4:] != '.pwf':
                 savepath = savepath+'.pwf'
@@ -533,8 +557,7 @@ class PasswordManager(object):
             # else:
             #     savepath = savepath[:-4] + '.pwf'
                 
-            with open(savepath , "wb") as f:
-                f.write(signing_key + ciphertext)
+            write_vault(savepath, key, rows)
        
             popup_window = tk.Toplevel()
             popup_window.geometry("300x100") 
@@ -585,31 +608,18 @@ class PasswordManager(object):
             if not pwf_file:
                 return
             
-            cipher = AESCipher()
-            
-            with open(self.keypath, "r") as f:
-                key = f.read()
-            
-            key = binascii.unhexlify(key)            
-        
-            with open(pwf_file, "rb") as f:
-                msg = f.read()
-                signing_key = msg[:16]
-                ciphertext = msg[16:]
+            key = load_key_spec(self.keypath)
             
             try:
-                ciphertext, iv = cipher.authenticate(ciphertext, signing_key)
+                rows = read_vault(pwf_file, key)
             except TTLError:
                 self.base_app.one_button_popup("TTL Failure",
                             "The message's time-to-live (TTL) has expired.")
                 return
-            except AuthenticationFailed:
+            except (AuthenticationFailed, InvalidToken):
                 self.base_app.one_button_popup("Authentication Failed",
                                       "Message Authentication has Failed")                
                 return
-            
-            try:
-                deciphertext = cipher.decrypt(ciphertext, key, iv)
             except DecryptionFailed:
                 self.base_app.one_button_popup("Decryption Failed",
                                       "Message Decryption has Failed")                
@@ -619,12 +629,10 @@ class PasswordManager(object):
                             "Message unpadding after decryption has failed.")                
                 return                       
         
-            csv_data = deciphertext.decode('utf-8').split('\n')
             self.iid = 0
             treev.delete(*treev.get_children())
             
-            for row in csv_data:
-                row = row.split(',')
+            for row in rows:
                 treev.insert("", 'end', iid=self.iid, text ="L1", 
                              values=tuple(row))
                 self.iid = self.iid + 1
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+"""
+pierceslock
+By Ronald Kemker
+
+Description: The GUI-free core of the "Pierce's Lock" Encryption/Decryption 
+             Software: the cipher, the .cmf container format, key files, 
+             keystores and password vaults.  application.py and 
+             password_manager.py are Tk front ends on top of it.  Run 
+             "python -m pierceslock --help" for the command line interface.
+
+             Names are imported from their submodules on first use, so 
+             "import pierceslock" stays cheap until the cipher is needed.
+
+"""
+
+import importlib
+
+_EXPORTS = {
+    'AESCipher' : 'cipher',
+    'CipherSession' : 'cipher',
+    'CMFReader' : 'cipher',
+    'InvalidToken' : 'exceptions',
+    'AuthenticationFailed' : 'exceptions',
+    'DecryptionFailed' : 'exceptions',
+    'UnpaddingError' : 'exceptions',
+    'TTLError' : 'exceptions',
+    'NotAnArchive' : 'exceptions',
+    'MemberNotFound' : 'exceptions',
+    'KeyNotFound' : 'exceptions',
+    'CHUNK_SIZE' : 'container',
+    'ALGORITHMS' : 'container',
+    'ALG_AES_CBC_HMAC' : 'container',
+    'ALG_AES_GCM' : 'container',
+    'ALG_CHACHA20_POLY1305' : 'container',
+    'cmf_name' : 'container',
+    'plain_name' : 'container',
+    'key_fingerprint' : 'container',
+    'CODECS' : 'compress',
+    'CODEC_NONE' : 'compress',
+    'CODEC_ZLIB' : 'compress',
+    'CODEC_LZMA' : 'compress',
+    'CODEC_ZSTD' : 'compress',
+    'default_codec' : 'compress',
+    'generate_key' : 'keys',
+    'KeyIndex' : 'keys',
+    'list_keys' : 'keys',
+    'load_key' : 'keys',
+    'save_key' : 'keys',
+    'KeyStore' : 'keystore',
+    'import_key_dir' : 'keystore',
+    'KeyStoreIndex' : 'keystore',
+    'load_key_spec' : 'keystore',
+    'open_key_index' : 'keystore',
+    'encrypt_tree' : 'archive',
+    'decrypt_tree' : 'archive',
+    'archive_name' : 'archive',
+    'list_archive' : 'archive',
+    'extract_member' : 'archive',
+    'read_vault' : 'vault',
+    'write_vault' : 'vault',
+    }
+
+__all__ = sorted(_EXPORTS)
+
+def __getattr__(name):
+    if name not in _EXPORTS:
+        raise AttributeError("module 'pierceslock' has no attribute %r" 
+                             % name)
+    module = importlib.import_module('pierceslock.' + _EXPORTS[name])
+    value = getattr(module, name)
+    globals()[name] = value
+    return value
+
+def __dir__():
+    return sorted(list(globals()) + __all__)
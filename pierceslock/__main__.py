@@ -0,0 +1,12 @@
+# -*- coding: utf-8 -*-
+"""
+__main__.py
+
+Description: Entry point for "python -m pierceslock"
+
+"""
+
+import sys
+from pierceslock.cli import main
+
+sys.exit(main())
@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+"""
+aio.py
+By Ronald Kemker
+18 Jun 2021
+
+Description: asyncio counterparts of the file API for servers that must not
+             block their event loop.  Chunks are sealed and opened in an
+             executor, one chunk in flight per stream, and every write waits
+             on drain(), so a slow peer slows down its own stream instead of
+             piling up memory.  Compressed chunks are inflated and written 
+             a bounded piece at a time.
+
+"""
+
+import io, time, asyncio, functools
+from cryptography.exceptions import InvalidTag
+
+from pierceslock.exceptions import AuthenticationFailed, DecryptionFailed, \
+    TTLError, InvalidToken
+from pierceslock.container import CHUNK_SIZE, MAX_CHUNK_SIZE, ALG_AES_GCM, \
+    ALG_AES_CBC_HMAC, CMF_MAGIC, _chunk_nonce, _ChunkReader
+from pierceslock.compress import CODEC_NONE, decompressor, \
+    decompress_pieces, _ERRORS
+from pierceslock.cipher import AESCipher
+
+async def _read_chunk(reader, size):
+    '''
+    Reads size bytes from reader, or fewer at the end of the stream
+    '''
+    try:
+        return await reader.readexactly(size)
+    except asyncio.IncompleteReadError as e:
+        return e.partial
+
+async def _write(writer, result, executor):
+    '''
+    Writes result to writer: a byte string, or an iterator of byte strings
+    that is advanced in executor one piece at a time
+    '''
+    if isinstance(result, (bytes, bytearray)):
+        writer.write(result)
+        await writer.drain()
+        return
+    loop = asyncio.get_running_loop()
+    while True:
+        piece = await loop.run_in_executor(executor, next, result, None)
+        if piece is None:
+            return
+        writer.write(piece)
+        await writer.drain()
+
+async def _pipeline(reader, writer, size, process, executor):
+    '''
+    Reads size-byte chunks from reader, runs process(index, chunk, last) on
+    each in executor and writes the results to writer in order (see 
+    _write).  The next chunk is read while the current one is processed.
+    '''
+    loop = asyncio.get_running_loop()
+    pending = None
+    try:
+        chunk = await _read_chunk(reader, size)
+        index = 0
+        while True:
+            # Read one chunk ahead to find out whether this one is the last
+            next_chunk = await _read_chunk(reader, size)
+            last = not next_chunk
+            if pending is not None:
+                await _write(writer, await pending, executor)
+            pending = loop.run_in_executor(executor, process, index, chunk,
+                                           last)
+            if last:
+                break
+            chunk = next_chunk
+            index += 1
+        await _write(writer, await pending, executor)
+    finally:
+        # Do not leave an unawaited chunk behind if we stopped early
+        if pending is not None and not pending.done():
+            pending.cancel()
+        elif pending is not None and not pending.cancelled():
+            pending.exception()
+
+async def encrypt_stream(reader, writer, key, chunk_size=CHUNK_SIZE,
+                         algorithm=ALG_AES_GCM, executor=None, cipher=None,
+                         name=''):
+    '''
+    Encrypts everything read from reader into a version 4 .cmf container
+    written to writer.  The output is the same as AESCipher.encrypt_file 
+    with an unknown plaintext size.
+
+    Parameters
+    ----------
+    reader : asyncio.StreamReader
+        The plaintext (read until EOF)
+    writer : asyncio.StreamWriter
+        Where the .cmf data is written; it is not closed
+    key : byte-string
+        encryption key.
+    chunk_size : int, optional
+        Number of bytes per chunk (default=CHUNK_SIZE)
+    algorithm : int, optional
+        ALG_AES_GCM (default) or ALG_CHACHA20_POLY1305
+    executor : concurrent.futures.Executor, optional
+        Where the chunks are sealed (default=None, the loop's default
+        executor)
+    cipher : AESCipher object, optional
+        The cipher to use (default=None, a new one)
+    name : string, optional
+        The original file name recorded in the metadata (default='')
+
+    Returns
+    -------
+    None.
+    '''
+    if algorithm == ALG_AES_CBC_HMAC:
+        raise ValueError('Streams need an AEAD algorithm')
+    if not 0 < chunk_size <= MAX_CHUNK_SIZE:
+        raise ValueError('chunk_size must be in (0, %d]' % MAX_CHUNK_SIZE)
+    cipher = cipher or AESCipher()
+
+    header, metadata, aead = cipher._aead_header(algorithm, key, chunk_size,
+                                                 name=name)
+    writer.write(header + metadata)
+
+    def seal(index, chunk, last):
+        return aead.encrypt(_chunk_nonce(index, last), chunk, header)
+
+    await _pipeline(reader, writer, chunk_size, seal, executor)
+
+async def decrypt_stream(reader, writer, key, ttl=None, executor=None,
+                         cipher=None):
+    '''
+    Authenticates and decrypts a version 2, 3 or 4 .cmf container read from
+    reader.  Every chunk is authenticated before its plaintext is written,
+    so the plaintext already written is genuine even if a later chunk
+    fails; a truncated stream fails at its end.
+
+    Parameters
+    ----------
+    reader : asyncio.StreamReader
+        The .cmf data (read until EOF)
+    writer : asyncio.StreamWriter
+        Where the plaintext is written; it is not closed
+    key : byte-string
+        encryption key.
+    ttl : int, optional
+        The "time-to-live" for a given message. (Default=None)
+    executor : concurrent.futures.Executor, optional
+        Where the chunks are opened (default=None, the loop's default
+        executor)
+    cipher : AESCipher object, optional
+        The cipher to use (default=None, a new one)
+
+    Returns
+    -------
+    None.
+
+    Raises
+    ------
+    InvalidToken
+        If the stream is not an AEAD container (older containers carry one
+        signature at the very end and cannot be streamed safely)
+    TTLError, AuthenticationFailed, DecryptionFailed
+        Same conditions as AESCipher.decrypt_file
+    '''
+    cipher = cipher or AESCipher()
+
+    prefix = await _read_chunk(reader, len(CMF_MAGIC) + 1)
+    if (len(prefix) <= len(CMF_MAGIC) or 
+            not prefix.startswith(CMF_MAGIC) or
+            prefix[-1] not in _ChunkReader.header_sizes):
+        raise InvalidToken
+    size = _ChunkReader.header_sizes[prefix[-1]]
+    header = _ChunkReader(io.BytesIO(prefix + await _read_chunk(
+                                             reader, size - len(prefix))))
+    timestamp = header.read_header()[0]
+    if ttl is not None and timestamp + ttl < int(time.time()):
+        raise TTLError
+
+    aead = cipher.aead_engine(header.algorithm, key, header.salt)
+    cipher._open_metadata(header, aead)
+    d = decompressor(header.codec) if header.codec != CODEC_NONE else None
+
+    def inflate(data, last):
+        try:
+            yield from decompress_pieces(d, data)
+            if last:
+                yield d.flush()
+        except _ERRORS:
+            raise DecryptionFailed
+    
+    def open_chunk(index, sealed, last):
+        try:
+            plaintext = aead.decrypt(_chunk_nonce(index, last), sealed,
+                                     header.header)
+        except InvalidTag:
+            raise AuthenticationFailed
+        # Decompressed lazily, so the output of one chunk is never held
+        # in memory at once
+        return plaintext if d is None else inflate(plaintext, last)
+
+    await _pipeline(reader, writer, header.chunk_size + 16, open_chunk,
+                    executor)
+
+async def encrypt_file(src, dst, key, executor=None, cipher=None, **kwargs):
+    '''
+    AESCipher.encrypt_file run in executor (default=None, the loop's
+    default executor).  Unless given, workers is 1: with many files in
+    flight the executor already keeps the cores busy.
+    '''
+    cipher = cipher or AESCipher()
+    kwargs.setdefault('workers', 1)
+    await asyncio.get_running_loop().run_in_executor(
+        executor, functools.partial(cipher.encrypt_file, src, dst, key,
+                                    **kwargs))
+
+async def decrypt_file(src, dst, key, executor=None, cipher=None, **kwargs):
+    '''
+    AESCipher.decrypt_file run in executor, see encrypt_file
+    '''
+    cipher = cipher or AESCipher()
+    kwargs.setdefault('workers', 1)
+    await asyncio.get_running_loop().run_in_executor(
+        executor, functools.partial(cipher.decrypt_file, src, dst, key,
+                                    **kwargs))
@@ -0,0 +1,475 @@
+# -*- coding: utf-8 -*-
+"""
+archive.py
+By Ronald Kemker
+18 Jun 2021
+
+Description: Encrypts a whole directory tree into one .cmf archive and
+             extracts it again.  The tree is written as a tar stream straight
+             into the cipher, so no plaintext tar file is ever written and
+             memory use stays bounded.  Reading the files and encrypting them
+             run in separate threads, connected by a small in-memory pipe.
+
+             Behind the end of the tar stream every archive carries an index
+             of its members, so uncompressed archives can be listed and 
+             single members extracted by decrypting only the chunks that
+             hold them.
+
+"""
+
+import os, io, json, time, queue, struct, tarfile, threading, zlib, \
+    contextlib
+
+from pierceslock.exceptions import InvalidToken, TTLError, NotAnArchive, \
+    MemberNotFound
+from pierceslock.container import CHUNK_SIZE, ALG_AES_CBC_HMAC, ALG_AES_GCM,\
+    CMF_MAGIC, _open_stream, _open_output, _ChunkReader, cmf_name
+from pierceslock.compress import CODEC_NONE
+
+# Number of blocks buffered between the tar thread and the cipher.  Memory
+# use of the pipe is about PIPE_DEPTH * chunk size.
+PIPE_DEPTH = 32
+
+# The plaintext of an archive is
+#   tar stream | index | index length (8) | INDEX_MAGIC
+# where the index is zlib-compressed JSON: one entry per member with its 
+# name, type, size, mtime, mode and (for files) the offset of its data in 
+# the plaintext.  Tar readers stop at the end-of-archive blocks and never 
+# see the index.
+INDEX_MAGIC = b'PLIX'
+
+# Safe extraction (no absolute paths, links out of the tree, devices, ...)
+# where this Python has it
+if hasattr(tarfile, 'data_filter'):
+    _EXTRACT_FILTER = {'filter' : 'data'}
+else:
+    _EXTRACT_FILTER = {}
+
+class _Pipe(object):
+    '''
+    Bounded in-memory pipe between two threads.  The producer calls write
+    and then finish (with the exception that stopped it, if any); the
+    consumer calls read, and close if it stops reading early.
+    '''
+    def __init__(self, depth=PIPE_DEPTH):
+        self._queue = queue.Queue(depth)
+        self._buffer = bytearray()
+        self._eof = False
+        self._closed = False
+        self._error = None
+
+    def seekable(self):
+        return False
+
+    def write(self, data):
+        if self._closed:
+            raise BrokenPipeError('the reading end has been closed')
+        self._queue.put(bytes(data))
+        return len(data)
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def finish(self, error=None):
+        self._error = error
+        if not self._closed:
+            self._queue.put(None)
+
+    def read(self, size=-1):
+        while not self._eof and (size < 0 or len(self._buffer) < size):
+            block = self._queue.get()
+            if block is None:
+                self._eof = True
+            else:
+                self._buffer += block
+        if self._eof and self._error is not None:
+            raise self._error
+        if size < 0:
+            size = len(self._buffer)
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+    def close(self):
+        # Set the flag first, then unblock a producer waiting on a full queue
+        self._closed = True
+        try:
+            while True:
+                self._queue.get_nowait()
+        except queue.Empty:
+            pass
+
+class _IndexingTarFile(tarfile.TarFile):
+    '''
+    TarFile that records where the data of every member starts
+    '''
+    def __init__(self, *args, **kwargs):
+        self.index = []
+        super(_IndexingTarFile, self).__init__(*args, **kwargs)
+    
+    def addfile(self, tarinfo, fileobj=None):
+        super(_IndexingTarFile, self).addfile(tarinfo, fileobj)
+        entry = _member_entry(tarinfo)
+        if fileobj is not None:
+            blocks = -(-tarinfo.size // tarfile.BLOCKSIZE)
+            entry['offset'] = self.offset - blocks * tarfile.BLOCKSIZE
+        self.index.append(entry)
+
+def _member_entry(tarinfo):
+    '''
+    The index entry of a member (without its offset)
+    '''
+    if tarinfo.isreg():
+        kind = 'file'
+    elif tarinfo.isdir():
+        kind = 'dir'
+    elif tarinfo.issym():
+        kind = 'symlink'
+    else:
+        kind = 'other'
+    # The tar header only keeps the permission bits
+    return {'name' : tarinfo.name, 'type' : kind, 'size' : tarinfo.size,
+            'mtime' : tarinfo.mtime, 'mode' : tarinfo.mode & 0o7777}
+
+def _pack_index(index):
+    '''
+    The trailer written after the tar stream (see INDEX_MAGIC)
+    '''
+    data = zlib.compress(json.dumps(index, separators=(',', ':')).encode())
+    return data + struct.pack('>Q', len(data)) + INDEX_MAGIC
+
+def _read_index(reader):
+    '''
+    Reads the index from the end of a CMFReader, or returns None if the 
+    archive has none
+    '''
+    trailer = len(INDEX_MAGIC) + 8
+    if reader.size < trailer:
+        return None
+    reader.seek(-trailer, io.SEEK_END)
+    tail = reader.read(trailer)
+    (length,) = struct.unpack('>Q', tail[:8])
+    if tail[8:] != INDEX_MAGIC or length > reader.size - trailer:
+        return None
+    reader.seek(-trailer - length, io.SEEK_END)
+    return json.loads(zlib.decompress(reader.read(length)))
+
+def _member_path(dst_dir, name):
+    '''
+    Where member name is extracted to, refusing names that leave dst_dir
+    '''
+    path = os.path.normpath(name)
+    if os.path.isabs(path) or path.split(os.sep)[0] == os.pardir:
+        raise ValueError('Refusing to extract %r outside of %s' % 
+                         (name, dst_dir))
+    return os.path.join(dst_dir, path)
+
+def _default_cipher(cipher):
+    if cipher is None:
+        # Imported here so that importing the archive module stays cheap
+        from pierceslock.cipher import AESCipher
+        cipher = AESCipher()
+    return cipher
+
+def _check_aead(fin):
+    '''
+    Raises InvalidToken unless fin (left where it was) holds an AEAD 
+    container.  Archives are unpacked as they are decrypted, so older 
+    containers with a single signature at the end are not accepted.
+    '''
+    start = fin.tell()
+    head = fin.read(len(CMF_MAGIC) + 1)
+    fin.seek(start)
+    if (head[:-1] != CMF_MAGIC or 
+            head[-1] not in _ChunkReader.header_sizes):
+        raise InvalidToken
+
+def _open_index(fin, key, cipher):
+    '''
+    Returns a CMFReader over the archive in fin and the archive index, or 
+    (None, None) if the archive is compressed or has no index.  fin is left
+    where it was.
+    '''
+    from pierceslock.cipher import CMFReader
+    
+    _check_aead(fin)
+    start = fin.tell()
+    header = _ChunkReader(fin)
+    header.read_header()
+    fin.seek(start)
+    if header.codec != CODEC_NONE:
+        return None, None
+    
+    reader = CMFReader(fin, key, cipher)
+    index = _read_index(reader)
+    fin.seek(start)
+    if index is None:
+        return None, None
+    return reader, index
+
+@contextlib.contextmanager
+def _decrypted_tar(fin, key, cipher, ttl=None, workers=None):
+    '''
+    Yields a streaming TarFile over the plaintext of the archive in fin, 
+    decrypted in a producer thread
+    '''
+    pipe = _Pipe()
+    thread = _run_producer(pipe, lambda: cipher.decrypt_file(
+                               fin, pipe, key, ttl=ttl, workers=workers))
+    try:
+        try:
+            tar = tarfile.open(fileobj=pipe, mode='r|', bufsize=CHUNK_SIZE)
+        except tarfile.ReadError as e:
+            raise NotAnArchive(str(e))
+        with tar:
+            yield tar
+        # Drain the index after the end-of-archive marker, so the last 
+        # chunk (and with it the length of the file) is verified
+        while pipe.read(CHUNK_SIZE):
+            pass
+    finally:
+        pipe.close()
+        thread.join()
+
+def _run_producer(pipe, fn):
+    '''
+    Runs fn() in a daemon thread and finishes pipe when it returns
+    '''
+    def run():
+        try:
+            fn()
+        except BaseException as e:
+            pipe.finish(e)
+        else:
+            pipe.finish()
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread
+
+def archive_name(path):
+    '''
+    The name given to the archive of directory path, i.e. "photos" becomes
+    "photos_TAR.cmf" (which decrypts to "photos.tar" as a plain .cmf file)
+    '''
+    return cmf_name(os.path.normpath(path) + '.tar')
+
+def encrypt_tree(src_dir, dst, key, algorithm=ALG_AES_GCM, compression=None,
+                 chunk_size=CHUNK_SIZE, workers=None, cipher=None):
+    '''
+    Encrypts the directory tree at src_dir into a single .cmf archive.  The
+    archive is a tar stream inside a regular chunked AEAD container, so
+    decrypt_file turns it back into a .tar file and decrypt_tree unpacks it.
+    list_archive and extract_member use the index stored after the tar 
+    stream.
+
+    Parameters
+    ----------
+    src_dir : string
+        The directory to archive
+    dst : string or file object
+        The path (or binary file object) the archive is written to
+    key : byte-string
+        encryption key.
+    algorithm : int, optional
+        ALG_AES_GCM (default) or ALG_CHACHA20_POLY1305
+    compression : int, optional
+        Codec the tar stream is compressed with (default=None), see
+        AESCipher.encrypt_file
+    chunk_size : int, optional
+        Number of bytes per chunk (default=CHUNK_SIZE)
+    workers : int, optional
+        Number of threads sealing chunks (default=None, one per CPU)
+    cipher : AESCipher object, optional
+        The cipher to use (default=None, a new one)
+
+    Returns
+    -------
+    None.
+
+    Raises
+    ------
+    ValueError
+        If algorithm is not an AEAD algorithm; archives are extracted as
+        they are decrypted, so every chunk has to be authenticated on its own
+    OSError
+        If a file in the tree cannot be read.  Nothing is left at dst.
+    '''
+    if algorithm == ALG_AES_CBC_HMAC:
+        raise ValueError('Archives need an AEAD algorithm')
+    if not os.path.isdir(src_dir):
+        raise NotADirectoryError(src_dir)
+    cipher = _default_cipher(cipher)
+    pipe = _Pipe()
+
+    def write_tar():
+        with _IndexingTarFile.open(fileobj=pipe, mode='w|',
+                                   bufsize=chunk_size) as tar:
+            tar.add(src_dir, arcname=os.path.basename(
+                                         os.path.normpath(src_dir)))
+        pipe.write(_pack_index(tar.index))
+
+    thread = _run_producer(pipe, write_tar)
+    try:
+        # The trailing slash marks the recorded name as a directory
+        cipher.encrypt_file(pipe, dst, key, chunk_size=chunk_size,
+                            algorithm=algorithm, workers=workers,
+                            compression=compression, 
+                            name=os.path.basename(
+                                os.path.normpath(src_dir)) + '/')
+    finally:
+        pipe.close()
+        thread.join()
+
+def decrypt_tree(src, dst_dir, key, ttl=None, workers=None, cipher=None):
+    '''
+    Authenticates, decrypts and unpacks an archive written by encrypt_tree
+    into dst_dir.  Only authenticated data reaches the disk, but if the
+    archive turns out to be damaged part way through, the files unpacked
+    before the damaged chunk are left in place.
+
+    Parameters
+    ----------
+    src : string or seekable file object
+        The path (or binary file object) of the archive
+    dst_dir : string
+        The directory the tree is unpacked into (created if needed)
+    key : byte-string
+        encryption key.
+    ttl : int, optional
+        The "time-to-live" for the archive. (Default=None)
+    workers : int, optional
+        Number of threads opening chunks (default=None, one per CPU)
+    cipher : AESCipher object, optional
+        The cipher to use (default=None, a new one)
+
+    Returns
+    -------
+    None.
+
+    Raises
+    ------
+    InvalidToken
+        If src is not an AEAD container
+    TTLError, AuthenticationFailed, DecryptionFailed
+        Same conditions as AESCipher.decrypt_file
+    NotAnArchive
+        If the container does not hold a tar archive
+    '''
+    cipher = _default_cipher(cipher)
+    with _open_stream(src, 'rb') as fin:
+        _check_aead(fin)
+        os.makedirs(dst_dir, exist_ok=True)
+        with _decrypted_tar(fin, key, cipher, ttl, workers) as tar:
+            tar.extractall(dst_dir, **_EXTRACT_FILTER)
+
+def list_archive(src, key, cipher=None):
+    '''
+    Lists the members of an archive written by encrypt_tree.  For 
+    uncompressed archives only the chunks holding the index are read and 
+    decrypted; compressed archives (and archives without an index) have to 
+    be decrypted in full.
+
+    Parameters
+    ----------
+    src : string or seekable file object
+        The path (or binary file object) of the archive
+    key : byte-string
+        encryption key.
+    cipher : AESCipher object, optional
+        The cipher to use (default=None, a new one)
+
+    Returns
+    -------
+    list of dicts
+        One dict per member, with its name, type ('file', 'dir', 'symlink' 
+        or 'other'), size, mtime and mode.  Files listed from the index 
+        also have the offset of their data in the plaintext.
+
+    Raises
+    ------
+    Same as decrypt_tree
+    '''
+    cipher = _default_cipher(cipher)
+    with _open_stream(src, 'rb') as fin:
+        index = _open_index(fin, key, cipher)[1]
+        if index is not None:
+            return index
+        
+        with _decrypted_tar(fin, key, cipher) as tar:
+            return [_member_entry(member) for member in tar]
+
+def extract_member(src, key, name, dst_dir, ttl=None, cipher=None):
+    '''
+    Extracts the single member name of an archive into dst_dir.  For 
+    uncompressed archives the index gives the position of the member, and 
+    only the chunks holding its data are read and decrypted.
+
+    Parameters
+    ----------
+    src : string or seekable file object
+        The path (or binary file object) of the archive
+    key : byte-string
+        encryption key.
+    name : string
+        The member, as given by list_archive
+    dst_dir : string
+        The directory the member is extracted into, with its path inside 
+        the archive
+    ttl : int, optional
+        The "time-to-live" for the archive. (Default=None)
+    cipher : AESCipher object, optional
+        The cipher to use (default=None, a new one)
+
+    Returns
+    -------
+    string
+        The path of the extracted file
+
+    Raises
+    ------
+    MemberNotFound
+        If the archive has no member called name
+    ValueError
+        If the member is not a regular file or directory, or its path 
+        leaves dst_dir
+    Same as decrypt_tree
+    '''
+    cipher = _default_cipher(cipher)
+    with _open_stream(src, 'rb') as fin:
+        reader, index = _open_index(fin, key, cipher)
+        if index is None:
+            with _decrypted_tar(fin, key, cipher, ttl) as tar:
+                for member in tar:
+                    if member.name == name:
+                        tar.extract(member, dst_dir, **_EXTRACT_FILTER)
+                        return _member_path(dst_dir, name)
+            raise MemberNotFound(name)
+        
+        if ttl is not None and reader.timestamp + ttl < int(time.time()):
+            raise TTLError
+        
+        entry = next((e for e in index if e['name'] == name), None)
+        if entry is None:
+            raise MemberNotFound(name)
+        path = _member_path(dst_dir, name)
+        if entry['type'] == 'dir':
+            os.makedirs(path, exist_ok=True)
+            return path
+        if entry['type'] != 'file':
+            raise ValueError('%s is a %s, only files and directories can be '
+                             'extracted on their own' % (name, entry['type']))
+        
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        reader.seek(entry['offset'])
+        with _open_output(path) as fout:
+            remaining = entry['size']
+            while remaining:
+                data = reader.read(min(remaining, CHUNK_SIZE))
+                if not data:
+                    raise InvalidToken
+                fout.write(data)
+                remaining -= len(data)
+        os.utime(path, (entry['mtime'], entry['mtime']))
+        return path
@@ -0,0 +1,1631 @@
+# -*- coding: utf-8 -*-
+"""
+cipher.py
+By Ronald Kemker
+18 Jun 2021
+
+Description: Runs AES-256 encryption
+
+"""
+
+import os, io, base64, time, struct, binascii, contextlib, collections, \
+    itertools, shutil, tempfile
+from concurrent.futures import ThreadPoolExecutor
+from cryptography.hazmat.primitives.ciphers.algorithms import AES
+from cryptography.hazmat.primitives.ciphers.modes import CBC
+from cryptography.hazmat.primitives.ciphers import Cipher
+from cryptography.hazmat.primitives.hmac import HMAC, hashes
+from cryptography.hazmat.primitives.padding import PKCS7
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM, \
+    ChaCha20Poly1305
+from cryptography.exceptions import InvalidSignature, InvalidTag
+from cryptography import utils
+
+from pierceslock.exceptions import InvalidToken, AuthenticationFailed, \
+    DecryptionFailed, UnpaddingError, TTLError
+from pierceslock.container import CHUNK_SIZE, MAX_CHUNK_SIZE, \
+    ALG_AES_CBC_HMAC, ALG_AES_GCM, ALG_CHACHA20_POLY1305, ALGORITHMS, \
+    CMF_MAGIC, CMF_VERSION, CMF_METADATA_VERSION, METADATA_NONCE, \
+    _open_stream, _open_output, _read_full, _mapped, _view_chunks, \
+    _chunk_nonce, _indexed_chunks, _rechunk, _pack_metadata, \
+    _unpack_metadata, _TokenReader, _ContainerReader, _ChunkReader, \
+    key_fingerprint
+from pierceslock.compress import CODEC_NONE, ENTROPY_SAMPLE_SIZE, \
+    is_compressible, compress_stream, decompress_stream
+from pierceslock.journal import Checkpoint, new_journal, read_journal, \
+    write_journal, reopen_output, remove_journal, source_id
+
+# AEAD chunks are handed to the worker threads in segments of about this 
+# many bytes, so the per-task overhead stays small next to the cipher work.
+SEGMENT_SIZE = 4 * 1024 * 1024
+
+def _segments(chunks, chunk_size):
+    '''
+    Groups an iterable of chunks into lists of about SEGMENT_SIZE bytes
+    '''
+    per_segment = max(1, SEGMENT_SIZE // chunk_size)
+    segment = []
+    for chunk in chunks:
+        segment.append(chunk)
+        if len(segment) == per_segment:
+            yield segment
+            segment = []
+    if segment:
+        yield segment
+
+def _parallel_map(fn, iterable, workers):
+    '''
+    Like map(fn, iterable), but runs fn in a pool of worker threads.  Results
+    are yielded in input order and at most 2 * workers items are in flight, 
+    so memory stays bounded however long iterable is.  The cipher backend 
+    releases the GIL, so the workers run on separate cores.
+    '''
+    if workers <= 1:
+        for item in iterable:
+            yield fn(item)
+        return
+    
+    pending = collections.deque()
+    with ThreadPoolExecutor(workers) as pool:
+        try:
+            for item in iterable:
+                pending.append(pool.submit(fn, item))
+                if len(pending) >= 2 * workers:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            for future in pending:
+                future.cancel()
+
+def _source_name(src, name=None):
+    '''
+    The file name recorded in the metadata of a file encrypted from src: 
+    name if given, otherwise the base name of src (or of its .name, for file
+    objects opened from a path)
+    '''
+    if name is not None:
+        return name
+    path = src if isinstance(src, (str, os.PathLike)) else \
+        getattr(src, 'name', None)
+    if isinstance(path, (str, os.PathLike)):
+        return os.path.basename(os.fspath(path))
+    return ''
+
+def _counted(items, progress, size=len):
+    '''
+    Passes items through, calling progress(size(item)) as each is taken 
+    (items itself if progress is None)
+    '''
+    if progress is None:
+        return items
+    return (progress(size(item)) or item for item in items)
+
+def _chunk_len(item):
+    '''
+    The size of the chunk in an (index, chunk, last) tuple
+    '''
+    return len(item[1])
+
+def _remaining(fileobj):
+    '''
+    The number of bytes from the current position of fileobj to its end, 
+    or None if that cannot be known without reading it (pipes, sockets)
+    '''
+    try:
+        if not fileobj.seekable():
+            return None
+        pos = fileobj.tell()
+        end = fileobj.seek(0, io.SEEK_END)
+        fileobj.seek(pos)
+        return end - pos
+    except (AttributeError, OSError, ValueError):
+        return None
+
+class AESCipher(object):
+    '''
+    AESCipher Class
+    '''
+        
+    def __init__(self, block_size=32):
+        '''
+        AESCipher Object
+        
+        Parameters
+        ----------
+        block_size : int (default=32)
+           Description 
+    
+        Attributes
+        ----------
+        block_size : int (default=32)
+           The number of bits in each block 
+        _MAX_CLOCK_SKEW : int (default=60)
+           The max time the message can be validated in (not implemented)
+           
+    
+        Returns
+        -------
+        None
+
+        '''
+        self.block_size = block_size
+        self._MAX_CLOCK_SKEW = 60
+            
+    def generate_key(self):
+        '''
+        Generates a random 256-bit key (for encryption, signing, and 
+        initialization)     
+        
+        Returns
+        -------
+        key : byte string
+            The randomly generated key
+
+        '''
+        return os.urandom(16)
+    
+    def session(self, key, signing_key=None):
+        '''
+        Returns a CipherSession for encrypting many small messages with one
+        key pair.
+
+        Parameters
+        ----------
+        key : byte-string
+            encryption key.
+        signing_key : byte-string, optional
+            authentication key. (Default=None, a random key)
+
+        Returns
+        -------
+        CipherSession object
+        '''
+        return CipherSession(key, signing_key)
+        
+    def encrypt(self, msg, key, iv = None):
+        '''
+        Performs AES-256 (CBC Mode) encryption with a given key.
+        
+
+        Parameters
+        ----------
+        msg : byte-string
+            The message that needs to be encrypted.
+        key : byte-string
+            encryption key.
+        iv : byte_string, optional
+            initialization vector (default=None)
+
+        Returns
+        -------
+        byte-string
+            Output cipher text.
+
+        '''        
+
+        # AES (Advanced Encryption Standard) is a block cipher standardized 
+        # by NIST. AES is both fast, and cryptographically strong. It is a 
+        aes = AES(key)
+        
+        # initialization_vector. Random bytes. They do not need to be kept 
+        # secret and they can be included in a transmitted message. Must be the 
+        # same number of bytes as the block_size of the cipher. Each time 
+        # something is encrypted a new initialization_vector should be 
+        # generated. Do not reuse an initialization_vector with a given key, 
+        # and particularly do not use a constant initialization_vector.
+        if not iv:
+            iv = self.generate_key()
+        
+        # CBC (Cipher Block Chaining) is a mode of operation for block ciphers. 
+        # It is considered cryptographically strong.
+        cbc = CBC(iv)
+        
+        # Padding is a way to take data that may or may not be a multiple of  
+        # the block size for a cipher and extend it out so that it is. This is 
+        # required for many block cipher modes as they require the data to be 
+        # encrypted to be an exact multiple of the block size.
+
+        # PKCS7 padding works by appending N bytes with the value of chr(N), 
+        # where N is the number of bytes required to make the final block of 
+        # data the same size as the block size.
+        padder = PKCS7(aes.block_size).padder()
+        padded_data = padder.update(msg) + padder.finalize()
+        
+        # AES encryptor using CBC mode
+        encryptor = Cipher(aes, cbc).encryptor()
+        
+        ciphertext = encryptor.update(padded_data) + encryptor.finalize()
+        
+        return ciphertext, iv
+        
+    def encode_authentication(self, ciphertext, iv, signing_key=None):
+        '''
+        Perform SHA-256 Hash-based Message Authentication on the ciphertext
+
+        Parameters
+        ----------
+        ciphertext : bytes string
+            The encrypted message
+        iv : bytes string
+            The initialization vector
+        signing_key : byte string, optional
+            authentication key. (Default=None)
+
+        Returns
+        -------
+        bytes-string
+            The authentication time, iv, ciphertext, and authentication key
+
+        '''
+        # Record time for message authentication
+        current_time = int(time.time())    
+
+        if not signing_key:
+            signing_key = self.generate_key()
+
+        # Pack the current time and initialization vector
+        header = b"\x80" + struct.pack(">Q", current_time) + iv
+        
+        # SHA-256 is a cryptographic hash function from the SHA-2 family and 
+        # is standardized by NIST. It produces a 256-bit message digest.
+        crypto_hash = hashes.SHA256()
+
+        # Hashed-based message authentication (HMAC)
+        # Tool to calculate message authentication codes using 
+        # cryptographic hash function coupled with a secret key.
+        h = HMAC(signing_key, crypto_hash)
+        h.update(header) # bytes to hash and authenticate
+        h.update(ciphertext)
+        hmac = h.finalize() # finalize current context, return msg as bytes        
+        token = b''.join((header, ciphertext, hmac))
+        return base64.urlsafe_b64encode(token), signing_key
+
+    def derive_signing_key(self, key):
+        '''
+        Derives the HMAC key of a binary .cmf container from the encryption 
+        key, so the signing key never has to be stored with the file.
+
+        Parameters
+        ----------
+        key : byte-string
+            encryption key.
+
+        Returns
+        -------
+        byte-string
+            The 32-byte signing key
+        '''
+        hkdf = HKDF(algorithm=hashes.SHA256(), length=32, salt=None, 
+                    info=b'pierceslock cmf hmac')
+        return hkdf.derive(key)
+    
+    def encrypt_file(self, src, dst, key, chunk_size=CHUNK_SIZE, 
+                     algorithm=ALG_AES_GCM, workers=None, compression=None,
+                     resumable=False, name=None, progress=None):
+        '''
+        Encrypts a file in fixed-size chunks into a binary .cmf container
+        (see CMF_MAGIC).  The file is never held in memory.
+
+        Parameters
+        ----------
+        src : string or file object
+            The path (or binary file object) of the file to encrypt
+        dst : string or file object
+            The path (or binary file object) the .cmf data is written to
+        key : byte-string
+            encryption key (32 bytes for the AEAD algorithms).
+        chunk_size : int, optional
+            Number of bytes read per step (default=CHUNK_SIZE)
+        algorithm : int, optional
+            ALG_AES_GCM (default), ALG_CHACHA20_POLY1305 or ALG_AES_CBC_HMAC
+        workers : int, optional
+            Number of threads sealing AEAD segments in parallel (default=
+            None, one per CPU).  CBC encryption is serial and ignores this.
+        compression : int, optional
+            Codec (see compress.CODECS) the plaintext is compressed with 
+            before it is encrypted (default=None, no compression).  Files 
+            whose first bytes look compressed already (JPEG, ZIP, ...) are 
+            stored uncompressed.  Needs an AEAD algorithm.
+        resumable : boolean, optional
+            Keep a checkpoint journal next to dst (see journal.py) and, if 
+            an earlier run for the same src was interrupted, continue it 
+            (default=False).  src and dst must be paths; needs an AEAD 
+            algorithm and no compression.  The partial output is kept if 
+            the job fails.
+        name : string, optional
+            The original file name recorded in the metadata of AEAD 
+            containers (default=None, the base name of src, if it has one)
+        progress : callable, optional
+            Called with the number of plaintext bytes taken from src as the
+            job advances (default=None).  Unlike a wrapper around src, this
+            keeps the mmap input path.
+
+        Returns
+        -------
+        None.
+
+        '''
+        if algorithm not in ALGORITHMS:
+            raise ValueError('Unknown algorithm %r' % algorithm)
+        if chunk_size <= 0:
+            raise ValueError('chunk_size must be positive')
+        compression = compression or CODEC_NONE
+        if compression != CODEC_NONE and algorithm == ALG_AES_CBC_HMAC:
+            raise ValueError('Compression needs an AEAD algorithm')
+        
+        # Regular files are read through mmap and fed to the cipher as 
+        # memoryview slices, so the plaintext is never copied into Python 
+        # objects.  Anything else (pipes, BytesIO, ...) is read in chunks.
+        if resumable:
+            if algorithm == ALG_AES_CBC_HMAC or compression != CODEC_NONE:
+                raise ValueError('Resumable encryption needs an uncompressed'
+                                 ' AEAD container')
+            return self._encrypt_resumable(src, dst, key, chunk_size, 
+                                           algorithm, workers, name, progress)
+        
+        with _open_stream(src, 'rb') as fin, _mapped(fin) as view, \
+                _open_output(dst) as fout:
+            if algorithm == ALG_AES_CBC_HMAC:
+                self._encrypt_cbc_stream(fin, fout, key, chunk_size, view,
+                                         progress)
+            else:
+                self._encrypt_aead_stream(fin, fout, key, chunk_size, 
+                                          algorithm, workers, view, 
+                                          compression, _source_name(src, name),
+                                          progress)
+    
+    def _encrypt_cbc_stream(self, fin, fout, key, chunk_size, view=None,
+                            progress=None):
+        '''
+        Writes a version 1 (AES-256-CBC + HMAC-SHA256) container.  The 
+        ciphertext goes into one preallocated buffer via update_into.
+        '''
+        iv = self.generate_key()
+        
+        encryptor = Cipher(AES(key), CBC(iv)).encryptor()
+        h = HMAC(self.derive_signing_key(key), hashes.SHA256())
+        
+        header = (CMF_MAGIC + bytes([CMF_VERSION]) + 
+                  struct.pack(">Q", int(time.time())) + iv)
+        h.update(header)
+        fout.write(header)
+        
+        if view is not None:
+            chunks = (view[i:i+chunk_size] 
+                      for i in range(0, len(view), chunk_size))
+        else:
+            chunks = iter(lambda: fin.read(chunk_size), b'')
+        chunks = _counted(chunks, progress)
+        
+        # Room for a whole chunk or the padding, plus the partial block the
+        # encryptor may be holding
+        block = AES.block_size // 8
+        out = bytearray(max(chunk_size, block) + block - 1)
+        total = 0
+        for chunk in chunks:
+            total += len(chunk)
+            n = encryptor.update_into(chunk, out)
+            h.update(memoryview(out)[:n])
+            fout.write(memoryview(out)[:n])
+        
+        # PKCS7: the encryptor keeps the trailing partial block, so only the
+        # padding bytes themselves have to be added
+        pad = block - total % block
+        n = encryptor.update_into(bytes([pad]) * pad, out)
+        encryptor.finalize()
+        h.update(memoryview(out)[:n])
+        fout.write(memoryview(out)[:n])
+        fout.write(h.finalize())
+        
+    def _encrypt_aead_stream(self, fin, fout, key, chunk_size, algorithm,
+                             workers=None, view=None, codec=CODEC_NONE,
+                             name='', progress=None):
+        '''
+        Writes a version 4 (chunked AEAD with metadata) container.
+        '''
+        size = len(view) if view is not None else _remaining(fin)
+        if not 0 < chunk_size <= MAX_CHUNK_SIZE:
+            raise ValueError('chunk_size must be in (0, %d]' % MAX_CHUNK_SIZE)
+        
+        pieces = None
+        if codec != CODEC_NONE:
+            # Look at the start of the data before committing to the codec
+            if view is not None:
+                sample = view[:ENTROPY_SAMPLE_SIZE]
+                pieces = (view[i:i+chunk_size] 
+                          for i in range(0, len(view), chunk_size))
+            else:
+                sample = _read_full(fin, ENTROPY_SAMPLE_SIZE)
+                pieces = itertools.chain([sample], 
+                                         iter(lambda: fin.read(chunk_size), 
+                                              b''))
+            if not is_compressible(sample):
+                codec = CODEC_NONE
+        
+        if codec != CODEC_NONE:
+            chunks = _rechunk(compress_stream(_counted(pieces, progress), 
+                                              codec), chunk_size)
+        elif view is not None:
+            chunks = _counted(_view_chunks(view, chunk_size), progress, 
+                              _chunk_len)
+        elif pieces is not None:
+            # The sample has already been read from fin
+            chunks = _rechunk(_counted(pieces, progress), chunk_size)
+        else:
+            chunks = _counted(_indexed_chunks(fin, chunk_size), progress, 
+                              _chunk_len)
+        
+        header, metadata, aead = self._aead_header(algorithm, key, chunk_size,
+                                                   codec, name, size)
+        fout.write(header + metadata)
+        
+        def seal(segment):
+            return [aead.encrypt(_chunk_nonce(index, last), chunk, header)
+                    for index, chunk, last in segment]
+        
+        segments = _segments(chunks, chunk_size)
+        for sealed in _parallel_map(seal, segments, workers or os.cpu_count()):
+            fout.writelines(sealed)
+    
+    def _aead_header(self, algorithm, key, chunk_size, codec=CODEC_NONE,
+                     name='', size=None):
+        '''
+        A new version 4 header with a fresh salt (the last 16 bytes of the 
+        header)
+        
+        Returns
+        -------
+        header : byte-string
+            The header, i.e. the associated data of every chunk
+        metadata : byte-string
+            The sealed metadata block that follows it
+        aead : AESGCM or ChaCha20Poly1305 object
+            The file's AEAD object
+        '''
+        salt = os.urandom(16)
+        header = (CMF_MAGIC + 
+                  struct.pack(">BBBIQ", CMF_METADATA_VERSION, algorithm, 
+                              codec, chunk_size, int(time.time())) + 
+                  key_fingerprint(key) + salt)
+        aead = self.aead_engine(algorithm, key, salt)
+        metadata = aead.encrypt(METADATA_NONCE, _pack_metadata(name, size), 
+                                header)
+        return header, metadata, aead
+    
+    def _open_metadata(self, reader, aead):
+        '''
+        Authenticates the metadata of a version 4 container
+        
+        Returns
+        -------
+        name : string or None
+            The original file name (None for older containers)
+        size : int or None
+            The plaintext size (None if unknown or for older containers)
+        
+        Raises
+        ------
+        AuthenticationFailed
+            If the metadata block has been tampered with
+        '''
+        if reader.metadata is None:
+            return None, None
+        try:
+            return _unpack_metadata(aead.decrypt(METADATA_NONCE, 
+                                                 reader.metadata, 
+                                                 reader.header))
+        except InvalidTag:
+            raise AuthenticationFailed
+    
+    def _encrypt_resumable(self, src, dst, key, chunk_size, algorithm, 
+                           workers=None, name=None, progress=None):
+        '''
+        Writes a version 4 container like _encrypt_aead_stream, recording 
+        checkpoints in a journal next to dst.  If dst already has a journal 
+        for the same input, settings and key, the job continues after the 
+        last checkpoint instead of starting over.
+        '''
+        if not 0 < chunk_size <= MAX_CHUNK_SIZE:
+            raise ValueError('chunk_size must be in (0, %d]' % MAX_CHUNK_SIZE)
+        
+        with open(src, 'rb') as fin, _mapped(fin) as view:
+            source = source_id(fin)
+            state = read_journal(dst)
+            fout = None
+            if (state is not None and state['mode'] == 'encrypt' and
+                    state['source'] == source):
+                # The journal holds the header and the sealed metadata
+                reader = _ChunkReader(io.BytesIO(
+                    bytes.fromhex(state['header'])))
+                reader.read_header()
+                # A run interrupted under another key starts over; its 
+                # chunks could not be opened with this one
+                if (reader.algorithm == algorithm and 
+                        reader.chunk_size == chunk_size and
+                        reader.fingerprint == key_fingerprint(key)):
+                    fout = reopen_output(dst, state)
+                    header = reader.header
+                    aead = self.aead_engine(algorithm, key, reader.salt)
+            
+            if fout is None:
+                header, metadata, aead = self._aead_header(
+                    algorithm, key, chunk_size, CODEC_NONE, 
+                    _source_name(src, name), source[0])
+                fout = open(dst, 'wb')
+                fout.write(header + metadata)
+                state = new_journal('encrypt', source, header + metadata, 
+                                    header + metadata)
+            
+            with fout:
+                start = state['chunks']
+                if view is not None:
+                    chunks = _view_chunks(view[start*chunk_size:], chunk_size,
+                                          start)
+                else:
+                    fin.seek(start * chunk_size)
+                    chunks = _indexed_chunks(fin, chunk_size, start)
+                if progress is not None and start:
+                    progress(min(start * chunk_size, source[0]))
+                chunks = _counted(chunks, progress, _chunk_len)
+                
+                def seal(segment):
+                    index, _, last = segment[-1]
+                    return index, last, [aead.encrypt(_chunk_nonce(i, l), 
+                                                      chunk, header)
+                                         for i, chunk, l in segment]
+                
+                checkpoint = Checkpoint(dst, fout, state)
+                segments = _segments(chunks, chunk_size)
+                for index, last, sealed in _parallel_map(
+                        seal, segments, workers or os.cpu_count()):
+                    fout.writelines(sealed)
+                    # The journal never covers the last chunk, the job is 
+                    # finished once that is written
+                    if not last:
+                        checkpoint.update(index + 1, sum(map(len, sealed)),
+                                          sealed[-1])
+        remove_journal(dst)
+    
+    def encrypt_in_place(self, src, key, dst=None, chunk_size=CHUNK_SIZE,
+                         algorithm=ALG_AES_GCM, wipe=False):
+        '''
+        Encrypts a file into a version 4 container without a second copy 
+        of it: the file is extended by the container overhead and rewritten
+        from the end, one segment (SEGMENT_SIZE bytes) at a time.  Each 
+        segment's plaintext is kept in a journal next to the file until its
+        ciphertext is on disk, so an interrupted run is finished by calling
+        encrypt_in_place again with the same arguments.  The extra disk 
+        space needed is about one segment (two while the journal is being 
+        replaced).
+
+        Parameters
+        ----------
+        src : string
+            The path of the file to encrypt
+        key : byte-string
+            encryption key (32 bytes).
+        dst : string, optional
+            The file is renamed to this before it is rewritten (default=
+            None, keep the name src)
+        chunk_size : int, optional
+            Number of bytes per chunk (default=CHUNK_SIZE)
+        algorithm : int, optional
+            ALG_AES_GCM (default) or ALG_CHACHA20_POLY1305
+        wipe : boolean, optional
+            Overwrite every journal with zeros before it is replaced or 
+            removed, so no copy of the plaintext is left in free space 
+            (default=False).  The file itself is overwritten completely by 
+            the ciphertext, which is longer than the plaintext.
+
+        Returns
+        -------
+        None.
+        '''
+        if algorithm == ALG_AES_CBC_HMAC:
+            raise ValueError('In-place encryption needs an AEAD algorithm')
+        if not 0 < chunk_size <= MAX_CHUNK_SIZE:
+            raise ValueError('chunk_size must be in (0, %d]' % MAX_CHUNK_SIZE)
+        dst = src if dst is None else dst
+        
+        state, payload = read_journal(dst, payload=True)
+        if state is None or state['mode'] != 'in-place':
+            size = os.path.getsize(src)
+            header, metadata, aead = self._aead_header(
+                algorithm, key, chunk_size, CODEC_NONE, _source_name(src), 
+                size)
+            state = {'mode' : 'in-place',
+                     'header' : (header + metadata).hex(),
+                     'size' : size,
+                     # Chunks from here on are encrypted and on disk
+                     'done' : max(1, -(-size // chunk_size)),
+                     # First chunk of the segment held in the journal
+                     'pending' : None}
+            write_journal(dst, state)
+        else:
+            reader = _ChunkReader(io.BytesIO(bytes.fromhex(state['header'])))
+            reader.read_header()
+            if reader.fingerprint != key_fingerprint(key):
+                raise ValueError('The interrupted run used another key')
+            header = reader.header
+            metadata = reader.metadata
+            aead = self.aead_engine(reader.algorithm, key, reader.salt)
+            chunk_size = reader.chunk_size
+            size = state['size']
+        # The rename is the first change made to the file
+        if dst != src and os.path.exists(src):
+            os.replace(src, dst)
+        
+        count = max(1, -(-size // chunk_size))
+        total = len(header) + len(metadata) + size + 16 * count
+        if os.path.getsize(dst) < total:
+            os.truncate(dst, total)
+        per_segment = max(1, SEGMENT_SIZE // chunk_size)
+        
+        with open(dst, 'r+b') as f:
+            def rewrite(start, end, plaintext):
+                '''
+                Writes the ciphertext of chunks start to end (exclusive)
+                '''
+                f.seek(len(header) + len(metadata) + start * (chunk_size + 16))
+                f.writelines(aead.encrypt(_chunk_nonce(i, i == count - 1),
+                                          plaintext[(i - start) * chunk_size:
+                                                    (i - start + 1) * 
+                                                    chunk_size], header)
+                             for i in range(start, end))
+                if start == 0:
+                    f.seek(0)
+                    f.write(header + metadata)
+                f.flush()
+                os.fsync(f.fileno())
+            
+            done = state['done']
+            if state['pending'] is not None:
+                # Interrupted while this segment was being written
+                rewrite(state['pending'], done, payload)
+                done = state['pending']
+            
+            # Going from the end, the ciphertext of a segment only ever 
+            # lands on plaintext that has already been read
+            while done > 0:
+                start = max(0, done - per_segment)
+                f.seek(start * chunk_size)
+                plaintext = _read_full(f, min(done * chunk_size, size) - 
+                                          start * chunk_size)
+                state.update(done=done, pending=start)
+                write_journal(dst, state, plaintext, wipe)
+                rewrite(start, done, plaintext)
+                done = start
+        remove_journal(dst, wipe)
+    
+    def aead_engine(self, algorithm, key, salt):
+        '''
+        Builds the AEAD object for one version 2 container.  Every file gets
+        its own key, derived from the encryption key and the file's salt.
+
+        Parameters
+        ----------
+        algorithm : int
+            ALG_AES_GCM or ALG_CHACHA20_POLY1305
+        key : byte-string
+            encryption key.
+        salt : byte-string
+            The random salt stored in the container header
+
+        Returns
+        -------
+        AESGCM or ChaCha20Poly1305 object
+
+        Raises
+        ------
+        InvalidToken
+            If the algorithm is not an AEAD algorithm
+        '''
+        if algorithm == ALG_AES_GCM:
+            engine = AESGCM
+        elif algorithm == ALG_CHACHA20_POLY1305:
+            engine = ChaCha20Poly1305
+        else:
+            raise InvalidToken
+        
+        hkdf = HKDF(algorithm=hashes.SHA256(), length=32, salt=salt,
+                    info=b'pierceslock cmf aead' + bytes([algorithm]))
+        return engine(hkdf.derive(key))
+    
+    def decrypt_file(self, src, dst, key, ttl=None, chunk_size=CHUNK_SIZE,
+                     workers=None, resumable=False, progress=None):
+        '''
+        Authenticates and decrypts a .cmf file in fixed-size chunks.  All 
+        container versions and the older signing key + base64 token layout 
+        are accepted.  The file is read once; plaintext is written as it is 
+        decrypted and removed again if authentication fails.  dst may be a
+        pipe: AEAD chunks are written once they are authenticated, older 
+        containers only after the whole file is.
+
+        Parameters
+        ----------
+        src : string or file object
+            The path (or binary file object) of the .cmf file
+        dst : string or file object
+            The path (or binary file object) the plaintext is written to
+        key : byte-string
+            encryption key.
+        ttl : int, optional
+            The "time-to-live" for a given message. (Default=None)  
+        chunk_size : int, optional
+            Number of bytes read per step (default=CHUNK_SIZE).  AEAD 
+            containers use the chunk size recorded in their header.
+        workers : int, optional
+            Number of threads opening AEAD segments in parallel (default=
+            None, one per CPU).
+        resumable : boolean, optional
+            Same as for encrypt_file (default=False).  Only uncompressed 
+            version 2 containers can be resumed, others are decrypted as 
+            usual.  The partial output is kept if the job is interrupted, 
+            but still removed if authentication fails.
+        progress : callable, optional
+            Called with the number of ciphertext bytes taken from src as 
+            the job advances (default=None), see encrypt_file
+
+        Returns
+        -------
+        None.
+
+        Raises
+        ------
+        InvalidToken, TTLError, AuthenticationFailed, DecryptionFailed, 
+        UnpaddingError
+            Same conditions as authenticate and decrypt
+        '''
+        with _open_stream(src, 'rb') as fin:
+            reader, signing_key = self._open_reader(fin, key, chunk_size)
+            timestamp = reader.read_header()[0]
+            
+            if ttl is not None:
+                if timestamp + ttl < int(time.time()):
+                    raise TTLError
+            
+            if (resumable and isinstance(reader, _ChunkReader) and 
+                    reader.codec == CODEC_NONE):
+                return self._decrypt_resumable(reader, fin, dst, key, workers,
+                                               progress)
+            
+            if reader.mappable:
+                mapping = _mapped(fin)
+            else:
+                mapping = contextlib.nullcontext()
+            with mapping as view, _open_output(dst) as fout:
+                reader.view = view
+                if isinstance(reader, _ChunkReader):
+                    self._decrypt_aead_stream(reader, fout, key, workers,
+                                              progress)
+                elif fout.seekable():
+                    self._decrypt_cbc_stream(reader, fout, key, signing_key,
+                                             progress)
+                else:
+                    # One signature covers the whole file and plaintext sent
+                    # down a pipe cannot be taken back, so hold it until the
+                    # signature has been checked
+                    with tempfile.TemporaryFile() as spool:
+                        self._decrypt_cbc_stream(reader, spool, key, 
+                                                 signing_key, progress)
+                        spool.seek(0)
+                        shutil.copyfileobj(spool, fout, SEGMENT_SIZE)
+    
+    def decrypt_chunks(self, src, key, ttl=None, chunk_size=CHUNK_SIZE,
+                       workers=None):
+        '''
+        Authenticates and decrypts a .cmf file like decrypt_file, but yields
+        the plaintext instead of writing it.  In AEAD containers every chunk
+        has its own tag, so the plaintext of each segment (SEGMENT_SIZE 
+        bytes of chunks) is yielded as soon as its chunks verify, and 
+        iteration stops with AuthenticationFailed at the first bad chunk; 
+        everything yielded before it is genuine.  Version 1 
+        containers and tokens are only authenticated at their end, so their
+        plaintext is held in a temporary file until then.
+
+        Parameters
+        ----------
+        src : string or file object
+            The path (or binary file object) of the .cmf file
+        key : byte-string
+            encryption key.
+        ttl : int, optional
+            The "time-to-live" for a given message. (Default=None)  
+        chunk_size : int, optional
+            Number of bytes read per step (default=CHUNK_SIZE)
+        workers : int, optional
+            Number of threads opening AEAD segments in parallel (default=
+            None, one per CPU).
+
+        Yields
+        ------
+        byte-string
+            The plaintext, in order
+
+        Raises
+        ------
+        InvalidToken, TTLError, AuthenticationFailed, DecryptionFailed, 
+        UnpaddingError
+            Same conditions as decrypt_file
+        '''
+        with _open_stream(src, 'rb') as fin:
+            reader, signing_key = self._open_reader(fin, key, chunk_size)
+            timestamp = reader.read_header()[0]
+            
+            if ttl is not None:
+                if timestamp + ttl < int(time.time()):
+                    raise TTLError
+            
+            if reader.mappable:
+                mapping = _mapped(fin)
+            else:
+                mapping = contextlib.nullcontext()
+            with mapping as view:
+                reader.view = view
+                if isinstance(reader, _ChunkReader):
+                    yield from self._aead_plaintext(reader, key, workers)
+                    return
+                with tempfile.TemporaryFile() as spool:
+                    self._decrypt_cbc_stream(reader, spool, key, signing_key)
+                    spool.seek(0)
+                    yield from iter(lambda: spool.read(SEGMENT_SIZE), b'')
+                    
+    def verify_file(self, src, key, ttl=None, chunk_size=CHUNK_SIZE,
+                    workers=None):
+        '''
+        Checks that a .cmf file is intact without writing or keeping any 
+        plaintext.  Version 1 containers and tokens only have their HMAC 
+        computed (no decryption, no unpadding).  AEAD tags can only be 
+        checked by opening the chunks, so each chunk is decrypted and 
+        dropped straight away; compressed data is not decompressed.
+
+        Parameters
+        ----------
+        src : string or file object
+            The path (or binary file object) of the .cmf file
+        key : byte-string
+            encryption key.
+        ttl : int, optional
+            The "time-to-live" for a given message. (Default=None)  
+        chunk_size : int, optional
+            Number of bytes read per step (default=CHUNK_SIZE)
+        workers : int, optional
+            Number of threads opening AEAD segments in parallel (default=
+            None, one per CPU).
+
+        Returns
+        -------
+        None.
+
+        Raises
+        ------
+        InvalidToken, TTLError, AuthenticationFailed
+            Same conditions as authenticate
+        '''
+        with _open_stream(src, 'rb') as fin:
+            reader, signing_key = self._open_reader(fin, key, chunk_size)
+            timestamp = reader.read_header()[0]
+            
+            if ttl is not None:
+                if timestamp + ttl < int(time.time()):
+                    raise TTLError
+            
+            if reader.mappable:
+                mapping = _mapped(fin)
+            else:
+                mapping = contextlib.nullcontext()
+            with mapping as view:
+                reader.view = view
+                if not isinstance(reader, _ChunkReader):
+                    h = HMAC(signing_key, hashes.SHA256())
+                    h.update(reader.header)
+                    for ciphertext in reader:
+                        h.update(ciphertext)
+                    try:
+                        h.verify(reader.signature)
+                    except InvalidSignature:
+                        raise AuthenticationFailed
+                    return
+                
+                aead = self.aead_engine(reader.algorithm, key, reader.salt)
+                self._open_metadata(reader, aead)
+                
+                def check_segment(segment):
+                    try:
+                        for index, sealed, last in segment:
+                            aead.decrypt(_chunk_nonce(index, last), sealed, 
+                                         reader.header)
+                    except InvalidTag:
+                        raise AuthenticationFailed
+                
+                segments = _segments(reader, reader.chunk_size)
+                for _ in _parallel_map(check_segment, segments, 
+                                       workers or os.cpu_count()):
+                    pass
+    
+    def stat_file(self, src, key=None):
+        '''
+        Describes a .cmf file from its header alone, without reading the 
+        ciphertext.  The name and plaintext size are sealed, so they need 
+        the key and are only known for version 4 containers.
+
+        Parameters
+        ----------
+        src : string or file object
+            The path (or binary file object) of the .cmf file
+        key : byte-string, optional
+            encryption key (default=None, only report what the header 
+            shows in the clear)
+
+        Returns
+        -------
+        dict
+            version (0 for the older token layout), algorithm, codec, 
+            chunk_size (None for version 1), timestamp, fingerprint (hex, 
+            version 4 only), name and size (None if not known) and 
+            verified (True if the metadata has been authenticated)
+
+        Raises
+        ------
+        InvalidToken
+            If src is not a .cmf file
+        AuthenticationFailed
+            If the file was encrypted with another key or its metadata has 
+            been tampered with
+        '''
+        with _open_stream(src, 'rb') as fin:
+            # Token readers decode as little as possible with a small chunk
+            reader = self._open_reader(fin, b'', 64)[0]
+            reader.read_header()
+        
+        info = {'version' : 0, 
+                'algorithm' : ALG_AES_CBC_HMAC, 
+                'codec' : CODEC_NONE,
+                'chunk_size' : None, 
+                'timestamp' : reader.timestamp,
+                'fingerprint' : None,
+                'name' : None,
+                'size' : None,
+                'verified' : False}
+        if isinstance(reader, _ContainerReader):
+            info['version'] = CMF_VERSION
+        if not isinstance(reader, _ChunkReader):
+            return info
+        
+        info.update(version=reader.version, algorithm=reader.algorithm,
+                    codec=reader.codec, chunk_size=reader.chunk_size)
+        if reader.fingerprint is not None:
+            info['fingerprint'] = reader.fingerprint.hex()
+            if key is not None:
+                if reader.fingerprint != key_fingerprint(key):
+                    raise AuthenticationFailed
+                aead = self.aead_engine(reader.algorithm, key, reader.salt)
+                name, size = self._open_metadata(reader, aead)
+                info.update(name=name, size=size, verified=True)
+        return info
+    
+    def _decrypt_cbc_stream(self, reader, fout, key, signing_key, 
+                            progress=None):
+        '''
+        Decrypts a version 1 container or a legacy token.  Each ciphertext 
+        chunk is authenticated and decrypted as it is read; the caller 
+        discards the output if the signature does not match.  
+        
+        Plaintext is decrypted into a reusable buffer with update_into.  The 
+        last plaintext block is held back, since it carries the padding.
+        '''
+        h = HMAC(signing_key, hashes.SHA256())
+        h.update(reader.header)
+        decryptor = Cipher(AES(key), CBC(reader.iv)).decryptor()
+        block = AES.block_size // 8
+        out = bytearray(0)
+        held = b''
+        
+        for ciphertext in _counted(reader, progress):
+            h.update(ciphertext)
+            if len(out) < len(ciphertext) + block - 1:
+                out = bytearray(len(ciphertext) + block - 1)
+            n = decryptor.update_into(ciphertext, out)
+            if n:
+                fout.write(held)
+                fout.write(memoryview(out)[:n-block])
+                held = bytes(out[n-block:n])
+        try:
+            h.verify(reader.signature)
+        except InvalidSignature:
+            raise AuthenticationFailed
+        try:
+            plaintext_padded = held + decryptor.finalize()
+        except ValueError:
+            raise DecryptionFailed
+        
+        unpadder = PKCS7(AES.block_size).unpadder()
+        try:
+            fout.write(unpadder.update(plaintext_padded))
+            fout.write(unpadder.finalize())
+        except ValueError:
+            raise UnpaddingError
+    
+    def _decrypt_aead_stream(self, reader, fout, key, workers=None, 
+                             progress=None):
+        '''
+        Decrypts a version 2, 3 or 4 container into fout
+        '''
+        fout.writelines(self._aead_plaintext(reader, key, workers, progress))
+    
+    def _aead_plaintext(self, reader, key, workers=None, progress=None):
+        '''
+        Yields the plaintext of a version 2, 3 or 4 container, decrypted 
+        segment by segment and stopping at the first chunk whose tag does 
+        not verify.
+        '''
+        aead = self.aead_engine(reader.algorithm, key, reader.salt)
+        self._open_metadata(reader, aead)
+        
+        def open_segment(segment):
+            try:
+                return [aead.decrypt(_chunk_nonce(index, last), sealed, 
+                                     reader.header)
+                        for index, sealed, last in segment]
+            except InvalidTag:
+                raise AuthenticationFailed
+        
+        segments = _segments(_counted(reader, progress, _chunk_len), 
+                             reader.chunk_size)
+        plaintexts = _parallel_map(open_segment, segments, 
+                                   workers or os.cpu_count())
+        pieces = itertools.chain.from_iterable(plaintexts)
+        if reader.codec == CODEC_NONE:
+            yield from pieces
+            return
+        
+        try:
+            yield from decompress_stream(pieces, reader.codec)
+        except ValueError:
+            raise DecryptionFailed
+    
+    def _decrypt_resumable(self, reader, fin, dst, key, workers=None, 
+                           progress=None):
+        '''
+        Decrypts an uncompressed version 2 or 4 container like 
+        _decrypt_aead_stream, recording
+        checkpoints in a journal next to dst (see _encrypt_resumable).
+        '''
+        source = source_id(fin)
+        start = fin.tell() - reader.header_size
+        state = read_journal(dst)
+        fout = None
+        if (state is not None and state['mode'] == 'decrypt' and 
+                state['source'] == source and 
+                state['header'] == reader.header.hex()):
+            fout = reopen_output(dst, state)
+        if fout is None:
+            fout = open(dst, 'wb')
+            state = new_journal('decrypt', source, reader.header, b'')
+        
+        with fout:
+            reader.first_chunk = state['chunks']
+            fin.seek(start + reader.header_size + 
+                     reader.first_chunk * (reader.chunk_size + 16))
+            aead = self.aead_engine(reader.algorithm, key, reader.salt)
+            self._open_metadata(reader, aead)
+            
+            def open_segment(segment):
+                index, _, last = segment[-1]
+                try:
+                    return index, last, [aead.decrypt(_chunk_nonce(i, l), 
+                                                      sealed, reader.header)
+                                         for i, sealed, l in segment]
+                except InvalidTag:
+                    raise AuthenticationFailed
+            
+            checkpoint = Checkpoint(dst, fout, state)
+            try:
+                if progress is not None and reader.first_chunk:
+                    progress(reader.first_chunk * (reader.chunk_size + 16))
+                with _mapped(fin) as view:
+                    reader.view = view
+                    segments = _segments(_counted(reader, progress, 
+                                                  _chunk_len), 
+                                         reader.chunk_size)
+                    for index, last, plaintext in _parallel_map(
+                            open_segment, segments, workers or os.cpu_count()):
+                        fout.writelines(plaintext)
+                        if not last:
+                            checkpoint.update(index + 1, 
+                                              sum(map(len, plaintext)),
+                                              plaintext[-1])
+            except AuthenticationFailed:
+                # Starting over will not help, the input is damaged
+                fout.close()
+                os.remove(dst)
+                remove_journal(dst)
+                raise
+        remove_journal(dst)
+    
+    def _open_reader(self, fin, key, chunk_size):
+        '''
+        Detects the layout of the .cmf data in fin and returns a reader for it
+        along with the matching signing key (None for AEAD containers).
+        '''
+        magic = fin.read(len(CMF_MAGIC) + 1)
+        if magic[:-1] == CMF_MAGIC:
+            if magic[-1] in _ChunkReader.header_sizes:
+                return _ChunkReader(fin, prefix=magic), None
+            reader = _ContainerReader(fin, chunk_size, prefix=magic)
+            return reader, self.derive_signing_key(key)
+        
+        signing_key = magic + fin.read(16 - len(magic))
+        return _TokenReader(fin, chunk_size), signing_key
+            
+    def decrypt(self, ciphertext, key, iv):
+        '''
+        Performs AES-256 (CBC Mode) decryption with a given key and 
+        Hashed-based message authentication (HMAC).
+        
+        Parameters
+        ----------
+        ciphertext : byte string
+            The encrypted message
+        key : byte-string
+            encryption key.
+        iv : byte string
+            initialization vector 
+            
+        Returns
+        -------
+        deciphertext : byte string
+            The decrypted and unpadded message
+        
+        Raises
+        ------
+        InvalidToken Exception : 
+            raises if any part of the decrpytion process is interrupted, 
+            including: 
+                - Error with decryption
+                - Error with unpadding
+
+        '''
+        
+        # Initialize AES object with encryption key
+        aes = AES(key)
+        
+        # CBC (Cipher Block Chaining) is a mode of operation for block ciphers. 
+        # It is considered cryptographically strong.
+        cbc = CBC(iv)
+
+        # AES decryption using CBC mode
+        decryptor = Cipher(aes, cbc).decryptor()
+        plaintext_padded = decryptor.update(ciphertext)
+        try:
+            plaintext_padded += decryptor.finalize()
+        except ValueError:
+            raise DecryptionFailed
+        
+        # Unpadding the plain text
+        unpadder = PKCS7(aes.block_size).unpadder()
+
+        unpadded = unpadder.update(plaintext_padded)
+        try:
+            unpadded += unpadder.finalize()
+        except ValueError:
+            raise UnpaddingError
+        return unpadded
+
+    def authenticate(self, ciphertext, signing_key, ttl=None):
+        '''
+        Authenticate transmitted message
+        
+        Parameters
+        ----------
+        ciphertext : byte string
+            The encrypted message
+        signing_key : byte string
+            authentication key.
+        ttl : int, optional
+            The "time-to-live" for a given message. (Default=None)  
+            TODO: This needs to be intergrated somehow with the current app
+            
+        Returns
+        -------
+        ciphertext : memoryview
+            The encrypted message (a view into the decoded token)
+        iv : byte string
+            initialization vector        
+        
+        Raises
+        ------
+        InvalidToken Exception : 
+            raises if any part of the decrpytion process is interrupted, 
+            including: 
+                - ttl has expired
+                - Message is not authentic
+
+        '''
+        
+        # Split file into timestamp and data and encrpyted message
+        timestamp, data = self._get_unverified_token_data(ciphertext)
+
+        # Get current timestamp for message authentication
+        current_time = int(time.time())
+        
+        # If defined, validate message delivery is within time-to-live
+        if ttl is not None:
+            if timestamp + ttl < current_time:
+                raise TTLError
+
+        # TODO: Consider re-adding this if it makes sense            
+        # # If message took longer than _MAX_CLOCK_SKEW seconds to arrive
+        # if current_time + self._MAX_CLOCK_SKEW < timestamp:
+        #     raise InvalidToken
+
+        # SHA-256 is a cryptographic hash function from the SHA-2 family  
+        # and is standardized by NIST. It produces a 256-bit message 
+        # digest.
+        crypto_hash = hashes.SHA256()
+
+        # Hashed-based message authentication (HMAC)
+        # Tool to calculate message authentication codes using 
+        # cryptographic hash function coupled with a secret key.
+        # memoryview slices share the decoded token instead of copying it
+        view = memoryview(data)
+        h = HMAC(signing_key, crypto_hash)
+        h.update(view[:-32]) # Grab the signing key
+        
+        # Authenticate message to make sure it has not been tampered with
+        try:
+            h.verify(data[-32:])
+        except InvalidSignature:
+            raise AuthenticationFailed                
+
+        # Extract initialization vector
+        iv = data[9:25]
+        # Extract encrypted message
+        ciphertext = view[25:-32] 
+        
+        return ciphertext, iv
+        
+    def _get_unverified_token_data(self, token):
+        '''
+        This breaks up the ciphertext into timestamp and "other" data for
+        validating against ttl
+
+        Parameters
+        ----------
+        token : byte-string
+            This it the raw ciphertext data
+
+        Raises
+        ------
+        InvalidToken
+            If not properly formatted
+
+        Returns
+        -------
+        timestamp : byte-string
+            Time that the message was encrypted.
+        data : byte-string
+            The initialization_vector, ciphertext, and signature key (in order) 
+
+        '''
+        utils._check_bytes("token", token)
+        try:
+            data = base64.urlsafe_b64decode(token)
+        except (TypeError, binascii.Error):
+            raise InvalidToken
+
+        if not data or data[0] != 0x80:
+            raise InvalidToken
+
+        try:
+            (timestamp,) = struct.unpack(">Q", data[1:9])
+        except struct.error:
+            raise InvalidToken
+        return timestamp, data
+
+class CipherSession(object):
+    '''
+    Encrypts and decrypts many small messages with one key pair.  The tokens
+    are the same as AESCipher.encrypt + encode_authentication produce, but
+    the key objects and the keyed HMAC context are built once per session 
+    rather than once per message.
+    '''
+    
+    def __init__(self, key, signing_key=None):
+        '''
+        Parameters
+        ----------
+        key : byte-string
+            encryption key.
+        signing_key : byte-string, optional
+            authentication key. (Default=None, a random 16-byte key)
+        
+        Attributes
+        ----------
+        key : byte-string
+            encryption key.
+        signing_key : byte-string
+            authentication key.
+        '''
+        self.key = key
+        self.signing_key = signing_key or os.urandom(16)
+        
+        # Validates the key once; AES objects are immutable and reusable
+        self._aes = AES(key)
+        # Keyed HMAC context, copied for every message
+        self._hmac = HMAC(self.signing_key, hashes.SHA256())
+        self._block = AES.block_size // 8
+
+    def encrypt(self, msg, timestamp=None):
+        '''
+        Encrypts and signs one message
+
+        Parameters
+        ----------
+        msg : byte-string
+            The message that needs to be encrypted.
+        timestamp : int, optional
+            The time recorded in the token (default=None, now)
+
+        Returns
+        -------
+        byte-string
+            The base64 token
+        '''
+        if timestamp is None:
+            timestamp = int(time.time())
+        iv = os.urandom(16)
+        pad = self._block - len(msg) % self._block
+        
+        encryptor = Cipher(self._aes, CBC(iv)).encryptor()
+        ciphertext = (encryptor.update(msg) + 
+                      encryptor.update(bytes([pad]) * pad))
+        
+        header = b"\x80" + struct.pack(">Q", timestamp) + iv
+        h = self._hmac.copy()
+        h.update(header)
+        h.update(ciphertext)
+        return base64.urlsafe_b64encode(header + ciphertext + h.finalize())
+    
+    def decrypt(self, token, ttl=None):
+        '''
+        Authenticates and decrypts one token
+
+        Parameters
+        ----------
+        token : byte-string
+            The base64 token
+        ttl : int, optional
+            The "time-to-live" for a given message. (Default=None)  
+
+        Returns
+        -------
+        byte-string
+            The decrypted and unpadded message
+        
+        Raises
+        ------
+        InvalidToken, TTLError, AuthenticationFailed, DecryptionFailed, 
+        UnpaddingError
+            Same conditions as AESCipher.authenticate and decrypt
+        '''
+        try:
+            data = base64.urlsafe_b64decode(token)
+        except (TypeError, binascii.Error):
+            raise InvalidToken
+        if len(data) < 57 or data[0] != 0x80:
+            raise InvalidToken
+        
+        if ttl is not None:
+            (timestamp,) = struct.unpack(">Q", data[1:9])
+            if timestamp + ttl < int(time.time()):
+                raise TTLError
+        
+        view = memoryview(data)
+        h = self._hmac.copy()
+        h.update(view[:-32])
+        try:
+            h.verify(data[-32:])
+        except InvalidSignature:
+            raise AuthenticationFailed
+        
+        decryptor = Cipher(self._aes, CBC(data[9:25])).decryptor()
+        plaintext_padded = decryptor.update(view[25:-32])
+        try:
+            plaintext_padded += decryptor.finalize()
+        except ValueError:
+            raise DecryptionFailed
+        
+        unpadder = PKCS7(AES.block_size).unpadder()
+        try:
+            return unpadder.update(plaintext_padded) + unpadder.finalize()
+        except ValueError:
+            raise UnpaddingError
+    
+    def encrypt_many(self, msgs):
+        '''
+        Encrypts a batch of messages, all stamped with the same time
+
+        Parameters
+        ----------
+        msgs : iterable of byte-strings
+            The messages that need to be encrypted.
+
+        Returns
+        -------
+        list of byte-strings
+            One token per message
+        '''
+        timestamp = int(time.time())
+        return [self.encrypt(msg, timestamp) for msg in msgs]
+    
+    def decrypt_many(self, tokens, ttl=None):
+        '''
+        Authenticates and decrypts a batch of tokens.  Raises on the first 
+        token that fails, like decrypt.
+
+        Parameters
+        ----------
+        tokens : iterable of byte-strings
+            The base64 tokens
+        ttl : int, optional
+            The "time-to-live" for a given message. (Default=None)  
+
+        Returns
+        -------
+        list of byte-strings
+            One message per token
+        '''
+        return [self.decrypt(token, ttl) for token in tokens]
+
+class CMFReader(io.RawIOBase):
+    '''
+    Read-only, seekable file object over the plaintext of a version 2 (AEAD)
+    .cmf container.  Only the chunks covering the requested bytes are read, 
+    authenticated and decrypted, so reading a few bytes near the end of a 
+    huge file costs a few chunks rather than the whole file.
+    
+    Wrap it in io.BufferedReader for many small reads.
+    '''
+    
+    def __init__(self, src, key, cipher=None):
+        '''
+        Parameters
+        ----------
+        src : string or file object
+            The path (or seekable binary file object) of the .cmf file
+        key : byte-string
+            encryption key.
+        cipher : AESCipher object, optional
+            Cipher used to derive the file key (default=None, a new one)
+        
+        Attributes
+        ----------
+        size : int
+            The length of the plaintext in bytes
+        timestamp : int
+            Time that the file was encrypted.
+        
+        Raises
+        ------
+        InvalidToken
+            If src is not a version 2 container (compressed containers 
+            cannot be read at random)
+        AuthenticationFailed
+            If the last chunk does not verify (the file has been truncated 
+            or tampered with)
+        '''
+        super(CMFReader, self).__init__()
+        self._owns_file = isinstance(src, (str, bytes, os.PathLike))
+        self._file = open(src, 'rb') if self._owns_file else src
+        try:
+            self._open(key, cipher or AESCipher())
+        except BaseException:
+            self.close()
+            raise
+        
+    def _open(self, key, cipher):
+        self._start = self._file.tell()
+        self._reader = _ChunkReader(self._file)
+        self.timestamp = self._reader.read_header()[0]
+        if self._reader.codec != CODEC_NONE:
+            raise InvalidToken
+        self._aead = cipher.aead_engine(self._reader.algorithm, key, 
+                                        self._reader.salt)
+        self.name = cipher._open_metadata(self._reader, self._aead)[0]
+        
+        chunk_size = self._reader.chunk_size
+        body = (self._file.seek(0, io.SEEK_END) - self._start - 
+                self._reader.header_size)
+        self._n_chunks = max(1, -(-body // (chunk_size + 16)))
+        last_size = body - (self._n_chunks - 1) * (chunk_size + 16) - 16
+        if last_size < 0:
+            raise InvalidToken
+        self.size = (self._n_chunks - 1) * chunk_size + last_size
+        self._pos = 0
+        self._cached = (None, b'')
+        
+        # The last chunk carries the end-of-file flag, so checking it up 
+        # front authenticates size
+        self._chunk(self._n_chunks - 1)
+    
+    def _chunk(self, index):
+        '''
+        Returns the authenticated plaintext of chunk number index
+        '''
+        if self._cached[0] != index:
+            sealed_size = self._reader.chunk_size + 16
+            self._file.seek(self._start + self._reader.header_size + 
+                            index * sealed_size)
+            sealed = _read_full(self._file, sealed_size)
+            nonce = _chunk_nonce(index, index == self._n_chunks - 1)
+            try:
+                plaintext = self._aead.decrypt(nonce, sealed, 
+                                               self._reader.header)
+            except InvalidTag:
+                raise AuthenticationFailed
+            self._cached = (index, plaintext)
+        return self._cached[1]
+    
+    def readable(self):
+        return True
+    
+    def seekable(self):
+        return True
+    
+    def tell(self):
+        return self._pos
+    
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            pos = offset
+        elif whence == io.SEEK_CUR:
+            pos = self._pos + offset
+        elif whence == io.SEEK_END:
+            pos = self.size + offset
+        else:
+            raise ValueError('invalid whence (%r)' % whence)
+        if pos < 0:
+            raise ValueError('negative seek position %d' % pos)
+        self._pos = pos
+        return pos
+    
+    def readinto(self, b):
+        view = memoryview(b).cast('B')
+        n = 0
+        while n < len(view) and self._pos < self.size:
+            index, offset = divmod(self._pos, self._reader.chunk_size)
+            chunk = self._chunk(index)
+            count = min(len(view) - n, len(chunk) - offset)
+            view[n:n+count] = chunk[offset:offset+count]
+            n += count
+            self._pos += count
+        return n
+    
+    def close(self):
+        if not self.closed and self._owns_file:
+            self._file.close()
+        super(CMFReader, self).close()
+
+if __name__ == "__main__":
+
+    '''
+    Toy Example
+    '''    
+    msg = b'My wife is amazing!!!'
+
+    cipher = AESCipher()
+    
+    key = cipher.generate_key()
+    ciphertext, iv = cipher.encrypt(msg, key)
+    msg_tx, signing_key = cipher.encode_authentication(ciphertext, iv)
+    
+    ciphertext, iv = cipher.authenticate(msg_tx, signing_key)
+    deciphertext = cipher.decrypt(ciphertext, key, iv)
+    
+    if deciphertext != msg:
+        raise ValueError
+    
+  
\ No newline at end of file
@@ -0,0 +1,628 @@
+# -*- coding: utf-8 -*-
+"""
+cli.py
+By Ronald Kemker
+
+Description: Command line interface for encrypting, decrypting and verifying
+             .cmf files without the GUI, e.g.
+
+                 python -m pierceslock encrypt -k keys/my.key data/*.csv
+                 pg_dump db | python -m pierceslock encrypt -k my.key > db.cmf
+                 python -m pierceslock decrypt -k keys/my.key -o out/ data/
+                 python -m pierceslock verify -k keys/my.key archive/
+                 python -m pierceslock verify --json -k my.key archive/
+                 python -m pierceslock archive -k keys/my.key photos/
+                 python -m pierceslock extract -k keys/my.key photos_TAR.cmf
+                 python -m pierceslock list -k keys/my.key photos_TAR.cmf
+                 python -m pierceslock stat -k keys/my.key archive/
+                 python -m pierceslock keystore keys.pks --import keys/
+                 python -m pierceslock decrypt -k keys.pks:my data/
+
+"""
+
+import argparse, glob, json, os, sys, time, tarfile
+from concurrent.futures import ThreadPoolExecutor
+
+from pierceslock.exceptions import AuthenticationFailed, DecryptionFailed, \
+    UnpaddingError, TTLError, InvalidToken, NotAnArchive, MemberNotFound, \
+    KeyNotFound
+from pierceslock.container import CHUNK_SIZE, ALG_AES_CBC_HMAC, ALG_AES_GCM,\
+    ALG_CHACHA20_POLY1305, ALGORITHMS, cmf_name, plain_name
+from pierceslock.compress import CODECS, available_codecs
+from pierceslock.keys import load_key
+from pierceslock.journal import journal_path
+from pierceslock.archive import archive_name, encrypt_tree, decrypt_tree, \
+    list_archive, extract_member
+
+ALGORITHM_NAMES = {'gcm' : ALG_AES_GCM,
+                   'chacha20' : ALG_CHACHA20_POLY1305,
+                   'cbc' : ALG_AES_CBC_HMAC}
+
+CODEC_NAMES = {CODECS[codec] : codec for codec in available_codecs()}
+
+# Commands that stream stdin to stdout when given no inputs (or "-")
+PIPE_COMMANDS = ('encrypt', 'decrypt', 'verify')
+
+ERRORS = {InvalidToken : 'not a valid .cmf file',
+          TTLError : "the message's time-to-live (TTL) has expired",
+          AuthenticationFailed : 'message authentication has failed',
+          DecryptionFailed : 'message decryption has failed',
+          UnpaddingError : 'message unpadding after decryption has failed',
+          NotAnArchive : 'not a .cmf archive',
+          MemberNotFound : 'no such member in the archive'}
+
+def error_message(e):
+    '''
+    The message printed for an exception listed in ERRORS
+    '''
+    return next(msg for error, msg in ERRORS.items() if isinstance(e, error))
+
+def resolve_key(spec, master_key=None):
+    '''
+    Loads the key given to -k: a .key file, or the key NAME of a keystore
+    written as STORE.pks:NAME
+
+    Parameters
+    ----------
+    spec : string
+        The -k argument
+    master_key : string, optional
+        The .key file a wrapped keystore is unwrapped with (default=None)
+
+    Returns
+    -------
+    byte-string
+        The encryption key
+
+    Raises
+    ------
+    ValueError
+        If the keystore cannot be opened or has no such key
+    '''
+    store, sep, name = spec.rpartition(':')
+    if not (sep and store.lower().endswith('.pks') and os.path.isfile(store)):
+        return load_key(spec)
+    
+    # Imported here so that --help does not have to load the cipher backend
+    from pierceslock.keystore import KeyStore
+    try:
+        with KeyStore(store, load_key(master_key) if master_key else None) \
+                as keystore:
+            return keystore.get(name)
+    except KeyNotFound:
+        raise ValueError('%s has no key called %r' % (store, name))
+    except (InvalidToken, AuthenticationFailed):
+        raise ValueError('%s is not a keystore, or needs the right '
+                         '--master-key' % store)
+
+def run_keystore(args, stdout=sys.stdout, stderr=sys.stderr):
+    '''
+    Creates the keystore args.store if needed, imports the .key files of
+    args.import_dir into it and lists its keys with their fingerprints.
+    Damaged records are reported and make the exit status 1.
+
+    Returns
+    -------
+    int
+        The exit status (0 on success, 1 otherwise)
+    '''
+    from pierceslock.keystore import KeyStore, import_key_dir
+    master_key = load_key(args.master_key) if args.master_key else None
+    try:
+        keystore = KeyStore(args.store, master_key)
+    except (InvalidToken, AuthenticationFailed):
+        print('%s is not a keystore, or needs the right --master-key' % 
+              args.store, file=stderr)
+        return 1
+    with keystore:
+        if args.import_dir:
+            imported = import_key_dir(keystore, args.import_dir)
+            print('Imported %d key(s) from %s' % (len(imported), 
+                                                  args.import_dir), 
+                  file=stderr)
+        for name in keystore.names():
+            key_id = keystore.key_id(name)
+            print('%s  %s' % (key_id.hex() if key_id else 'damaged'.ljust(16),
+                              name), file=stdout)
+        if keystore.damaged():
+            print('%s has %d damaged record(s)' % (
+                  args.store, len(keystore.damaged())), file=stderr)
+            return 1
+    return 0
+
+def expand_inputs(patterns, cmf_only, dirs_only=False):
+    '''
+    Expands file names, glob patterns and directories (recursively) into a
+    sorted list of files
+
+    Parameters
+    ----------
+    patterns : list of strings
+        The command line inputs
+    cmf_only : boolean
+        Only pick up .cmf files when walking directories
+    dirs_only : boolean, optional
+        Return the matching directories themselves instead (default=False)
+
+    Returns
+    -------
+    list of strings
+        The matching files
+    '''
+    files = []
+    for pattern in patterns:
+        matches = glob.glob(pattern, recursive=True) or [pattern]
+        for match in matches:
+            if dirs_only:
+                if os.path.isdir(match):
+                    files.append(os.path.normpath(match))
+            elif os.path.isdir(match):
+                for root, _, names in os.walk(match):
+                    for name in names:
+                        if cmf_only != name.lower().endswith('.cmf'):
+                            continue
+                        files.append(os.path.join(root, name))
+            else:
+                files.append(match)
+    return sorted(set(files))
+
+def output_path(path, output_dir, command):
+    '''
+    Where the result of running command on path is written
+    '''
+    if command == 'encrypt':
+        out = cmf_name(path)
+    elif command == 'archive':
+        out = archive_name(path)
+    elif command == 'extract':
+        # The archive holds the directory itself, so unpack next to it
+        return output_dir or os.path.dirname(path) or os.curdir
+    else:
+        out = plain_name(path)
+    if output_dir:
+        out = os.path.join(output_dir, os.path.basename(out))
+    return out
+
+def archive_root(cipher, path, key):
+    '''
+    The directory the archive at path unpacks to: the name sealed in its
+    metadata, or for archives without one the file name if it is of the 
+    form "photos_TAR.cmf" (None if it cannot be told)
+    '''
+    name = cipher.stat_file(path, key)['name']
+    if name and name.endswith('/'):
+        return name[:-1]
+    base = plain_name(os.path.basename(path))
+    if base.lower().endswith('.tar') and len(base) > 4:
+        return base[:-4]
+    return None
+
+def resuming(out, args):
+    '''
+    Whether out is the partial output of an interrupted --resume run
+    '''
+    return args.resume and os.path.exists(journal_path(out))
+
+def run_one(cipher, command, path, args, key, workers):
+    '''
+    Runs one command on one file
+
+    Returns
+    -------
+    out : string or None
+        The output file
+    size : int
+        The number of bytes read
+    seconds : float
+        The wall-clock time taken
+    '''
+    start = time.perf_counter()
+    out = None
+    
+    if command == 'encrypt' and args.in_place:
+        out = output_path(path, args.output_dir, command)
+        # The file may already have been renamed by an interrupted run
+        if (os.path.exists(out) and 
+                not (args.force or os.path.exists(journal_path(out)))):
+            raise FileExistsError('%s exists (use --force)' % out)
+        cipher.encrypt_in_place(path, key, out, chunk_size=args.chunk_size,
+                                algorithm=ALGORITHM_NAMES[args.algorithm],
+                                wipe=args.wipe)
+        size = cipher.stat_file(out, key)['size']
+        return out, size, time.perf_counter() - start
+    
+    size = os.path.getsize(path)
+    if command == 'encrypt':
+        out = output_path(path, args.output_dir, command)
+        if os.path.exists(out) and not (args.force or resuming(out, args)):
+            raise FileExistsError('%s exists (use --force)' % out)
+        cipher.encrypt_file(path, out, key, chunk_size=args.chunk_size,
+                            algorithm=ALGORITHM_NAMES[args.algorithm],
+                            workers=workers,
+                            compression=CODEC_NAMES[args.compress],
+                            resumable=args.resume)
+    elif command == 'archive':
+        out = output_path(path, args.output_dir, command)
+        if os.path.exists(out) and not args.force:
+            raise FileExistsError('%s exists (use --force)' % out)
+        encrypt_tree(path, out, key, chunk_size=args.chunk_size,
+                     algorithm=ALGORITHM_NAMES[args.algorithm],
+                     compression=CODEC_NAMES[args.compress],
+                     workers=workers, cipher=cipher)
+        # Report the archive size, the tree size is not known up front
+        size = os.path.getsize(out)
+    elif command == 'extract':
+        out = output_path(path, args.output_dir, command)
+        targets = args.member or [archive_root(cipher, path, key)]
+        for target in filter(None, targets):
+            if os.path.exists(os.path.join(out, target)) and not args.force:
+                raise FileExistsError('%s exists (use --force)' % 
+                                      os.path.join(out, target))
+        if args.member:
+            for name in args.member:
+                extract_member(path, key, name, out, ttl=args.ttl, 
+                               cipher=cipher)
+        else:
+            decrypt_tree(path, out, key, ttl=args.ttl, workers=workers,
+                         cipher=cipher)
+    elif command == 'decrypt':
+        out = output_path(path, args.output_dir, command)
+        if os.path.exists(out) and not (args.force or resuming(out, args)):
+            raise FileExistsError('%s exists (use --force)' % out)
+        cipher.decrypt_file(path, out, key, ttl=args.ttl, workers=workers,
+                            resumable=args.resume)
+    else:
+        cipher.verify_file(path, key, ttl=args.ttl, workers=workers)
+
+    return out, size, time.perf_counter() - start
+
+def list_members(cipher, files, key, stdout=sys.stdout, stderr=sys.stderr):
+    '''
+    Prints the members of every archive in files, "ls -l" style
+
+    Returns
+    -------
+    int
+        The exit status (0 if every archive could be listed, 1 otherwise)
+    '''
+    failed = 0
+    for path in files:
+        try:
+            members = list_archive(path, key, cipher=cipher)
+        except tuple(ERRORS) as e:
+            failed += 1
+            print('FAILED %s: %s' % (path, error_message(e)), file=stderr)
+            continue
+        except OSError as e:
+            failed += 1
+            print('FAILED %s: %s' % (path, e), file=stderr)
+            continue
+        
+        print('%s:' % path, file=stdout)
+        for member in members:
+            print('%12d  %s  %s%s' % 
+                  (member['size'], 
+                   time.strftime('%Y-%m-%d %H:%M', 
+                                 time.localtime(member['mtime'])),
+                   member['name'], '/' if member['type'] == 'dir' else ''),
+                  file=stdout)
+    return 1 if failed else 0
+
+def stat_files(cipher, files, key, as_json=False, stdout=sys.stdout, 
+               stderr=sys.stderr):
+    '''
+    Prints what the header of every file in files says about it (see 
+    AESCipher.stat_file), one line or JSON object per file
+
+    Returns
+    -------
+    int
+        The exit status (0 if every header could be read, 1 otherwise)
+    '''
+    failed = 0
+    for path in files:
+        try:
+            info = cipher.stat_file(path, key)
+        except tuple(ERRORS) as e:
+            failed += 1
+            print('FAILED %s: %s' % (path, error_message(e)), file=stderr)
+            continue
+        except OSError as e:
+            failed += 1
+            print('FAILED %s: %s' % (path, e), file=stderr)
+            continue
+        
+        if as_json:
+            info['path'] = path
+            print(json.dumps(info), file=stdout)
+            continue
+        print('%s  v%d  %-26s %12s  %s  %s' % 
+              (path, info['version'], ALGORITHMS[info['algorithm']],
+               '-' if info['size'] is None else info['size'],
+               time.strftime('%Y-%m-%d %H:%M', 
+                             time.localtime(info['timestamp'])),
+               info['name'] or '-'), file=stdout)
+    return 1 if failed else 0
+
+def run_pipe(args, stdin=None, stdout=None, stderr=sys.stderr):
+    '''
+    Runs args.command on stdin and writes the result to stdout (pipe mode).
+    Nothing is read ahead beyond the chunks being worked on and nothing is
+    seeked, so the input may be of any length.
+
+    Parameters
+    ----------
+    stdin, stdout : binary file objects, optional
+        The input and output (default=None, sys.stdin.buffer and 
+        sys.stdout.buffer)
+
+    Returns
+    -------
+    int
+        The exit status (0 on success, 1 otherwise)
+    '''
+    stdin = stdin or sys.stdin.buffer
+    stdout = stdout or sys.stdout.buffer
+    if args.command != 'verify' and stdout.isatty():
+        print('Refusing to write binary data to a terminal', file=stderr)
+        return 1
+    
+    from pierceslock.cipher import AESCipher
+    
+    try:
+        key = resolve_key(args.key, args.master_key)
+    except ValueError as e:
+        print(e, file=stderr)
+        return 1
+    cipher = AESCipher()
+    try:
+        if args.command == 'encrypt':
+            cipher.encrypt_file(stdin, stdout, key, 
+                                chunk_size=args.chunk_size,
+                                algorithm=ALGORITHM_NAMES[args.algorithm],
+                                compression=CODEC_NAMES[args.compress])
+        elif args.command == 'decrypt':
+            cipher.decrypt_file(stdin, stdout, key, ttl=args.ttl)
+        else:
+            cipher.verify_file(stdin, key, ttl=args.ttl)
+        stdout.flush()
+    except tuple(ERRORS) as e:
+        print('FAILED <stdin>: %s' % error_message(e), file=stderr)
+        return 1
+    except (OSError, ValueError) as e:
+        print('FAILED <stdin>: %s' % e, file=stderr)
+        return 1
+    if args.command == 'verify':
+        print('<stdin> OK', file=stderr)
+    return 0
+
+def run(args, stdout=sys.stdout, stderr=sys.stderr):
+    '''
+    Runs args.command on every input file on a pool of args.jobs threads
+    and prints per-file timings and the total throughput.
+
+    Returns
+    -------
+    int
+        The exit status (0 if every file succeeded, 1 otherwise)
+    '''
+    files = expand_inputs(args.inputs, 
+                          cmf_only=args.command not in ('encrypt', 'archive'),
+                          dirs_only=args.command == 'archive')
+    if not files:
+        print('No input files', file=stderr)
+        return 1
+    if args.output_dir:
+        os.makedirs(args.output_dir, exist_ok=True)
+
+    # Imported here so that --help does not have to load the cipher backend
+    from pierceslock.cipher import AESCipher
+    
+    try:
+        key = resolve_key(args.key, args.master_key) if args.key else None
+    except ValueError as e:
+        print(e, file=stderr)
+        return 1
+    cipher = AESCipher()
+    jobs = max(1, min(args.jobs, len(files)))
+    # Share the cores between files running at the same time
+    workers = max(1, (os.cpu_count() or 1) // jobs)
+    
+    if args.command == 'list':
+        return list_members(cipher, files, key, stdout, stderr)
+    if args.command == 'stat':
+        return stat_files(cipher, files, key, args.json, stdout, stderr)
+
+    def task(path):
+        try:
+            return path, run_one(cipher, args.command, path, args, key,
+                                 workers), None
+        except tuple(ERRORS) as e:
+            return path, None, error_message(e)
+        except (OSError, ValueError, tarfile.TarError) as e:
+            # e.g. a member the extraction filter refuses
+            return path, None, str(e)
+
+    start = time.perf_counter()
+    total = 0
+    failed = 0
+    with ThreadPoolExecutor(jobs) as pool:
+        for path, result, error in pool.map(task, files):
+            if args.json:
+                print(json.dumps({'path' : path, 
+                                  'ok' : error is None,
+                                  'error' : error,
+                                  'bytes' : result[1] if result else None,
+                                  'seconds' : result[2] if result else None}),
+                      file=stdout)
+                failed += error is not None
+                continue
+            if error:
+                failed += 1
+                print('FAILED %s: %s' % (path, error), file=stderr)
+                continue
+            out, size, seconds = result
+            total += size
+            target = ' -> %s' % out if out else ' OK'
+            print('%s%s  %.1f MiB  %.3f s  %.1f MiB/s' %
+                  (path, target, size / 2**20, seconds,
+                   size / 2**20 / max(seconds, 1e-9)), file=stdout)
+
+    if args.json:
+        return 1 if failed else 0
+    elapsed = time.perf_counter() - start
+    print('%d file(s), %.1f MiB in %.2f s, %.1f MiB/s%s' %
+          (len(files) - failed, total / 2**20, elapsed,
+           total / 2**20 / max(elapsed, 1e-9),
+           ', %d failed' % failed if failed else ''), file=stdout)
+    return 1 if failed else 0
+
+def build_parser():
+    '''
+    Builds the argparse parser for the command line interface
+    '''
+    parser = argparse.ArgumentParser(prog='pierceslock',
+        description="Pierce's Lock: encrypt and decrypt files with AES-256")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    for command, help_txt in [('encrypt', 'encrypt files into .cmf files'),
+                              ('decrypt', 'decrypt .cmf files'),
+                              ('verify', 'authenticate .cmf files without '
+                                         'writing the plaintext'),
+                              ('archive', 'encrypt directory trees into one '
+                                          '.cmf archive each'),
+                              ('extract', 'decrypt and unpack .cmf '
+                                          'archives'),
+                              ('list', 'list the members of .cmf archives'),
+                              ('stat', 'show the name, size and settings '
+                                       'of .cmf files from their headers')]:
+        sub = commands.add_parser(command, help=help_txt)
+        if command in PIPE_COMMANDS:
+            sub.add_argument('inputs', nargs='*',
+                             help='files, glob patterns or directories; '
+                                  'none (or -) to read stdin and write '
+                                  'stdout')
+        else:
+            sub.add_argument('inputs', nargs='+',
+                             help='files, glob patterns or directories')
+        if command == 'stat':
+            sub.add_argument('-k', '--key',
+                             help='the .key file (or STORE.pks:NAME); '
+                                  'without it the name and size stay '
+                                  'sealed')
+        else:
+            sub.add_argument('-k', '--key', required=True,
+                             help='the .key file to use, or STORE.pks:NAME '
+                                  'for a key in a keystore')
+        sub.add_argument('--master-key',
+                         help='the .key file that unwraps the keystore '
+                              'given to -k')
+        sub.add_argument('-j', '--jobs', type=int,
+                         default=os.cpu_count() or 1,
+                         help='number of files processed at the same time '
+                              '(default: one per CPU)')
+        if command not in ('verify', 'list', 'stat'):
+            sub.add_argument('-o', '--output-dir',
+                             help='write the results here instead of next '
+                                  'to the inputs')
+            sub.add_argument('-f', '--force', action='store_true',
+                             help='overwrite existing output files')
+        else:
+            sub.set_defaults(output_dir=None, force=False)
+        if command in ('encrypt', 'archive'):
+            if command == 'encrypt':
+                algorithms = sorted(ALGORITHM_NAMES)
+            else:
+                algorithms = ['chacha20', 'gcm']
+            sub.add_argument('-a', '--algorithm', default='gcm',
+                             choices=algorithms,
+                             help='cipher to use (default: gcm)')
+            sub.add_argument('-z', '--compress', default='none',
+                             choices=sorted(CODEC_NAMES),
+                             help='compress before encrypting, unless the '
+                                  'file looks compressed already (default: '
+                                  'none)')
+            sub.add_argument('--chunk-size', type=int, default=CHUNK_SIZE,
+                             help='bytes per chunk (default: %d)' %
+                                  CHUNK_SIZE)
+        elif command not in ('list', 'stat'):
+            sub.add_argument('--ttl', type=int,
+                             help='reject files older than this many '
+                                  'seconds')
+            if command == 'extract':
+                sub.add_argument('-m', '--member', action='append',
+                                 help='only extract this member (as shown '
+                                      'by list); may be repeated')
+        if command == 'verify':
+            sub.add_argument('--json', action='store_true',
+                             help='print one JSON object per file (path, '
+                                  'ok, error, bytes, seconds) instead of '
+                                  'the report')
+        elif command == 'stat':
+            sub.add_argument('--json', action='store_true',
+                             help='print one JSON object per file')
+        else:
+            sub.set_defaults(json=False)
+        if command in ('encrypt', 'decrypt'):
+            sub.add_argument('-r', '--resume', action='store_true',
+                             help='keep a checkpoint journal next to each '
+                                  'output and continue interrupted runs')
+        if command == 'encrypt':
+            sub.add_argument('--in-place', action='store_true',
+                             help='rewrite each file into its .cmf file '
+                                  'without a second copy (interrupted runs '
+                                  'are finished by running again)')
+            sub.add_argument('--wipe', action='store_true',
+                             help='with --in-place, overwrite the plaintext '
+                                  'kept in the journal before it is removed')
+
+    sub = commands.add_parser('keystore', 
+                              help='create a keystore (one .pks file for '
+                                   'many keys), import .key files into it '
+                                   'and list its keys')
+    sub.add_argument('store', help='the .pks file, created if missing')
+    sub.add_argument('--import', dest='import_dir', metavar='DIR',
+                     help='add the .key files in DIR (names it has '
+                          'already are skipped)')
+    sub.add_argument('--master-key',
+                     help='the .key file the keys are wrapped with')
+    return parser
+
+def main(argv=None):
+    '''
+    Command line entry point
+
+    Parameters
+    ----------
+    argv : list of strings, optional
+        The arguments (default=None, sys.argv[1:])
+
+    Returns
+    -------
+    int
+        The exit status
+    '''
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if args.command == 'keystore':
+        return run_keystore(args)
+    if (args.command == 'encrypt' and args.algorithm == 'cbc' and 
+            args.compress != 'none'):
+        parser.error('--compress needs an AEAD algorithm (gcm or chacha20)')
+    if args.command == 'encrypt' and args.in_place:
+        if (args.algorithm == 'cbc' or args.compress != 'none' or 
+                args.resume or args.output_dir):
+            parser.error('--in-place works with gcm or chacha20 only, '
+                         'without --compress, --resume or --output-dir')
+    elif getattr(args, 'wipe', False):
+        parser.error('--wipe needs --in-place')
+    if args.command in PIPE_COMMANDS and args.inputs in ([], ['-']):
+        if (args.output_dir or getattr(args, 'resume', False) or 
+                getattr(args, 'in_place', False)):
+            parser.error('--output-dir, --resume and --in-place need input '
+                         'files')
+        return run_pipe(args)
+    return run(args)
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,296 @@
+# -*- coding: utf-8 -*-
+"""
+compress.py
+By Ronald Kemker
+18 Jun 2021
+
+Description: Streaming compression applied to the plaintext before it is
+             encrypted (ciphertext does not compress).  zlib and lzma come
+             with Python; zstd is used when the zstandard package (or the
+             Python 3.14 compression.zstd module) is installed.
+
+"""
+
+import zlib, lzma, math, collections
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    from compression import zstd
+except ImportError:
+    zstd = None
+
+# Exceptions raised by the decompressors on corrupt input
+_ERRORS = (zlib.error, lzma.LZMAError)
+if zstandard is not None:
+    _ERRORS += (zstandard.ZstdError,)
+if zstd is not None:
+    _ERRORS += (zstd.ZstdError,)
+
+# Codec IDs recorded in version 3 containers
+CODEC_NONE = 0
+CODEC_ZLIB = 1
+CODEC_LZMA = 2
+CODEC_ZSTD = 3
+CODECS = {CODEC_NONE : 'none',
+          CODEC_ZLIB : 'zlib',
+          CODEC_LZMA : 'lzma',
+          CODEC_ZSTD : 'zstd'}
+
+# Number of leading plaintext bytes looked at before deciding to compress
+ENTROPY_SAMPLE_SIZE = 64 * 1024
+
+# Samples with more bits of entropy per byte than this are taken to be
+# compressed already (JPEG, PNG, ZIP, video, ... sit just under 8) and are
+# stored as they are.  Text, CSV and logs are usually between 4 and 6.
+ENTROPY_THRESHOLD = 7.5
+
+# Most bytes a decompressor returns per call (see decompress_pieces), so a
+# small, highly compressed input cannot make it allocate without bound
+DECOMPRESS_PIECE_SIZE = 1024 * 1024
+
+class _ZlibDecompressor(object):
+    '''
+    zlib.decompressobj that keeps its own unconsumed_tail.  needs_input is
+    False while output is still pending from the data given so far.
+    '''
+    def __init__(self):
+        self._d = zlib.decompressobj()
+        self.needs_input = True
+
+    def decompress(self, data, max_length=0):
+        if self._d.unconsumed_tail:
+            data = self._d.unconsumed_tail + data
+        out = self._d.decompress(data, max_length)
+        self.needs_input = not self._d.unconsumed_tail and (
+            not max_length or len(out) < max_length)
+        return out
+
+    def flush(self):
+        return self._d.flush()
+
+class _LZMADecompressor(object):
+    '''
+    lzma.LZMADecompressor with the interface of _ZlibDecompressor (also 
+    used for the zstd decompressor of Python 3.14, which works the same)
+    '''
+    def __init__(self, d=None):
+        self._d = d or lzma.LZMADecompressor()
+
+    @property
+    def needs_input(self):
+        return self._d.eof or self._d.needs_input
+
+    def decompress(self, data, max_length=0):
+        if self._d.eof and not data:
+            return b''
+        return self._d.decompress(data, max_length or -1)
+
+    def flush(self):
+        return b''
+
+class _ZstdDecompressor(object):
+    '''
+    zstandard's decompressobj with the interface of _ZlibDecompressor.  It 
+    has no output limit, so a limited call feeds it max_length // 1024 
+    bytes at a time.  zstd expands 4 bytes to at most one 128 KiB block, 
+    so a call returns at most about 32 * max_length bytes.
+    '''
+    def __init__(self):
+        self._d = zstandard.ZstdDecompressor().decompressobj()
+        self._pending = b''
+
+    @property
+    def needs_input(self):
+        return not self._pending
+
+    def decompress(self, data, max_length=0):
+        data = self._pending + data
+        if not max_length:
+            self._pending = b''
+            return self._d.decompress(data)
+        step = max(1, max_length // 1024)
+        out = []
+        size = 0
+        start = 0
+        while start < len(data) and size < max_length:
+            piece = self._d.decompress(data[start:start+step])
+            out.append(piece)
+            size += len(piece)
+            start += step
+        self._pending = data[start:]
+        return b''.join(out)
+
+    def flush(self):
+        return self.decompress(b'')
+
+def available_codecs():
+    '''
+    The codec IDs that can be used on this machine
+
+    Returns
+    -------
+    list of int
+    '''
+    codecs = [CODEC_NONE, CODEC_ZLIB, CODEC_LZMA]
+    if zstandard is not None or zstd is not None:
+        codecs.append(CODEC_ZSTD)
+    return codecs
+
+def default_codec():
+    '''
+    The fastest codec available (zstd if installed, otherwise zlib)
+    '''
+    if CODEC_ZSTD in available_codecs():
+        return CODEC_ZSTD
+    return CODEC_ZLIB
+
+def compressor(codec):
+    '''
+    Creates a streaming compressor
+
+    Parameters
+    ----------
+    codec : int
+        CODEC_ZLIB, CODEC_LZMA or CODEC_ZSTD
+
+    Returns
+    -------
+    object with compress(data) and flush() methods
+
+    Raises
+    ------
+    ValueError
+        If the codec is unknown or not installed
+    '''
+    if codec == CODEC_ZLIB:
+        return zlib.compressobj(6)
+    elif codec == CODEC_LZMA:
+        return lzma.LZMACompressor(preset=1)
+    elif codec == CODEC_ZSTD and zstandard is not None:
+        return zstandard.ZstdCompressor(level=3).compressobj()
+    elif codec == CODEC_ZSTD and zstd is not None:
+        return zstd.ZstdCompressor(level=3)
+    raise ValueError('Compression codec %r is not available' % codec)
+
+def decompressor(codec):
+    '''
+    Creates a streaming decompressor
+
+    Parameters
+    ----------
+    codec : int
+        CODEC_ZLIB, CODEC_LZMA or CODEC_ZSTD
+
+    Returns
+    -------
+    object with decompress(data, max_length=0) and flush() methods and a
+    needs_input attribute, see decompress_pieces
+
+    Raises
+    ------
+    ValueError
+        If the codec is unknown or not installed
+    '''
+    if codec == CODEC_ZLIB:
+        return _ZlibDecompressor()
+    elif codec == CODEC_LZMA:
+        return _LZMADecompressor()
+    elif codec == CODEC_ZSTD and zstandard is not None:
+        return _ZstdDecompressor()
+    elif codec == CODEC_ZSTD and zstd is not None:
+        return _LZMADecompressor(zstd.ZstdDecompressor())
+    raise ValueError('Compression codec %r is not available' % codec)
+
+def entropy(sample):
+    '''
+    Shannon entropy of the byte values in sample
+
+    Parameters
+    ----------
+    sample : bytes-like object
+
+    Returns
+    -------
+    float
+        Bits per byte, between 0 (constant) and 8 (uniformly random)
+    '''
+    n = len(sample)
+    if not n:
+        return 0.0
+    counts = collections.Counter(bytes(sample)).values()
+    return -sum(c / n * math.log2(c / n) for c in counts)
+
+def is_compressible(sample):
+    '''
+    Whether data starting with sample is worth compressing
+    '''
+    return entropy(sample[:ENTROPY_SAMPLE_SIZE]) <= ENTROPY_THRESHOLD
+
+def compress_stream(pieces, codec):
+    '''
+    Compresses an iterable of byte strings
+
+    Parameters
+    ----------
+    pieces : iterable of bytes-like objects
+        The plaintext, in pieces of any size
+    codec : int
+        CODEC_ZLIB, CODEC_LZMA or CODEC_ZSTD
+
+    Returns
+    -------
+    generator of byte strings
+        The compressed stream
+    '''
+    c = compressor(codec)
+    for piece in pieces:
+        out = c.compress(piece)
+        if out:
+            yield out
+    yield c.flush()
+
+def decompress_pieces(d, data, max_length=DECOMPRESS_PIECE_SIZE):
+    '''
+    Feeds data to the decompressor d and yields what it returns, at most
+    max_length bytes at a time (see _ZstdDecompressor for zstandard)
+
+    Parameters
+    ----------
+    d : object
+        A decompressor from decompressor()
+    data : bytes-like object
+        The next piece of the compressed stream
+    max_length : int, optional
+        Most bytes per piece (default=DECOMPRESS_PIECE_SIZE)
+
+    Returns
+    -------
+    generator of byte strings
+    '''
+    out = d.decompress(data, max_length)
+    if out:
+        yield out
+    while not d.needs_input:
+        out = d.decompress(b'', max_length)
+        if out:
+            yield out
+
+def decompress_stream(pieces, codec):
+    '''
+    The inverse of compress_stream
+
+    Raises
+    ------
+    ValueError
+        If the stream is corrupt
+    '''
+    d = decompressor(codec)
+    try:
+        for piece in pieces:
+            yield from decompress_pieces(d, piece)
+        yield d.flush()
+    except _ERRORS as e:
+        raise ValueError('Corrupt %s stream: %s' % (CODECS[codec], e))
@@ -0,0 +1,484 @@
+# -*- coding: utf-8 -*-
+"""
+container.py
+By Ronald Kemker
+18 Jun 2021
+
+Description: The .cmf file format: layout constants, the streaming readers 
+             for every container version and the file naming convention.
+             This module only needs the standard library.
+
+"""
+
+import os, io, base64, struct, binascii, contextlib, mmap, stat, hmac, \
+    hashlib
+from pierceslock.exceptions import InvalidToken
+from pierceslock.compress import CODECS, CODEC_NONE
+
+# Number of plaintext bytes pushed through the cipher at a time by the 
+# streaming file API.  Peak memory use is a small multiple of this value.
+CHUNK_SIZE = 64 * 1024
+
+# Largest chunk size accepted from a container header
+MAX_CHUNK_SIZE = 64 * 1024 * 1024
+
+# Algorithm IDs recorded in version 2 containers
+ALG_AES_CBC_HMAC = 0
+ALG_AES_GCM = 1
+ALG_CHACHA20_POLY1305 = 2
+ALGORITHMS = {ALG_AES_CBC_HMAC : 'AES-256-CBC + HMAC-SHA256',
+              ALG_AES_GCM : 'AES-256-GCM',
+              ALG_CHACHA20_POLY1305 : 'ChaCha20-Poly1305'}
+
+# Binary .cmf container, version 1 (AES-256-CBC + HMAC-SHA256):
+#   CMF_MAGIC | version (1) | timestamp (8) | iv (16) | ciphertext | hmac (32)
+# The HMAC-SHA256 covers everything before it.
+#
+# Version 2 (AEAD):
+#   CMF_MAGIC | version (1) | algorithm (1) | chunk size (4) | timestamp (8) |
+#   salt (16) | chunk 0 | chunk 1 | ... 
+# Every chunk is chunk size bytes of plaintext (the last one may be shorter)
+# sealed with its own 16-byte tag.  The nonce holds the chunk index and a 
+# flag marking the last chunk, and the header is the associated data of 
+# every chunk, so chunks cannot be reordered, dropped or truncated.
+#
+# Version 3 is version 2 with the plaintext compressed before it is chunked:
+#   CMF_MAGIC | version (1) | algorithm (1) | codec (1) | chunk size (4) |
+#   timestamp (8) | salt (16) | chunk 0 | chunk 1 | ...
+# The codec byte (see compress.CODECS) is authenticated with the header.
+#
+# Version 4 adds the key fingerprint and a fixed-size, sealed metadata block
+# so a file can be described from its first METADATA_HEADER_SIZE bytes:
+#   CMF_MAGIC | version (1) | algorithm (1) | codec (1) | chunk size (4) |
+#   timestamp (8) | key fingerprint (8) | salt (16) | 
+#   sealed metadata (METADATA_SIZE + 16) | chunk 0 | chunk 1 | ...
+# The metadata (plaintext size, original file name) is sealed under its own 
+# nonce with the header before it as associated data; the chunks use that
+# same header as associated data, as in version 2.
+#
+# Files written before the container existed hold the 16-byte signing key
+# followed by the base64 token from encode_authentication; they are detected
+# by the missing magic.
+CMF_MAGIC = b'PLCK'
+CMF_VERSION = 1
+CMF_AEAD_VERSION = 2
+CMF_COMPRESSED_VERSION = 3
+CMF_METADATA_VERSION = 4
+
+# Plaintext size of the version 4 metadata block: plaintext size (8), name 
+# length (2) and the UTF-8 file name, zero-padded to METADATA_NAME_SIZE
+METADATA_NAME_SIZE = 246
+METADATA_SIZE = 8 + 2 + METADATA_NAME_SIZE
+
+# Bytes before the first chunk of a version 4 container
+METADATA_HEADER_SIZE = len(CMF_MAGIC) + 1 + 1 + 1 + 4 + 8 + 8 + 16 + \
+    METADATA_SIZE + 16
+
+# Recorded plaintext size of input that was streamed from a pipe
+SIZE_UNKNOWN = 2**64 - 1
+
+# Nonce of the metadata block.  Chunk nonces start with three zero bytes, 
+# so the two can never collide.
+METADATA_NONCE = b'\x01' + bytes(11)
+
+@contextlib.contextmanager
+def _open_stream(target, mode):
+    '''
+    Opens target if it is a path, otherwise yields the file object as-is 
+    (the caller keeps ownership of file objects it passes in).
+    '''
+    if isinstance(target, (str, bytes, os.PathLike)):
+        with open(target, mode) as f:
+            yield f
+    else:
+        yield target
+
+@contextlib.contextmanager
+def _open_output(target):
+    '''
+    Same as _open_stream for writing, but removes a partially written output
+    file if anything goes wrong while it is being produced.  Seekable file
+    objects are truncated back to where writing started instead.
+    '''
+    if isinstance(target, (str, bytes, os.PathLike)):
+        try:
+            with open(target, 'wb') as f:
+                yield f
+        except BaseException:
+            if os.path.exists(target):
+                os.remove(target)
+            raise
+    else:
+        start = target.tell() if target.seekable() else None
+        try:
+            yield target
+        except BaseException:
+            if start is not None:
+                target.seek(start)
+                target.truncate()
+            raise
+
+def _read_full(fileobj, size):
+    '''
+    Reads exactly size bytes from fileobj, unless the end of file is reached.
+    '''
+    data = fileobj.read(size)
+    if len(data) == size or not data:
+        return data
+    parts = [data]
+    remaining = size - len(data)
+    while remaining:
+        part = fileobj.read(remaining)
+        if not part:
+            break
+        parts.append(part)
+        remaining -= len(part)
+    return b''.join(parts)
+
+@contextlib.contextmanager
+def _mapped(fileobj):
+    '''
+    Yields a read-only memoryview of fileobj, from its current position to 
+    the end, backed by mmap.  Slices of the view can be handed to the cipher
+    contexts without copying the file into Python objects.  Yields None if 
+    fileobj is not a non-empty regular file.
+    '''
+    try:
+        info = os.fstat(fileobj.fileno())
+        start = fileobj.tell()
+        if not stat.S_ISREG(info.st_mode) or info.st_size <= start:
+            raise ValueError
+        m = mmap.mmap(fileobj.fileno(), 0, access=mmap.ACCESS_READ)
+    except (AttributeError, OSError, ValueError, io.UnsupportedOperation):
+        m = None
+    
+    if m is None:
+        yield None
+        return
+    
+    view = memoryview(m)[start:]
+    try:
+        yield view
+    finally:
+        view.release()
+        try:
+            m.close()
+        except BufferError:
+            # A slice is still referenced somewhere; the map is closed when 
+            # it is garbage collected instead
+            pass
+
+def _view_chunks(view, size, start=0):
+    '''
+    Same as _indexed_chunks, over a memoryview instead of a file object
+    '''
+    count = max(1, -(-len(view) // size))
+    for i in range(count):
+        yield start + i, view[i*size:(i+1)*size], i == count - 1
+
+def _chunk_nonce(index, last):
+    '''
+    96-bit nonce of chunk number index in a version 2 container.
+    '''
+    return struct.pack(">3xQ?", index, last)
+
+def key_fingerprint(key):
+    '''
+    The 8-byte fingerprint of key recorded in version 4 headers, so the 
+    right key can be picked (or a wrong one rejected) without trying it.  
+    It is a keyed hash and reveals nothing about the key.
+    '''
+    return hmac.new(key, b'pierceslock key fingerprint', 
+                    hashlib.sha256).digest()[:8]
+
+def _pack_metadata(name, size):
+    '''
+    The version 4 metadata block for a file called name of size bytes (None
+    if unknown).  Names longer than METADATA_NAME_SIZE bytes are cut.
+    '''
+    name = name.encode('utf-8')[:METADATA_NAME_SIZE]
+    # Do not leave half a character behind
+    name = name.decode('utf-8', 'ignore').encode('utf-8')
+    size = SIZE_UNKNOWN if size is None else size
+    return struct.pack(">QH%ds" % METADATA_NAME_SIZE, size, len(name), name)
+
+def _unpack_metadata(data):
+    '''
+    The inverse of _pack_metadata
+
+    Returns
+    -------
+    name : string
+    size : int or None
+    '''
+    size, length, name = struct.unpack(">QH%ds" % METADATA_NAME_SIZE, data)
+    if length > METADATA_NAME_SIZE:
+        raise InvalidToken
+    try:
+        name = name[:length].decode('utf-8')
+    except UnicodeDecodeError:
+        raise InvalidToken
+    return name, None if size == SIZE_UNKNOWN else size
+
+def _indexed_chunks(fileobj, size, start=0):
+    '''
+    Yields (index, chunk, last) for every size-byte piece of fileobj, 
+    numbered from start.  An empty file still gives one (empty) last chunk.
+    '''
+    index = start
+    chunk = _read_full(fileobj, size)
+    while True:
+        # Read one chunk ahead to find out whether this one is the last
+        next_chunk = _read_full(fileobj, size)
+        last = not next_chunk
+        yield index, chunk, last
+        if last:
+            break
+        chunk = next_chunk
+        index += 1
+
+def _rechunk(pieces, size):
+    '''
+    Same as _indexed_chunks, over an iterable of byte strings of any length
+    (e.g. the output of a compressor) instead of a file object
+    '''
+    index = 0
+    buffer = bytearray()
+    for piece in pieces:
+        buffer += piece
+        # Keep at least one byte back so the last chunk can be flagged
+        while len(buffer) > size:
+            yield index, bytes(buffer[:size]), False
+            del buffer[:size]
+            index += 1
+    yield index, bytes(buffer), True
+
+class _TokenReader(object):
+    '''
+    Streams a base64 token (as written by encode_authentication) from a file
+    object without holding more than one chunk of it in memory.
+    
+    Iterating over the reader yields the ciphertext in chunks.  Once the 
+    iteration is exhausted the HMAC signature is available in .signature.
+    '''
+    header_size = 25
+    # Readers that can take a memoryview of the data after the header (in 
+    # view) and read from it instead of fileobj
+    mappable = False
+    view = None
+    
+    def __init__(self, fileobj, chunk_size=CHUNK_SIZE, prefix=b''):
+        self.fileobj = fileobj
+        # Keep reads aligned to whole base64 quanta
+        self.chunk_size = max(4, chunk_size - chunk_size % 4)
+        self.header = None
+        self.signature = None
+        self._carry = b''
+        # Bytes already consumed from fileobj by the caller
+        self._buffer = prefix
+        
+    def _decoded_chunks(self):
+        while True:
+            raw = self.fileobj.read(self.chunk_size)
+            if not raw:
+                break
+            raw = self._carry + raw
+            n = len(raw) - len(raw) % 4
+            self._carry = raw[n:]
+            try:
+                yield base64.urlsafe_b64decode(raw[:n])
+            except (TypeError, binascii.Error):
+                raise InvalidToken
+        if self._carry:
+            raise InvalidToken
+
+    def _parse_header(self, header):
+        if header[0] != 0x80:
+            raise InvalidToken
+        (timestamp,) = struct.unpack(">Q", header[1:9])
+        return timestamp, header[9:25]
+
+    def read_header(self):
+        '''
+        Reads the version byte, timestamp and initialization vector
+        
+        Returns
+        -------
+        timestamp : int
+            Time that the message was encrypted.
+        iv : byte string
+            initialization vector
+        '''
+        self._chunks = self._decoded_chunks()
+        while len(self._buffer) < self.header_size:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                break
+            self._buffer += chunk
+        if len(self._buffer) < self.header_size:
+            raise InvalidToken
+        self.header = self._buffer[:self.header_size]
+        self._buffer = self._buffer[self.header_size:]
+        self.timestamp, self.iv = self._parse_header(self.header)
+        return self.timestamp, self.iv
+    
+    def __iter__(self):
+        for chunk in self._chunks:
+            self._buffer += chunk
+            # Always hold back the last 32 bytes, they may be the signature
+            if len(self._buffer) > 32:
+                yield self._buffer[:-32]
+                self._buffer = self._buffer[-32:]
+        if len(self._buffer) < 32:
+            raise InvalidToken
+        if len(self._buffer) > 32:
+            yield self._buffer[:-32]
+        self.signature = self._buffer[-32:]
+        self._buffer = b''
+
+class _ContainerReader(_TokenReader):
+    '''
+    Streams a binary .cmf container (see CMF_MAGIC).  Same interface as 
+    _TokenReader, without the base64 decoding step.
+    '''
+    header_size = len(CMF_MAGIC) + 1 + 8 + 16
+    mappable = True
+    
+    def __init__(self, fileobj, chunk_size=CHUNK_SIZE, prefix=b''):
+        super(_ContainerReader, self).__init__(fileobj, chunk_size, prefix)
+        self.chunk_size = chunk_size
+        
+    def _decoded_chunks(self):
+        while True:
+            raw = self.fileobj.read(self.chunk_size)
+            if not raw:
+                break
+            yield raw
+    
+    def _parse_header(self, header):
+        n = len(CMF_MAGIC)
+        if header[:n] != CMF_MAGIC or header[n] != CMF_VERSION:
+            raise InvalidToken
+        (timestamp,) = struct.unpack(">Q", header[n+1:n+9])
+        return timestamp, header[n+9:n+25]
+    
+    def read_header(self):
+        # Read exactly the header, so the rest can be mapped from the 
+        # current file position
+        self._buffer += _read_full(self.fileobj, 
+                                   self.header_size - len(self._buffer))
+        return super(_ContainerReader, self).read_header()
+    
+    def __iter__(self):
+        if self.view is None:
+            return super(_ContainerReader, self).__iter__()
+        return self._view_chunks()
+    
+    def _view_chunks(self):
+        if len(self.view) < 32:
+            raise InvalidToken
+        body = self.view[:-32]
+        for i in range(0, len(body), self.chunk_size):
+            yield body[i:i+self.chunk_size]
+        self.signature = bytes(self.view[-32:])
+
+class _ChunkReader(object):
+    '''
+    Streams a version 2 (AEAD), 3 (compressed AEAD) or 4 (AEAD with 
+    metadata) container.  Iterating over the reader yields (index, sealed 
+    chunk, last) tuples.
+    
+    .header is the associated data of the chunks; header_size is where the
+    first chunk starts (after the sealed metadata, in version 4).
+    '''
+    header_size = len(CMF_MAGIC) + 1 + 1 + 4 + 8 + 16
+    # Bytes before the first chunk, by version
+    header_sizes = {CMF_AEAD_VERSION : header_size,
+                    CMF_COMPRESSED_VERSION : header_size + 1,
+                    CMF_METADATA_VERSION : METADATA_HEADER_SIZE}
+    mappable = True
+    view = None
+    
+    def __init__(self, fileobj, prefix=b''):
+        self.fileobj = fileobj
+        self.header = None
+        self.codec = CODEC_NONE
+        self.fingerprint = None
+        # The sealed metadata block (version 4 only)
+        self.metadata = None
+        # Index of the chunk at the current position of fileobj
+        self.first_chunk = 0
+        # Bytes already consumed from fileobj by the caller
+        self._prefix = prefix
+        
+    def read_header(self):
+        '''
+        Reads the container header
+        
+        Returns
+        -------
+        timestamp : int
+            Time that the message was encrypted.
+        salt : byte string
+            The salt used to derive the file key
+        '''
+        n = len(CMF_MAGIC)
+        header = self._prefix + _read_full(self.fileobj, 
+                                           n + 1 - len(self._prefix))
+        if len(header) < n + 1 or header[:n] != CMF_MAGIC:
+            raise InvalidToken
+        self.version = header[n]
+        if self.version not in self.header_sizes:
+            raise InvalidToken
+        self.header_size = self.header_sizes[self.version]
+        
+        header += _read_full(self.fileobj, self.header_size - len(header))
+        if len(header) < self.header_size:
+            raise InvalidToken
+        if self.version == CMF_METADATA_VERSION:
+            self.metadata = header[-METADATA_SIZE-16:]
+            header = header[:-METADATA_SIZE-16]
+        self.header = header
+        
+        self.algorithm = header[n+1]
+        if self.version != CMF_AEAD_VERSION:
+            self.codec = header[n+2]
+            n += 1
+        self.chunk_size, self.timestamp = struct.unpack(">IQ", 
+                                                        header[n+2:n+14])
+        if self.version == CMF_METADATA_VERSION:
+            self.fingerprint = header[n+14:n+22]
+        self.salt = header[-16:]
+        
+        if (self.algorithm not in ALGORITHMS or self.codec not in CODECS or
+                not 0 < self.chunk_size <= MAX_CHUNK_SIZE):
+            raise InvalidToken
+        return self.timestamp, self.salt
+    
+    def __iter__(self):
+        if self.view is not None:
+            return _view_chunks(self.view, self.chunk_size + 16, 
+                                self.first_chunk)
+        return _indexed_chunks(self.fileobj, self.chunk_size + 16, 
+                               self.first_chunk)
+
+def cmf_name(path):
+    '''
+    The name Application.encrypt gives the encrypted copy of path, i.e.
+    "report.csv" becomes "report_CSV.cmf"
+    '''
+    base, ext = os.path.splitext(path)
+    if ext:
+        return base + '_' + ext[1:].upper() + '.cmf'
+    return base + '.cmf'
+
+def plain_name(path):
+    '''
+    The inverse of cmf_name, i.e. "report_CSV.cmf" becomes "report.csv"
+    '''
+    base = path[:-4] if path.lower().endswith('.cmf') else path
+    head, tail = os.path.split(base)
+    if '_' in tail:
+        tail, ext = tail.rsplit('_', 1)
+        return os.path.join(head, tail + '.' + ext.lower())
+    return base
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+"""
+exceptions.py
+By Ronald Kemker
+18 Jun 2021
+
+Description: Errors raised while authenticating and decrypting messages, 
+             when an archive or keystore lookup fails, and when a 
+             background job is cancelled
+
+"""
+
+import tarfile
+
+class InvalidToken(Exception):
+    pass
+
+class AuthenticationFailed(Exception):
+    pass
+
+class DecryptionFailed(Exception):
+    pass
+
+class UnpaddingError(Exception):
+    pass
+
+class TTLError(Exception):
+    pass
+
+class Cancelled(Exception):
+    pass
+
+# A container that does not hold a tar archive.  It is a tarfile.ReadError,
+# which is what decrypt_tree raised before.
+class NotAnArchive(tarfile.ReadError):
+    pass
+
+class MemberNotFound(KeyError):
+    pass
+
+class KeyNotFound(KeyError):
+    pass
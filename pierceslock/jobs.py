@@ -0,0 +1,345 @@
+# -*- coding: utf-8 -*-
+"""
+jobs.py
+By Ronald Kemker
+18 Jun 2021
+
+Description: Background jobs for the GUI.  The work runs on a worker thread
+             and reports its progress and outcome through a queue.Queue, 
+             which the Tk main loop polls with window.after.  Cancelling a 
+             job makes its next read, write or advance raise Cancelled, so 
+             it stops between chunks, and its partial output is removed.  
+             A Batch runs many such jobs on a bounded pool of threads.
+
+"""
+
+import os, time, queue, shutil, threading, contextlib
+from concurrent.futures import ThreadPoolExecutor, wait
+from pierceslock.exceptions import Cancelled
+
+# Seconds between two progress messages
+PROGRESS_INTERVAL = 0.1
+
+# Number of jobs a Batch runs at the same time
+BATCH_WORKERS = min(4, os.cpu_count() or 1)
+
+class _CountingWriter(object):
+    '''
+    Binary file wrapper that reports every write to a Job
+    '''
+    def __init__(self, fileobj, job):
+        self._file = fileobj
+        self._job = job
+
+    def write(self, data):
+        self._job.advance(len(data))
+        return self._file.write(data)
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def seekable(self):
+        return self._file.seekable()
+
+    def tell(self):
+        return self._file.tell()
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        return self._file.seek(offset, whence)
+
+    def truncate(self, size=None):
+        return self._file.truncate(size)
+
+    def flush(self):
+        self._file.flush()
+
+class _CountingReader(object):
+    '''
+    Binary file wrapper that reports every read to a Job.  It has no 
+    fileno, so the cipher reads it in chunks instead of mapping the file.
+    '''
+    def __init__(self, fileobj, job):
+        self._file = fileobj
+        self._job = job
+
+    def read(self, size=-1):
+        data = self._file.read(size)
+        self._job.advance(len(data))
+        return data
+
+    def seekable(self):
+        return self._file.seekable()
+
+    def tell(self):
+        return self._file.tell()
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        return self._file.seek(offset, whence)
+
+class Job(object):
+    '''
+    One piece of work run on a background thread.  It posts these tuples 
+    to its events queue:
+    
+        ('progress', bytes done, bytes total, bytes per second)
+        ('done', result)
+        ('cancelled',)
+        ('error', exception)
+    
+    and the last three only once, at the end.
+    '''
+
+    def __init__(self, work, total, events=None):
+        '''
+        Parameters
+        ----------
+        work : callable
+            work(job) does the job and returns its result.  It reads or 
+            writes through job.input / job.output, or passes job.advance as
+            the cipher's progress callback, so progress is counted.
+        total : int
+            The number of bytes expected to be counted
+        events : queue.Queue, optional
+            Where the messages are posted (default=None, a new queue)
+        '''
+        self.work = work
+        self.total = total
+        self.events = events if events is not None else queue.Queue()
+        self.done = 0
+        self.thread = None
+        self._cancel = threading.Event()
+        self._start = None
+        self._posted = 0.0
+
+    def start(self):
+        '''
+        Starts the worker thread and returns the job
+        '''
+        self._start = time.perf_counter()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        return self
+
+    def run(self):
+        '''
+        Does the work in the calling thread
+        
+        Returns
+        -------
+        tuple
+            The final message: ('done', result), ('cancelled',) or 
+            ('error', exception)
+        '''
+        try:
+            result = self.work(self)
+        except Cancelled:
+            return ('cancelled',)
+        except Exception as e:
+            return ('error', e)
+        return ('done', result)
+
+    def _run(self):
+        outcome = self.run()
+        if outcome[0] == 'done':
+            self._post()
+        self.events.put(outcome)
+
+    def cancel(self):
+        '''
+        Asks the job to stop; it posts ('cancelled',) once it has
+        '''
+        self._cancel.set()
+
+    @property
+    def cancelled(self):
+        return self._cancel.is_set()
+
+    def rate(self):
+        '''
+        Average throughput so far, in bytes per second
+        '''
+        elapsed = time.perf_counter() - (self._start or time.perf_counter())
+        return self.done / max(elapsed, 1e-9)
+
+    def _post(self):
+        self._posted = time.perf_counter()
+        self.events.put(('progress', self.done, self.total, self.rate()))
+
+    def advance(self, n):
+        '''
+        Counts n more bytes, posting progress at most every 
+        PROGRESS_INTERVAL seconds
+
+        Raises
+        ------
+        Cancelled
+            If the job has been cancelled
+        '''
+        if self._cancel.is_set():
+            raise Cancelled
+        self.done += n
+        if time.perf_counter() - self._posted >= PROGRESS_INTERVAL:
+            self._post()
+
+    @contextlib.contextmanager
+    def input(self, path):
+        '''
+        Opens path for reading, counting what is read
+        '''
+        with open(path, 'rb') as f:
+            yield _CountingReader(f, self)
+
+    @contextlib.contextmanager
+    def output(self, path, counted=True):
+        '''
+        Opens path for writing, counting what is written unless counted is
+        False (when the job counts its input instead).  The file is removed
+        if the job fails or is cancelled.
+        '''
+        try:
+            with open(path, 'wb') as f:
+                yield _CountingWriter(f, self) if counted else f
+        except BaseException:
+            if os.path.exists(path):
+                os.remove(path)
+            raise
+
+    @contextlib.contextmanager
+    def output_dir(self, path):
+        '''
+        Yields path, a directory the job unpacks into.  If the job created
+        it and then fails or is cancelled, it is removed again.
+        '''
+        created = not os.path.exists(path)
+        try:
+            yield path
+        except BaseException:
+            if created:
+                shutil.rmtree(path, ignore_errors=True)
+            raise
+
+class _BatchJob(Job):
+    '''
+    A Job run by a Batch: it shares the batch's cancel flag and leaves the
+    progress messages to the batch
+    '''
+    def __init__(self, work, total, cancel):
+        Job.__init__(self, work, total)
+        self._cancel = cancel
+
+    def _post(self):
+        pass
+
+class Batch(object):
+    '''
+    A queue of jobs run on a bounded pool of worker threads, in order.  It
+    posts these tuples to its events queue:
+    
+        ('status', index, state, detail)
+        ('progress', bytes done, bytes total, bytes per second, seconds left)
+        ('summary', done, failed, cancelled, seconds)
+    
+    where state is 'running', 'done' (detail is the result), 'failed' 
+    (detail is the exception) or 'cancelled', and seconds left is None 
+    until something has been done.  The summary comes once, at the end.  
+    A failed job does not stop the others.
+    '''
+
+    def __init__(self, items, workers=None, events=None):
+        '''
+        Parameters
+        ----------
+        items : list of tuples
+            (work, total) of each job, see Job
+        workers : int, optional
+            Number of jobs run at the same time (default=None, 
+            BATCH_WORKERS)
+        events : queue.Queue, optional
+            Where the messages are posted (default=None, a new queue)
+        '''
+        self._cancel = threading.Event()
+        self.jobs = [_BatchJob(work, total, self._cancel) 
+                     for work, total in items]
+        self.total = sum(job.total for job in self.jobs)
+        self.workers = max(1, workers or BATCH_WORKERS)
+        self.events = events if events is not None else queue.Queue()
+        self.thread = None
+        self._finished = set()
+        self._start = None
+
+    def start(self):
+        '''
+        Starts the batch and returns it
+        '''
+        self._start = time.perf_counter()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        return self
+
+    def _run(self):
+        with ThreadPoolExecutor(self.workers) as pool:
+            futures = [pool.submit(self._run_job, index) 
+                       for index in range(len(self.jobs))]
+            while wait(futures, timeout=PROGRESS_INTERVAL).not_done:
+                self._post()
+        self._post()
+        states = [future.result() for future in futures]
+        self.events.put(('summary', states.count('done'), 
+                         states.count('failed'), states.count('cancelled'),
+                         time.perf_counter() - self._start))
+
+    def _run_job(self, index):
+        if self._cancel.is_set():
+            self.events.put(('status', index, 'cancelled', None))
+            return 'cancelled'
+        self.events.put(('status', index, 'running', None))
+        outcome = self.jobs[index].run()
+        self._finished.add(index)
+        state = {'done' : 'done', 
+                 'cancelled' : 'cancelled', 
+                 'error' : 'failed'}[outcome[0]]
+        self.events.put(('status', index, state, 
+                         outcome[1] if len(outcome) > 1 else None))
+        return state
+
+    def cancel(self):
+        '''
+        Stops the running jobs and skips the ones not started yet
+        '''
+        self._cancel.set()
+
+    @property
+    def cancelled(self):
+        return self._cancel.is_set()
+
+    @property
+    def done(self):
+        '''
+        Bytes done so far.  A finished job counts in full, whatever it 
+        actually read or wrote, so failures do not stall the estimate.
+        '''
+        return sum(job.total if index in self._finished 
+                   else min(job.done, job.total)
+                   for index, job in enumerate(self.jobs))
+
+    def rate(self):
+        '''
+        Average throughput so far, in bytes per second
+        '''
+        elapsed = time.perf_counter() - (self._start or time.perf_counter())
+        return self.done / max(elapsed, 1e-9)
+
+    def eta(self):
+        '''
+        Seconds left at the throughput measured so far, or None before
+        anything has been done
+        '''
+        done = self.done
+        if not done:
+            return None
+        return (self.total - done) / self.rate()
+
+    def _post(self):
+        self.events.put(('progress', self.done, self.total, self.rate(), 
+                         self.eta()))
@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+"""
+journal.py
+By Ronald Kemker
+18 Jun 2021
+
+Description: Checkpoint journals that let an interrupted encrypt_file or
+             decrypt_file (resumable=True) or encrypt_in_place continue 
+             where it stopped.  The journal sits next to the output as 
+             "<output>.journal" and is removed once the output is complete.
+
+"""
+
+import os, json, hashlib
+
+# Suffix of the journal file next to the output
+JOURNAL_SUFFIX = '.journal'
+
+# Output bytes written between two checkpoints.  Every checkpoint flushes
+# the output to disk, so this trades resume granularity for fsync calls.
+CHECKPOINT_INTERVAL = 64 * 1024 * 1024
+
+def journal_path(dst):
+    '''
+    The journal file of output path dst
+    '''
+    return os.fspath(dst) + JOURNAL_SUFFIX
+
+def source_id(fileobj):
+    '''
+    Identifies the input file, so a journal is only used with the input it
+    was written for.  A changed input restarts the job; resuming it would
+    seal different plaintext under nonces that have been used already.
+    '''
+    info = os.fstat(fileobj.fileno())
+    return [info.st_size, info.st_mtime_ns, info.st_ino]
+
+def read_journal(dst, payload=False):
+    '''
+    Reads the journal of dst
+
+    Parameters
+    ----------
+    dst : string
+        The output path
+    payload : boolean, optional
+        Also return the bytes stored after the state (default=False)
+
+    Returns
+    -------
+    dict or None
+        The journal, or None if there is none (or it cannot be read)
+    byte-string
+        The payload (only if payload is True)
+    '''
+    try:
+        with open(journal_path(dst), 'rb') as f:
+            state, _, data = f.read().partition(b'\n')
+        state = json.loads(state)
+    except (OSError, ValueError):
+        state, data = None, b''
+    return (state, data) if payload else state
+
+def _scrub(path):
+    '''
+    Overwrites the file at path with zeros, if it exists.  On SSDs and 
+    copy-on-write file systems the old blocks may survive regardless.
+    '''
+    try:
+        f = open(path, 'r+b')
+    except FileNotFoundError:
+        return
+    with f:
+        f.write(bytes(os.fstat(f.fileno()).st_size))
+        f.flush()
+        os.fsync(f.fileno())
+
+def write_journal(dst, state, payload=b'', wipe=False):
+    '''
+    Atomically replaces the journal of dst with state, followed by payload
+    bytes.  With wipe set, the journal being replaced is overwritten first 
+    (it may hold plaintext).
+    '''
+    path = journal_path(dst)
+    with open(path + '.tmp', 'wb') as f:
+        f.write(json.dumps(state).encode('utf-8') + b'\n')
+        f.write(payload)
+        f.flush()
+        os.fsync(f.fileno())
+    if wipe:
+        _scrub(path)
+    os.replace(path + '.tmp', path)
+
+def remove_journal(dst, wipe=False):
+    '''
+    Removes the journal of dst, if there is one, overwriting it first if 
+    wipe is set
+    '''
+    if wipe:
+        _scrub(journal_path(dst))
+    try:
+        os.remove(journal_path(dst))
+    except FileNotFoundError:
+        pass
+
+def new_journal(mode, source, header, output):
+    '''
+    The journal of a job that has written output (the first bytes of the
+    output, e.g. the container header) and no chunks yet
+
+    Parameters
+    ----------
+    mode : string
+        'encrypt' or 'decrypt'
+    source : list
+        source_id of the input
+    header : byte-string
+        The container header (of the output when encrypting, of the input
+        when decrypting)
+    output : byte-string
+        The output written so far
+    '''
+    return {'mode' : mode,
+            'source' : source,
+            'header' : header.hex(),
+            'chunks' : 0,
+            'output_size' : len(output),
+            'last_size' : len(output),
+            'digest' : hashlib.sha256(output).hexdigest()}
+
+def reopen_output(dst, state):
+    '''
+    Checks the partial output at dst against the journal state: it must be
+    at least as long as recorded and the last chunk recorded must hash to
+    the recorded digest.  Anything after the checkpoint is cut off.
+
+    Returns
+    -------
+    file object or None
+        dst opened for writing at the end of the last good chunk, or None
+        if the output does not match the journal
+    '''
+    try:
+        fout = open(dst, 'r+b')
+    except OSError:
+        return None
+    try:
+        end = state['output_size']
+        start = end - state['last_size']
+        if os.fstat(fout.fileno()).st_size < end or start < 0:
+            fout.close()
+            return None
+        fout.seek(start)
+        if hashlib.sha256(fout.read(end - start)).hexdigest() != \
+                state['digest']:
+            fout.close()
+            return None
+        fout.truncate(end)
+        fout.seek(end)
+        return fout
+    except BaseException:
+        fout.close()
+        raise
+
+class Checkpoint(object):
+    '''
+    Records progress in the journal of dst every CHECKPOINT_INTERVAL bytes
+    of output.  The output is flushed to disk before the journal is
+    written, so the journal never points past data that could be lost.
+    '''
+
+    def __init__(self, dst, fout, state, interval=None):
+        self.dst = dst
+        self.fout = fout
+        self.state = state
+        self.interval = interval or CHECKPOINT_INTERVAL
+        self._pending = 0
+        self._output_size = state['output_size']
+        write_journal(dst, state)
+
+    def update(self, chunks, written, last_output):
+        '''
+        Called after each batch of chunks has been written
+
+        Parameters
+        ----------
+        chunks : int
+            The number of chunks completed so far
+        written : int
+            Bytes written in this batch
+        last_output : bytes-like object
+            The output of the last chunk in this batch
+        '''
+        self._pending += written
+        self._output_size += written
+        if self._pending < self.interval:
+            return
+        self.fout.flush()
+        os.fsync(self.fout.fileno())
+        self.state.update(chunks=chunks, output_size=self._output_size,
+                          last_size=len(last_output),
+                          digest=hashlib.sha256(last_output).hexdigest())
+        write_journal(self.dst, self.state)
+        self._pending = 0
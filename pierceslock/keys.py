@@ -0,0 +1,331 @@
+# -*- coding: utf-8 -*-
+"""
+keys.py
+By Ronald Kemker
+18 Jun 2021
+
+Description: Reads, writes and lists the hex encoded .key files that hold 
+             the encryption keys, and KeyIndex, the cached listing of a key
+             directory the GUI windows share
+
+"""
+
+import os, glob, time, binascii, threading, collections
+from pierceslock.container import key_fingerprint
+
+# Number of parsed keys a KeyIndex keeps in memory
+KEY_CACHE_SIZE = 64
+
+# A directory modified less than this many seconds ago is listed again on
+# the next refresh: file system timestamps are coarse (a few milliseconds 
+# on Linux, 2 seconds on FAT), so a second change may not move them
+MTIME_GRACE = 2.0
+
+def generate_key():
+    '''
+    Generates a random 256-bit encryption key
+
+    Returns
+    -------
+    string
+        The key, hex encoded (the .key file contents)
+    '''
+    return binascii.hexlify(os.urandom(32)).decode('utf-8')
+
+def key_path(key_dir, name):
+    '''
+    The location of the .key file called name in key_dir
+    '''
+    return os.path.join(key_dir, name + '.key')
+
+def list_keys(key_dir):
+    '''
+    Lists the .key files in a directory
+
+    Parameters
+    ----------
+    key_dir : string
+        The directory to search
+
+    Returns
+    -------
+    list of strings
+        The key names (file names without the .key extension), sorted
+    '''
+    return sorted(os.path.basename(path)[:-4] 
+                  for path in glob.glob(os.path.join(key_dir, '*.key')))
+
+def read_key(path):
+    '''
+    Reads the hex encoded contents of a .key file
+
+    Parameters
+    ----------
+    path : string
+        The location of the .key file
+
+    Returns
+    -------
+    string
+        The hex encoded key
+    '''
+    with open(path, 'r') as f:
+        return f.read().strip()
+
+def load_key(path):
+    '''
+    Reads a .key file
+
+    Parameters
+    ----------
+    path : string
+        The location of the .key file
+
+    Returns
+    -------
+    byte-string
+        The encryption key
+    '''
+    return binascii.unhexlify(read_key(path))
+
+def save_key(path, hex_key):
+    '''
+    Writes a hex encoded key to a .key file
+
+    Parameters
+    ----------
+    path : string
+        The location of the .key file
+    hex_key : string
+        The hex encoded key
+
+    Returns
+    -------
+    None.
+    '''
+    with open(path, 'w') as f:
+        f.write(hex_key)
+
+def delete_key(path):
+    '''
+    Deletes a .key file
+
+    Parameters
+    ----------
+    path : string
+        The location of the .key file
+
+    Returns
+    -------
+    None.
+    '''
+    os.remove(path)
+
+class KeyIndex(object):
+    '''
+    A cached listing of the .key files in one directory.  The directory is
+    listed again only when its modification time changes, and then only new
+    or changed files lose their cached key and fingerprint.  Parsed keys are
+    kept in a least-recently-used cache, so picking a key does not read its
+    file again.  A key file rewritten in place (which leaves the directory 
+    alone) is only noticed once the directory changes or after invalidate().
+    '''
+
+    def __init__(self, key_dir, cache_size=KEY_CACHE_SIZE):
+        '''
+        Parameters
+        ----------
+        key_dir : string
+            The directory of .key files
+        cache_size : int, optional
+            Number of parsed keys kept (default=KEY_CACHE_SIZE)
+        '''
+        self.cache_size = cache_size
+        self.key_dir = None
+        self.generation = 0
+        self._lock = threading.RLock()
+        self.set_dir(key_dir)
+
+    def set_dir(self, key_dir):
+        '''
+        Points the index at key_dir.  Nothing is dropped if it is the 
+        directory indexed already, however it is spelled.
+        '''
+        key_dir = os.path.normpath(os.path.abspath(key_dir))
+        with self._lock:
+            if key_dir != self.key_dir:
+                self.key_dir = key_dir
+                self.invalidate()
+
+    def invalidate(self):
+        '''
+        Drops everything cached, so the next call lists the directory again
+        '''
+        with self._lock:
+            self._dir_mtime = None
+            self._mtimes = {}
+            self._names = []
+            self._fingerprints = {}
+            self._keys = collections.OrderedDict()
+            self.generation += 1
+
+    def _list(self):
+        mtimes = {}
+        try:
+            with os.scandir(self.key_dir) as entries:
+                for entry in entries:
+                    if entry.name.endswith('.key') and entry.is_file():
+                        mtimes[entry.name[:-4]] = entry.stat().st_mtime_ns
+        except OSError:
+            pass
+        return mtimes
+
+    def refresh(self):
+        '''
+        Brings the listing up to date.  If the directory has not changed 
+        (recently, see MTIME_GRACE) this costs a single stat.
+
+        Returns
+        -------
+        boolean
+            Whether the listing changed
+        '''
+        with self._lock:
+            try:
+                dir_mtime = os.stat(self.key_dir).st_mtime_ns
+            except OSError:
+                dir_mtime = None
+            if dir_mtime is not None and dir_mtime == self._dir_mtime:
+                return False
+            
+            mtimes = self._list()
+            if (dir_mtime is not None and 
+                    time.time() - dir_mtime / 1e9 < MTIME_GRACE):
+                dir_mtime = None
+            self._dir_mtime = dir_mtime
+            if mtimes == self._mtimes:
+                return False
+            # Keep what was cached for the files that did not change
+            for cache in (self._fingerprints, self._keys):
+                for name in [name for name in cache 
+                             if mtimes.get(name) != self._mtimes[name]]:
+                    del cache[name]
+            self._mtimes = mtimes
+            self._names = sorted(mtimes)
+            self.generation += 1
+            return True
+
+    def names(self):
+        '''
+        The key names in the directory, sorted (see list_keys)
+        '''
+        with self._lock:
+            self.refresh()
+            return list(self._names)
+
+    def path(self, name):
+        '''
+        The location of the .key file called name
+        '''
+        return key_path(self.key_dir, name)
+
+    def _load(self, name):
+        if name in self._keys:
+            self._keys.move_to_end(name)
+            return self._keys[name]
+        key = load_key(self.path(name))
+        if name in self._mtimes:
+            self._keys[name] = key
+            while len(self._keys) > self.cache_size:
+                self._keys.popitem(last=False)
+        return key
+
+    def load(self, name):
+        '''
+        The key called name, parsed once and then served from the cache
+        
+        Returns
+        -------
+        byte-string
+            The encryption key
+        
+        Raises
+        ------
+        OSError
+            If there is no such key file
+        '''
+        with self._lock:
+            self.refresh()
+            return self._load(name)
+
+    def read(self, name):
+        '''
+        The key called name, hex encoded (see read_key)
+        '''
+        return binascii.hexlify(self.load(name)).decode('utf-8')
+
+    def _fingerprint(self, name):
+        if name in self._fingerprints:
+            return self._fingerprints[name]
+        fingerprint = key_fingerprint(self._load(name))
+        if name in self._mtimes:
+            self._fingerprints[name] = fingerprint
+        return fingerprint
+
+    def fingerprint(self, name):
+        '''
+        The key_fingerprint of the key called name.  Fingerprints are kept 
+        for every key, not just the ones in the key cache.
+        '''
+        with self._lock:
+            self.refresh()
+            return self._fingerprint(name)
+
+    def find(self, fingerprint):
+        '''
+        The names of the keys with the given fingerprint, e.g. the 
+        "fingerprint" of AESCipher.stat_file.  The first call reads every 
+        key; later calls only read keys that were added or changed.
+        '''
+        with self._lock:
+            self.refresh()
+            names = []
+            for name in self._names:
+                try:
+                    if self._fingerprint(name) == fingerprint:
+                        names.append(name)
+                except (OSError, ValueError):
+                    # Unreadable or not a key after all
+                    continue
+            return names
+
+    def _touch(self):
+        # Our own change is applied to the cache directly; the next refresh
+        # lists the directory to catch anything else that changed with it
+        self._dir_mtime = None
+        self._names = sorted(self._mtimes)
+        self.generation += 1
+
+    def add(self, name, hex_key):
+        '''
+        Saves hex_key as the key called name (see save_key)
+        '''
+        with self._lock:
+            self.refresh()
+            save_key(self.path(name), hex_key)
+            self._mtimes[name] = os.stat(self.path(name)).st_mtime_ns
+            self._keys.pop(name, None)
+            self._fingerprints.pop(name, None)
+            self._touch()
+
+    def remove(self, name):
+        '''
+        Deletes the key called name (see delete_key)
+        '''
+        with self._lock:
+            self.refresh()
+            delete_key(self.path(name))
+            self._mtimes.pop(name, None)
+            self._keys.pop(name, None)
+            self._fingerprints.pop(name, None)
+            self._touch()
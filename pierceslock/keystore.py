@@ -0,0 +1,654 @@
+# -*- coding: utf-8 -*-
+"""
+keystore.py
+By Ronald Kemker
+18 Jun 2021
+
+Description: A single indexed file (.pks) holding many keys, instead of one
+             .key file per key.  The file is a header followed by fixed-size
+             records, one per key, so every record sits at a known offset:
+             a key is added by writing one record (into the first free slot)
+             and deleted by clearing one, without rewriting the file.  The
+             index of names and key IDs (fingerprints) to offsets is read
+             once when the store is opened.  With a master key the keys are
+             stored wrapped (sealed with AES-GCM) instead of in the clear.
+             A record that fails its check is never reused or dropped; it
+             stays until it is cleared explicitly.
+
+             Layout:  header  MAGIC | version | flags | salt | check
+                      records state | key ID | name | key | CRC-32
+
+"""
+
+import os, struct, zlib, binascii, contextlib
+from cryptography.exceptions import InvalidTag
+
+from pierceslock.exceptions import AuthenticationFailed, InvalidToken, \
+    KeyNotFound
+from pierceslock.container import ALG_AES_GCM, key_fingerprint
+from pierceslock.keys import KeyIndex, list_keys, load_key
+
+# File extension of keystores
+KEYSTORE_SUFFIX = '.pks'
+
+# First bytes of every keystore
+KEYSTORE_MAGIC = b'PLKS'
+KEYSTORE_VERSION = 1
+
+# Header flag: the keys are wrapped with a master key
+FLAG_WRAPPED = 1
+
+# Header: MAGIC, version, flags, salt, then the sealed check value that
+# tells a wrong master key from a damaged record
+HEADER = struct.Struct('>4sBB16s28s')
+HEADER_SIZE = 64
+
+# Longest key name and key, in bytes
+NAME_SIZE = 128
+KEY_SIZE = 32
+
+# Record: state, key ID (key_fingerprint), name length, name, key length,
+# key (or nonce + wrapped key + tag), then a CRC-32 of everything before it
+RECORD = struct.Struct('>B8sB%dsB%ds' % (NAME_SIZE, 12 + KEY_SIZE + 16))
+RECORD_SIZE = 256
+
+# Record states
+FREE = 0
+LIVE = 1
+
+# Associated data of the sealed check value in the header
+_CHECK = b'pierceslock keystore'
+
+class KeyStore(object):
+    '''
+    A keystore file, created if it does not exist.  Lookups are served from
+    the index built when it is opened; add and remove write a single record.
+    Use it as a context manager, or call close().
+    '''
+
+    def __init__(self, path, master_key=None):
+        '''
+        Parameters
+        ----------
+        path : string
+            The .pks file
+        master_key : byte-string, optional
+            Wraps the keys of a new store, and unwraps those of a wrapped
+            one (default=None, keys are stored in the clear)
+
+        Raises
+        ------
+        InvalidToken
+            If path is not a keystore
+        AuthenticationFailed
+            If the master key is wrong, or missing for a wrapped store
+        '''
+        self.path = path
+        self.master_key = master_key
+        self._deferred = 0
+        self._names = {}
+        self._ids = {}
+        self._free = []
+        self._damaged = {}
+        self._slots = 0
+
+        if not os.path.exists(path) or os.path.getsize(path) == 0:
+            self._f = open(path, 'w+b')
+            try:
+                self._create()
+            except BaseException:
+                self._f.close()
+                raise
+        else:
+            self._f = open(path, 'r+b')
+            try:
+                self._open()
+            except BaseException:
+                self._f.close()
+                raise
+
+    def _engine(self, salt):
+        # Imported here so that reading a plain store does not load the
+        # cipher backend
+        from pierceslock.cipher import AESCipher
+        return AESCipher().aead_engine(ALG_AES_GCM, self.master_key, salt)
+
+    def _create(self):
+        salt = os.urandom(16)
+        flags = 0
+        check = bytes(28)
+        self._aead = None
+        if self.master_key is not None:
+            flags = FLAG_WRAPPED
+            self._aead = self._engine(salt)
+            nonce = os.urandom(12)
+            check = nonce + self._aead.encrypt(nonce, b'', _CHECK)
+        header = HEADER.pack(KEYSTORE_MAGIC, KEYSTORE_VERSION, flags, salt,
+                             check)
+        self._write(0, header.ljust(HEADER_SIZE, b'\x00'))
+
+    def _open(self):
+        header = self._f.read(HEADER_SIZE)
+        if len(header) < HEADER_SIZE:
+            raise InvalidToken
+        magic, version, flags, salt, check = HEADER.unpack_from(header)
+        if magic != KEYSTORE_MAGIC or version != KEYSTORE_VERSION:
+            raise InvalidToken
+
+        self._aead = None
+        if flags & FLAG_WRAPPED:
+            if self.master_key is None:
+                raise AuthenticationFailed
+            self._aead = self._engine(salt)
+            try:
+                self._aead.decrypt(check[:12], check[12:], _CHECK)
+            except InvalidTag:
+                raise AuthenticationFailed
+
+        # One pass over the records builds the index.  A trailing partial
+        # record is an append that never completed.
+        data = self._f.read()
+        self._slots = len(data) // RECORD_SIZE
+        for slot in range(self._slots):
+            record = data[slot * RECORD_SIZE:(slot + 1) * RECORD_SIZE]
+            try:
+                entry = _unpack_record(record)
+            except AuthenticationFailed:
+                self._damaged[slot] = _damaged_name(record)
+                continue
+            if entry is None:
+                self._free.append(slot)
+                continue
+            key_id, name, _ = entry
+            self._names[name] = (slot, key_id)
+            self._ids.setdefault(key_id, []).append(name)
+        # Keep the names of damaged keys listed, so get() reports them and
+        # add() does not store another key under them
+        for slot, name in self._damaged.items():
+            if name is not None and name not in self._names:
+                self._names[name] = (slot, None)
+            else:
+                self._damaged[slot] = None
+        # Reuse the lowest free slots first
+        self._free.reverse()
+
+    def _write(self, offset, data):
+        self._f.seek(offset)
+        self._f.write(data)
+        if not self._deferred:
+            self._f.flush()
+            os.fsync(self._f.fileno())
+
+    def _offset(self, slot):
+        return HEADER_SIZE + slot * RECORD_SIZE
+
+    @contextlib.contextmanager
+    def bulk(self):
+        '''
+        Defers flushing to disk until the end of the with block, for
+        adding or removing many keys at once
+        '''
+        self._deferred += 1
+        try:
+            yield self
+        finally:
+            self._deferred -= 1
+            if not self._deferred:
+                self._f.flush()
+                os.fsync(self._f.fileno())
+
+    def __len__(self):
+        return len(self._names)
+
+    def __contains__(self, name):
+        return name in self._names
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        '''
+        Closes the file
+        '''
+        self._f.close()
+
+    @property
+    def wrapped(self):
+        '''
+        Whether the keys are wrapped with a master key
+        '''
+        return self._aead is not None
+
+    def names(self):
+        '''
+        The key names, sorted.  Names read from damaged records are listed 
+        too; get() raises AuthenticationFailed for them.
+        '''
+        return sorted(self._names)
+
+    def damaged(self):
+        '''
+        The slots whose records fail their check, sorted.  They are not
+        reused until they are cleared with clear_damaged.
+        '''
+        return sorted(self._damaged)
+
+    def clear_damaged(self, slot):
+        '''
+        Overwrites the damaged record in slot with zeros, dropping whatever
+        key it held, and frees the slot
+
+        Raises
+        ------
+        KeyError
+            If the record in slot is not damaged
+        '''
+        name = self._damaged.pop(slot)
+        if name is not None:
+            del self._names[name]
+        self._write(self._offset(slot), bytes(RECORD_SIZE))
+        self._free.append(slot)
+
+    def get(self, name):
+        '''
+        The key called name
+
+        Returns
+        -------
+        byte-string
+            The encryption key
+
+        Raises
+        ------
+        KeyNotFound
+            If there is no such key
+        AuthenticationFailed
+            If the record has been damaged or tampered with
+        '''
+        slot, key_id = self._entry(name)
+        self._f.seek(self._offset(slot))
+        entry = _unpack_record(self._f.read(RECORD_SIZE))
+        if entry is None or entry[:2] != (key_id, name):
+            raise AuthenticationFailed
+        blob = entry[2]
+        if self._aead is None:
+            return blob
+        try:
+            return self._aead.decrypt(blob[:12], blob[12:],
+                                      key_id + name.encode('utf-8'))
+        except InvalidTag:
+            raise AuthenticationFailed
+
+    def _entry(self, name):
+        if name not in self._names:
+            raise KeyNotFound(name)
+        return self._names[name]
+
+    def key_id(self, name):
+        '''
+        The ID (key_fingerprint) of the key called name, without reading it
+        (None if its record is damaged)
+        '''
+        return self._entry(name)[1]
+
+    def find(self, fingerprint):
+        '''
+        The names of the keys whose key_fingerprint is fingerprint, e.g. the
+        "fingerprint" of AESCipher.stat_file
+        '''
+        return sorted(self._ids.get(fingerprint, []))
+
+    def add(self, name, key):
+        '''
+        Stores key as name, in the first free slot
+
+        Parameters
+        ----------
+        name : string
+            The key name, at most NAME_SIZE bytes of UTF-8
+        key : byte-string
+            The key, at most KEY_SIZE bytes
+
+        Raises
+        ------
+        ValueError
+            If the name is taken or too long, or the key too long
+        '''
+        encoded = name.encode('utf-8')
+        if not encoded or len(encoded) > NAME_SIZE:
+            raise ValueError('Key names must be 1 to %d bytes' % NAME_SIZE)
+        if not key or len(key) > KEY_SIZE:
+            raise ValueError('Keys must be 1 to %d bytes' % KEY_SIZE)
+        if name in self._names:
+            raise ValueError('There is a key called %r already' % name)
+
+        key_id = key_fingerprint(key)
+        blob = key
+        if self._aead is not None:
+            nonce = os.urandom(12)
+            blob = nonce + self._aead.encrypt(nonce, key, key_id + encoded)
+        record = _pack_record(key_id, encoded, blob)
+
+        slot = self._free.pop() if self._free else self._slots
+        self._write(self._offset(slot), record)
+        self._slots = max(self._slots, slot + 1)
+        self._names[name] = (slot, key_id)
+        self._ids.setdefault(key_id, []).append(name)
+
+    def remove(self, name):
+        '''
+        Deletes the key called name, even if its record is damaged.  Its 
+        record is overwritten with zeros and its slot is reused by the next
+        add.
+
+        Raises
+        ------
+        KeyNotFound
+            If there is no such key
+        '''
+        slot, key_id = self._entry(name)
+        del self._names[name]
+        if key_id is None:
+            del self._damaged[slot]
+        else:
+            self._ids[key_id].remove(name)
+            if not self._ids[key_id]:
+                del self._ids[key_id]
+        self._write(self._offset(slot), bytes(RECORD_SIZE))
+        self._free.append(slot)
+
+def _pack_record(key_id, name, blob):
+    '''
+    A live record for name (bytes) holding blob
+    '''
+    record = RECORD.pack(LIVE, key_id, len(name), name, len(blob), blob)
+    record = record.ljust(RECORD_SIZE - 4, b'\x00')
+    return record + struct.pack('>I', zlib.crc32(record))
+
+def _unpack_record(record):
+    '''
+    The (key ID, name, blob) of a live record, or None for a free slot 
+    (all zeros)
+
+    Raises
+    ------
+    AuthenticationFailed
+        If the record is neither, e.g. a bit has flipped or a write was torn
+    '''
+    if len(record) < RECORD_SIZE:
+        raise AuthenticationFailed
+    if not any(record):
+        return None
+    if (record[0] != LIVE or 
+            struct.unpack('>I', record[-4:])[0] != zlib.crc32(record[:-4])):
+        raise AuthenticationFailed
+    _, key_id, name_size, name, blob_size, blob = RECORD.unpack_from(record)
+    return key_id, name[:name_size].decode('utf-8'), blob[:blob_size]
+
+def _damaged_name(record):
+    '''
+    The name a damaged record appears to hold, or None if it is unreadable
+    '''
+    _, _, name_size, name, _, _ = RECORD.unpack_from(record)
+    if not 0 < name_size <= NAME_SIZE:
+        return None
+    try:
+        return name[:name_size].decode('utf-8')
+    except UnicodeDecodeError:
+        return None
+
+def import_key_dir(store, key_dir):
+    '''
+    Copies the .key files of key_dir into store, skipping names it has
+    already and files that do not hold a key
+
+    Parameters
+    ----------
+    store : KeyStore object
+        The keystore to add to
+    key_dir : string
+        The directory of .key files
+
+    Returns
+    -------
+    list of strings
+        The names imported
+    '''
+    imported = []
+    with store.bulk():
+        for name in list_keys(key_dir):
+            if name in store:
+                continue
+            try:
+                key = load_key(os.path.join(key_dir, name + '.key'))
+                store.add(name, key)
+            except (OSError, ValueError):
+                continue
+            imported.append(name)
+    return imported
+
+def load_key_spec(spec, master_key=None):
+    '''
+    Loads a .key file, or the key NAME of a keystore written as 
+    STORE.pks:NAME (see KeyStoreIndex.path)
+
+    Parameters
+    ----------
+    spec : string
+        The location of the key
+    master_key : byte-string, optional
+        Unwraps the keys of a wrapped store (default=None)
+
+    Returns
+    -------
+    byte-string
+        The encryption key
+
+    Raises
+    ------
+    KeyNotFound
+        If the keystore has no such key
+    InvalidToken
+        If the store is not a keystore
+    AuthenticationFailed
+        If the master key is wrong or missing, or the record is damaged
+    '''
+    store, sep, name = spec.rpartition(':')
+    if not (sep and store.lower().endswith(KEYSTORE_SUFFIX) and 
+            os.path.isfile(store)):
+        return load_key(spec)
+    with KeyStore(store, master_key) as keystore:
+        return keystore.get(name)
+
+class KeyStoreIndex(object):
+    '''
+    The keys of one keystore, behind the same calls as keys.KeyIndex, so 
+    the key manager can show a .pks file in place of a directory of .key 
+    files.  The names are read again only when the file changes; every 
+    other call opens the store for just that call.  Only unwrapped stores
+    can be opened this way.
+    '''
+
+    def __init__(self, path):
+        '''
+        Parameters
+        ----------
+        path : string
+            The .pks file, created by the first add if it does not exist
+        '''
+        self.key_dir = None
+        self.generation = 0
+        self.set_dir(path)
+
+    def set_dir(self, path):
+        '''
+        Points the index at the keystore path
+        '''
+        path = os.path.normpath(os.path.abspath(path))
+        if path != self.key_dir:
+            self.key_dir = path
+            self.invalidate()
+
+    def invalidate(self):
+        '''
+        Drops the names read, so the next call reads the store again
+        '''
+        self._mtime = None
+        self._names = []
+        self.generation += 1
+
+    def refresh(self):
+        '''
+        Reads the names again if the file has changed
+
+        Returns
+        -------
+        boolean
+            Whether the listing changed
+
+        Raises
+        ------
+        InvalidToken
+            If the file is not a keystore
+        AuthenticationFailed
+            If the store is wrapped with a master key
+        '''
+        try:
+            mtime = os.stat(self.key_dir).st_mtime_ns
+        except OSError:
+            mtime = None
+        if mtime is not None and mtime == self._mtime:
+            return False
+        names = []
+        if mtime is not None:
+            with self._open() as keystore:
+                names = keystore.names()
+        self._mtime = mtime
+        if names == self._names:
+            return False
+        self._names = names
+        self.generation += 1
+        return True
+
+    def _open(self):
+        return KeyStore(self.key_dir)
+
+    def _changed(self):
+        # The next call reads the names of the rewritten file
+        self._mtime = None
+        self.refresh()
+
+    def names(self):
+        '''
+        The key names in the store, sorted
+        '''
+        self.refresh()
+        return list(self._names)
+
+    def path(self, name):
+        '''
+        The key called name, as STORE.pks:NAME (see load_key_spec)
+        '''
+        return '%s:%s' % (self.key_dir, name)
+
+    def load(self, name):
+        '''
+        The key called name
+
+        Raises
+        ------
+        KeyNotFound
+            If there is no such key
+        '''
+        with self._open() as keystore:
+            return keystore.get(name)
+
+    def read(self, name):
+        '''
+        The key called name, hex encoded
+        '''
+        return binascii.hexlify(self.load(name)).decode('utf-8')
+
+    def fingerprint(self, name):
+        '''
+        The key_fingerprint of the key called name
+        '''
+        with self._open() as keystore:
+            return keystore.key_id(name)
+
+    def find(self, fingerprint):
+        '''
+        The names of the keys with the given fingerprint
+        '''
+        with self._open() as keystore:
+            return keystore.find(fingerprint)
+
+    def add(self, name, hex_key):
+        '''
+        Stores hex_key as the key called name
+
+        Raises
+        ------
+        ValueError
+            If hex_key is not hex, or the name is taken (see KeyStore.add)
+        '''
+        key = binascii.unhexlify(hex_key.strip())
+        with self._open() as keystore:
+            keystore.add(name, key)
+        self._changed()
+
+    def remove(self, name):
+        '''
+        Deletes the key called name
+
+        Raises
+        ------
+        KeyNotFound
+            If there is no such key
+        '''
+        with self._open() as keystore:
+            keystore.remove(name)
+        self._changed()
+
+    def import_dir(self, key_dir):
+        '''
+        Copies the .key files of key_dir into the store (see import_key_dir)
+
+        Returns
+        -------
+        list of strings
+            The names imported
+        '''
+        with self._open() as keystore:
+            imported = import_key_dir(keystore, key_dir)
+        self._changed()
+        return imported
+
+def open_key_index(path, index=None):
+    '''
+    An index of the keys at path: a KeyStoreIndex for a .pks file, else a
+    keys.KeyIndex of the directory.  index is pointed at path and returned
+    if it is of the right kind, so its cache is kept.
+
+    Parameters
+    ----------
+    path : string
+        A directory of .key files or a keystore
+    index : KeyIndex or KeyStoreIndex object, optional
+        The index used until now (default=None)
+
+    Returns
+    -------
+    KeyIndex or KeyStoreIndex object
+    '''
+    if path.lower().endswith(KEYSTORE_SUFFIX):
+        kind = KeyStoreIndex
+    else:
+        kind = KeyIndex
+    if type(index) is not kind:
+        return kind(path)
+    index.set_dir(path)
+    return index
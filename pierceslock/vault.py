@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+"""
+vault.py
+By Ronald Kemker
+21 Nov 2021
+
+Description: Reads and writes the encrypted password files (.pwf) of the 
+             Password Manager.  A vault is a CSV table, one row per account,
+             stored in a .cmf container.  Older vaults have no VAULT_MARKER:
+             their fields were joined with plain commas, without quoting.
+
+"""
+
+import io, csv
+from pierceslock.cipher import AESCipher
+
+# First line of vaults written as CSV.  The NUL byte cannot occur in the
+# older format, whose fields come from the Password Manager's text entries.
+VAULT_MARKER = b'\x00pwf csv\n'
+
+def write_vault(path, key, rows):
+    '''
+    Encrypts and saves a password table
+
+    Parameters
+    ----------
+    path : string or file object
+        The .pwf file to write
+    key : byte-string
+        encryption key.
+    rows : list of lists of strings
+        The table rows
+
+    Returns
+    -------
+    None.
+    '''
+    text = io.StringIO()
+    csv.writer(text, lineterminator='\n').writerows(rows)
+    data = io.BytesIO(VAULT_MARKER + text.getvalue().encode('utf-8'))
+    AESCipher().encrypt_file(data, path, key)
+
+def read_vault(path, key, ttl=None):
+    '''
+    Authenticates, decrypts and parses a password table
+
+    Parameters
+    ----------
+    path : string or file object
+        The .pwf file to read
+    key : byte-string
+        encryption key.
+    ttl : int, optional
+        The "time-to-live" for a given message. (Default=None)  
+
+    Returns
+    -------
+    list of lists of strings
+        The table rows
+
+    Raises
+    ------
+    InvalidToken, TTLError, AuthenticationFailed, DecryptionFailed, 
+    UnpaddingError
+        Same conditions as AESCipher.decrypt_file
+    '''
+    data = io.BytesIO()
+    AESCipher().decrypt_file(path, data, key, ttl=ttl)
+    data = data.getvalue()
+    if not data.startswith(VAULT_MARKER):
+        # The older format wrote one byte per character (ord)
+        return [line.split(',') for line in data.decode('latin-1').split('\n')
+                if line]
+    text = io.StringIO(data[len(VAULT_MARKER):].decode('utf-8'), newline='')
+    return [row for row in csv.reader(text) if row]